@@ -0,0 +1,189 @@
+import json
+import logging
+import threading
+import Queue
+from collections import namedtuple
+
+log = logging.getLogger(__name__)
+
+# what a closed time_record adds to the totals. duration is in seconds
+Contribution = namedtuple('Contribution',
+                          'project_id phase_id action_item_id start duration')
+
+class Delta(namedtuple('Delta', 'old new')):
+    """One edit of a time_record: its Contribution before and after.
+    Either is None if the record wasn't closed then, so it counted
+    for nothing.
+    """
+
+    @property
+    def moved(self):
+        """True for a phase move, False if only the times changed."""
+        return (self.old is not None and self.new is not None
+                and self.old.phase_id != self.new.phase_id)
+
+    def changes(self):
+        """Returns (totals, buckets): seconds to add to each
+        (scope, scope_id) of time_total, and to each
+        (day, project_id, phase_id, action_item_id) of time_bucket.
+        """
+        totals = {}
+        buckets = {}
+        for sign, part in ((-1, self.old), (1, self.new)):
+            if part is None:
+                continue
+            seconds = sign * part.duration
+            for key in (('phase', part.phase_id),
+                        ('project', part.project_id),
+                        ('action_item', part.action_item_id)):
+                totals[key] = totals.get(key, 0) + seconds
+            key = (part.start - part.start % 86400, part.project_id,
+                   part.phase_id, part.action_item_id)
+            buckets[key] = buckets.get(key, 0) + seconds
+        return totals, buckets
+
+class TotalsWorker(threading.Thread):
+    """Background thread applying Deltas to time_total and time_bucket.
+
+    An edit commits its time_record and submit()s the Delta; the
+    worker takes everything queued since it last ran, adds up the
+    seconds per total and writes them in one transaction. A burst of
+    corrections to the same project costs a single upsert per phase.
+
+    Until a Delta is written its seconds are held as pending, and
+    totals() adds them to what it reads, so the editor sees its own
+    change straight away. Other readers of time_total may be behind
+    by a moment. Deltas still queued when the process exits are lost,
+    but init_db() rebuilds the totals from time_record on startup.
+
+    connect should return a new sqlite3 connection; the worker keeps
+    its own. A batch that fails is kept and tried again with the next
+    one, or after retry_delay seconds if nothing else arrives.
+    """
+
+    def __init__(self, connect, retry_delay=5):
+        super(TotalsWorker, self).__init__(name='totals')
+        self.daemon = True
+        self.connect = connect
+        self.retry_delay = retry_delay
+        self._queue = Queue.Queue()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._stop = object()
+
+    def submit(self, delta):
+        """Queues a Delta. Call after the edit has committed."""
+        totals, _ = delta.changes()
+        with self._lock:
+            self._add_pending(totals, 1)
+        self._queue.put(delta)
+
+    def flush(self):
+        """Blocks until every Delta submitted so far is written."""
+        self._queue.join()
+
+    def stop(self):
+        self._queue.put(self._stop)
+
+    def totals(self, db, scope, ids):
+        """Returns scope_id -> seconds for the ids, including the
+        Deltas that haven't been written yet.
+        """
+        ids = list(ids)
+        # held across the read, so a batch can't be committed and
+        # taken out of pending in between, and counted twice
+        with self._lock:
+            totals = dict(db.execute("""
+                SELECT  scope_id,
+                        seconds
+                FROM    time_total
+                WHERE   scope = ?
+                        AND scope_id IN (
+                            SELECT  value
+                            FROM    json_each(?)
+                        )
+                """, [scope, json.dumps([int(i) for i in ids])]))
+            for scope_id in ids:
+                totals[scope_id] = (totals.get(scope_id, 0) +
+                                    self._pending.get((scope, scope_id), 0))
+        return totals
+
+    def run(self):
+        db = self.connect()
+        totals, buckets, taken = {}, {}, 0
+        try:
+            while True:
+                try:
+                    batch = [self._queue.get(
+                        timeout=self.retry_delay if taken else None)]
+                except Queue.Empty:
+                    batch = []
+                while True:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except Queue.Empty:
+                        break
+                if self._stop in batch:
+                    return
+                for delta in batch:
+                    delta_totals, delta_buckets = delta.changes()
+                    merge(totals, delta_totals)
+                    merge(buckets, delta_buckets)
+                taken += len(batch)
+                try:
+                    self.write(db, totals, buckets)
+                except Exception:
+                    db.rollback()
+                    log.exception("Totals worker failed, will retry")
+                    continue
+                for _ in range(taken):
+                    self._queue.task_done()
+                totals, buckets, taken = {}, {}, 0
+        finally:
+            db.close()
+
+    def write(self, db, totals, buckets):
+        """Adds up the totals and buckets in one transaction, and takes
+        them out of pending once they're committed.
+        """
+        db.executemany("""
+            INSERT INTO time_total (scope,
+                                    scope_id,
+                                    seconds)
+            VALUES  (?,
+                    ?,
+                    ?)
+            ON CONFLICT (scope, scope_id)
+            DO UPDATE SET seconds = seconds + excluded.seconds
+            """, [key + (seconds,) for key, seconds in totals.items()
+                  if seconds])
+        db.executemany("""
+            INSERT INTO time_bucket (day,
+                                     project_id,
+                                     phase_id,
+                                     action_item_id,
+                                     seconds)
+            VALUES  (?,
+                    ?,
+                    ?,
+                    ?,
+                    ?)
+            ON CONFLICT (day, project_id, phase_id, action_item_id)
+            DO UPDATE SET seconds = seconds + excluded.seconds
+            """, [key + (seconds,) for key, seconds in buckets.items()
+                  if seconds])
+        with self._lock:
+            db.commit()
+            self._add_pending(totals, -1)
+
+    def _add_pending(self, totals, sign):
+        for key, seconds in totals.items():
+            seconds = self._pending.get(key, 0) + sign * seconds
+            if seconds:
+                self._pending[key] = seconds
+            else:
+                self._pending.pop(key, None)
+
+def merge(into, changes):
+    for key, seconds in changes.items():
+        into[key] = into.get(key, 0) + seconds
@@ -0,0 +1,36 @@
+import json
+
+# the tables with an archived flag. only these can be archived, and
+# the table names in the statements below only ever come from here
+ARCHIVABLE = ('action_item', 'item_rate', 'item_type', 'phase',
+              'project_status', 'user', 'usergroup')
+
+class ArchiveError(ValueError):
+    """Raised for a table that can't be archived."""
+
+# one constant statement per table. rows already in the wanted state
+# are skipped, so the count returned is of rows actually changed
+SET_ARCHIVED = dict((table, """
+    UPDATE  {}
+    SET     archived = :archived
+    WHERE   id IN (
+                SELECT  value
+                FROM    json_each(:ids)
+            )
+            AND archived IS NOT :archived
+    """.format(table)) for table in ARCHIVABLE)
+
+def set_archived(db, table, ids, archived=True):
+    """Archives the rows of table with the given ids, or with
+    archived=False brings them back, in one statement. Returns how
+    many rows changed.
+
+    Does not commit; the caller commits, and bumps the table in the
+    fragment cache.
+    """
+    if table not in SET_ARCHIVED:
+        raise ArchiveError("{} can't be archived.".format(table))
+    return db.execute(SET_ARCHIVED[table], {
+        "archived": 1 if archived else 0,
+        "ids": json.dumps([int(i) for i in ids])
+    }).rowcount
@@ -0,0 +1,49 @@
+"""Response size and time of an admin edit answered with the whole
+user editor, against a row patch.
+
+    python -m benchmarks.admin_patch [users] [edits]
+
+Fills the user table through /admin/bulk, then renames one user
+edits times each way. Without X-Table-Version the server sends the
+full editor, as it did before patches.
+"""
+import json
+import os
+import re
+import sys
+import time
+
+import main
+from benchmarks.bulk import new_database
+
+def run(users=2000, edits=200):
+    path, client = new_database()
+    client.post('/admin/bulk', content_type='application/json',
+                data=json.dumps([{"kind": 'user', "action": 'create',
+                                  "name": 'user{}'.format(i),
+                                  "email": 'user{}@example.com'.format(i),
+                                  "usergroup_id": 2} for i in range(users)]))
+    page = client.get('/admin').data
+    version = int(re.search(r'id="user_table" data-version="(\d+)"',
+                            page).group(1))
+
+    for name, patch in (('full editor', False), ('row patch', True)):
+        size = 0
+        started = time.time()
+        for i in range(edits):
+            headers = {'X-Table-Version': str(version)} if patch else {}
+            response = client.post('/admin/edit_user', headers=headers,
+                                   data={"user-id": '2',
+                                         "name": 'renamed {}'.format(i),
+                                         "email": 'renamed@example.com',
+                                         "usergroup": '2'})
+            version += 1
+            size += len(response.data)
+        seconds = time.time() - started
+        print('{:<12} {:>8.2f} ms/edit {:>9} bytes/edit'.format(
+            name, seconds / edits * 1000, size // edits))
+    main.get_pool().close_all()
+    os.remove(path)
+
+if __name__ == '__main__':
+    run(*[int(arg) for arg in sys.argv[1:3]])
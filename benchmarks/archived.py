@@ -0,0 +1,64 @@
+"""Open rates, types and project items as archived rows pile up, with
+and without the partial indexes over live rows (migration 009).
+
+    python -m benchmarks.archived [archived]
+
+Adds archived rows to item_rate, item_type and one project's
+action items, then times the queries main.py runs for the live ones.
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import timeit
+
+import archival
+from benchmarks import synthetic
+
+QUERIES = {
+    'open rates': "SELECT * FROM item_rate WHERE archived = 0",
+    'open types': "SELECT * FROM item_type WHERE archived = 0",
+    'project items': """
+        SELECT  id, name
+        FROM    action_item
+        WHERE   project_id = 1
+                AND archived = 0
+        """,
+}
+
+INDEXES = ('item_rate_live', 'item_type_live', 'action_item_live')
+
+def run(archived=50000, number=200):
+    path = os.path.join(tempfile.mkdtemp(), 'archived.db')
+    synthetic.build(path, records=1000)
+    db = sqlite3.connect(path)
+    for table, insert in (
+            ('item_rate', "INSERT INTO item_rate (description) VALUES ('old')"),
+            ('item_type', "INSERT INTO item_type (description) VALUES ('old')"),
+            ('action_item', """
+                INSERT INTO action_item (name, project_id, rate_id, type_id)
+                VALUES ('old', 1, 1, 1)
+                """)):
+        first = db.execute("SELECT max(id) FROM " + table).fetchone()[0] + 1
+        db.executemany(insert, [()] * archived)
+        archival.set_archived(db, table, range(first, first + archived))
+    db.commit()
+    db.execute("ANALYZE")
+
+    def time_queries(label):
+        for name, sql in sorted(QUERIES.items()):
+            seconds = timeit.timeit(lambda: db.execute(sql).fetchall(),
+                                    number=number)
+            print('{:<16} {:<14} {:>8.3f} ms'.format(
+                label, name, seconds / number * 1000))
+
+    time_queries('partial indexes')
+    for index in INDEXES:
+        db.execute("DROP INDEX " + index)
+    db.execute("ANALYZE")
+    time_queries('without them')
+    db.close()
+    os.remove(path)
+
+if __name__ == '__main__':
+    run(*[int(arg) for arg in sys.argv[1:2]])
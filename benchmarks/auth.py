@@ -0,0 +1,60 @@
+"""Per-request cost of the authorization check in check_user.
+
+Compares the old substring scan over the session's url list with a
+PermissionMap lookup, and times a request context running the
+before_request hooks with a warm session cache.
+
+Run from the repo root:
+    python -m benchmarks.auth
+"""
+import os
+import tempfile
+import timeit
+
+import main
+
+def old_check(navi, full_path):
+    stop_access = True
+    for url in navi:
+        if url in full_path:
+            stop_access = False
+    return not stop_access
+
+def run(number=100000):
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    os.remove(path)
+    main.app.config['DATABASE'] = path
+    with main.app.app_context():
+        main.init_db()
+    client = main.app.test_client()
+    client.post('/login', data={'name': 'Luke', 'password': 'password'})
+    with client.session_transaction() as sess:
+        session_id = sess['session_id']
+
+    navi = ['admin', 'my_projects', 'profile', 'adjustments', 'reports']
+    full_path = '/reports/run_report?'
+    permissions = main.permission_map
+    results = {
+        'substring scan': timeit.timeit(
+            lambda: old_check(navi, full_path), number=number),
+        'permission map': timeit.timeit(
+            lambda: permissions.allows(1, 'run_report'), number=number),
+    }
+
+    def hook():
+        with main.app.test_request_context('/reports/run_report'):
+            main.session['session_id'] = session_id
+            main.app.preprocess_request()
+    hook_number = number // 100
+    results['request ctx + check_user'] = timeit.timeit(
+        hook, number=hook_number) * 100
+
+    for name, seconds in sorted(results.items()):
+        print('{:<26} {:>8.3f} us/request'.format(
+            name, seconds / number * 1e6))
+    main.get_pool().close_all()
+    os.remove(path)
+
+if __name__ == '__main__':
+    run()
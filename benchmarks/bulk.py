@@ -0,0 +1,82 @@
+"""Onboarding users and repricing rates one admin POST at a time,
+against one POST to /admin/bulk.
+
+    python -m benchmarks.bulk [users] [rates]
+
+Mail is only queued; the outbox worker is never started.
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+
+import main
+from mailer import OutboxWorker
+
+def new_database():
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    os.remove(path)
+    main.app.config['DATABASE'] = path
+    main.app.extensions.pop('db_pool', None)
+    main.fragment_cache.clear()
+    with main.app.app_context():
+        main.init_db()
+    # wake() does nothing until the worker is started
+    main.app.extensions['mail_worker'] = OutboxWorker(main.connect_db,
+                                                      'localhost')
+    client = main.app.test_client()
+    client.post('/login', data={'name': 'Luke', 'password': 'password'})
+    return path, client
+
+def count(table):
+    with main.app.app_context():
+        return main.get_db().execute(
+            "SELECT count(*) FROM {}".format(table)).fetchone()[0]
+
+def timed(name, requests, table, send):
+    path, client = new_database()
+    before = count(table)
+    started = time.time()
+    for request in requests:
+        response = send(client, request)
+        assert response.status_code == 200, response.data
+    seconds = time.time() - started
+    print('{:<32} {:>4} requests {:>8.1f} ms  {} rows, {} mails queued'.format(
+        name, len(requests), seconds * 1000, count(table) - before,
+        count('outbox')))
+    main.get_pool().close_all()
+    os.remove(path)
+
+def post_form(url):
+    return lambda client, data: client.post(url, data=data)
+
+def post_bulk(client, operations):
+    return client.post('/admin/bulk', data=json.dumps(operations),
+                       content_type='application/json')
+
+def run(users=300, rates=50):
+    new_users = [{"name": 'user{}'.format(i),
+                  "email": 'user{}@example.com'.format(i),
+                  "usergroup_id": 2} for i in range(users)]
+    timed('edit_user per user',
+          [{"user-id": '-1', "name": user['name'], "email": user['email'],
+            "usergroup": '2'} for user in new_users],
+          'user', post_form('/admin/edit_user'))
+    timed('bulk create users',
+          [[dict(user, kind='user', action='create') for user in new_users]],
+          'user', post_bulk)
+
+    timed('edit_rate per rate',
+          [{"rate-id": '-1', "description": 'Rate {}'.format(i),
+            "fee_per_hour": str(i)} for i in range(rates)],
+          'item_rate', post_form('/admin/edit_rate'))
+    timed('bulk create rates',
+          [[{"kind": 'rate', "action": 'create',
+             "description": 'Rate {}'.format(i),
+             "fee_per_hour": i} for i in range(rates)]],
+          'item_rate', post_bulk)
+
+if __name__ == '__main__':
+    run(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,72 @@
+"""A correction session on the adjustments page: many edits in a row
+to one project's time records.
+
+    python -m benchmarks.edits [records] [edits]
+
+Each edit is answered with the edited row and the totals of the
+phases it touched, and the totals are written by the worker. For
+comparison, the same edits are followed by rendering the project's
+whole page of phases, which is what the edit used to send back.
+"""
+import datetime
+import os
+import random
+import sys
+import tempfile
+import time
+
+import main
+from benchmarks import synthetic
+
+def run(records=100000, edits=200, seed=0):
+    path = os.path.join(tempfile.mkdtemp(), 'edits.db')
+    synthetic.build_app_database(path, records=records)
+    client = main.app.test_client()
+    client.post('/login', data={'name': 'Luke', 'password': 'password'})
+    with main.app.app_context():
+        project_id = main.get_db().execute("""
+            SELECT  project_id
+            FROM    time_record
+            GROUP BY    project_id
+            ORDER BY    count(*) DESC
+            LIMIT   1
+            """).fetchone()[0]
+        record_ids = [row[0] for row in main.get_db().execute(
+            "SELECT id FROM time_record WHERE project_id = ?", [project_id])]
+        phase_ids = [p['id'] for p in main.get_phase_choices(project_id)]
+
+    rng = random.Random(seed)
+    start = datetime.datetime(2016, 6, 1, 9)
+    def edit():
+        began = start + datetime.timedelta(minutes=rng.randint(0, 10000))
+        return {"project-id": str(project_id),
+                "record-id": str(rng.choice(record_ids)),
+                "start": began.strftime('%Y-%m-%d %H:%M:%S'),
+                "stop": (began + datetime.timedelta(
+                    minutes=rng.randint(5, 240))).strftime('%Y-%m-%d %H:%M:%S'),
+                "phase": str(rng.choice(phase_ids))}
+
+    for name, full_page in (('edited row', False), ('full page', True)):
+        size = 0
+        started = time.time()
+        for i in range(edits):
+            response = client.post('/adjustments/edit_time_records',
+                                   data=edit())
+            assert response.status_code == 200, response.data
+            size += len(response.data)
+            if full_page:
+                response = client.post('/adjustments/search_by_project',
+                                       data={"project-id": project_id})
+                size += len(response.data)
+        seconds = time.time() - started
+        flushed = time.time()
+        main.get_totals_worker().flush()
+        print('{:<12} {:>8.2f} ms/edit {:>9} bytes/edit, '
+              'totals written {:.1f} ms later'.format(
+                  name, seconds / edits * 1000, size // edits,
+                  (time.time() - flushed) * 1000))
+    main.get_pool().close_all()
+    os.remove(path)
+
+if __name__ == '__main__':
+    run(*[int(arg) for arg in sys.argv[1:3]])
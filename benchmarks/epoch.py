@@ -0,0 +1,90 @@
+"""Aggregate query speed with DATETIME text timestamps compared to
+integer epoch seconds with a stored duration.
+
+Builds a synthetic database, copies time_record into a table laid
+out the old way (start and stop as text) and runs the same sums over
+both.
+
+Run from the repo root:
+    python -m benchmarks.epoch [records]
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+from benchmarks import synthetic
+
+# (name, query on the old text layout, query on the epoch layout)
+QUERIES = [
+    ("total per phase",
+     """SELECT  phase_id,
+                sum(strftime('%s', stop) - strftime('%s', start))
+        FROM    text_record
+        WHERE   stop IS NOT NULL
+        GROUP BY    phase_id""",
+     """SELECT  phase_id,
+                sum(duration)
+        FROM    time_record
+        WHERE   stop IS NOT NULL
+        GROUP BY    phase_id"""),
+    ("total per day",
+     """SELECT  date(start),
+                sum(strftime('%s', stop) - strftime('%s', start))
+        FROM    text_record
+        WHERE   stop IS NOT NULL
+        GROUP BY    date(start)""",
+     """SELECT  start - start % 86400,
+                sum(duration)
+        FROM    time_record
+        WHERE   stop IS NOT NULL
+        GROUP BY    start - start % 86400"""),
+    ("one year, per item",
+     """SELECT  action_item_id,
+                sum(strftime('%s', stop) - strftime('%s', start)) / 60.0
+        FROM    text_record
+        WHERE   start BETWEEN datetime('2016-01-01', 'utc')
+                      AND     datetime('2016-12-31 23:59:59', 'utc')
+                AND stop IS NOT NULL
+        GROUP BY    action_item_id""",
+     """SELECT  action_item_id,
+                sum(duration) / 60.0
+        FROM    time_record
+        WHERE   start >= strftime('%s', '2016-01-01', 'utc')
+                AND start < strftime('%s', '2017-01-01', 'utc')
+                AND duration IS NOT NULL
+        GROUP BY    action_item_id"""),
+]
+
+def run(records=200000, repeat=5):
+    path = os.path.join(tempfile.mkdtemp(), 'epoch.db')
+    print(synthetic.build(path, records=records))
+    db = sqlite3.connect(path)
+    db.executescript("""
+        CREATE TABLE text_record AS
+        SELECT  id,
+                action_item_id,
+                project_id,
+                phase_id,
+                datetime(start, 'unixepoch') AS start,
+                datetime(stop, 'unixepoch') AS stop
+        FROM    time_record;
+        
+        CREATE INDEX text_record_start 
+            ON text_record (start, stop, action_item_id);
+        """)
+    for name, text_sql, epoch_sql in QUERIES:
+        timings = []
+        for sql in (text_sql, epoch_sql):
+            started = time.time()
+            for i in range(repeat):
+                db.execute(sql).fetchall()
+            timings.append((time.time() - started) / repeat * 1000)
+        print('{:<20} text {:>8.1f} ms   epoch {:>8.1f} ms   {:>4.1f}x'.format(
+            name, timings[0], timings[1], timings[0] / timings[1]))
+    db.close()
+    os.remove(path)
+
+if __name__ == '__main__':
+    run(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,122 @@
+"""Cost of holding many idle timer event streams open.
+
+Serves the app from a threaded server in this process, opens clients
+event streams for one logged in user, and measures the process' CPU
+use while they sit idle, how long a timer start and stop take to
+reach all of them, and how quickly closed streams are let go.
+
+Run from the repo root:
+    python -m benchmarks.events [clients]
+"""
+import os
+import select
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+import main
+
+class QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+def open_stream(port, cookie):
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.sendall("GET /my_projects/timer_events HTTP/1.0\r\n"
+                 "Cookie: {}\r\n\r\n".format(cookie))
+    return sock
+
+def wait_for(socks, event, timeout=30):
+    """Reads from every socket until each has sent the event. Returns
+    how long that took.
+    """
+    started = time.time()
+    # poll, since select can't watch a thousand sockets
+    poller = select.poll()
+    pending = {}
+    for sock in socks:
+        poller.register(sock, select.POLLIN)
+        pending[sock.fileno()] = (sock, '')
+    while pending:
+        if time.time() - started > timeout:
+            raise RuntimeError("{} of {} streams never sent {}".format(
+                len(pending), len(socks), event))
+        for fileno, flags in poller.poll(1000):
+            sock, received = pending[fileno]
+            received += sock.recv(65536)
+            if 'event: ' + event in received:
+                poller.unregister(fileno)
+                del pending[fileno]
+            else:
+                pending[fileno] = (sock, received)
+    return time.time() - started
+
+def cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+def run(clients=200, idle=10, keepalive=1):
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    os.remove(path)
+    main.app.config['DATABASE'] = path
+    main.timer_bus.keepalive = keepalive
+    with main.app.app_context():
+        main.init_db()
+    client = main.app.test_client()
+    client.post('/login', data={'name': 'Luke', 'password': 'password'})
+    client.post('/my_projects/expanded_project', data='1')
+    cookie = '; '.join('{}={}'.format(c.name, c.value)
+                       for c in client.cookie_jar)
+
+    server = make_server('127.0.0.1', 0, main.app, threaded=True,
+                         request_handler=QuietHandler)
+    # closed streams end in a broken pipe, which is expected here
+    server.handle_error = lambda request, client_address: None
+    server.socket.listen(clients)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    port = server.socket.getsockname()[1]
+
+    started = time.time()
+    socks = [open_stream(port, cookie) for i in range(clients)]
+    wait_for(socks, 'timer_state')
+    print('{} streams open in {:.2f}s, {} subscribers, {} threads'.format(
+        clients, time.time() - started, len(main.timer_bus),
+        threading.active_count()))
+
+    before = cpu_time()
+    time.sleep(idle)
+    used = cpu_time() - before
+    print('idle {}s with a keepalive every {}s: {:.3f}s CPU, {:.2f}% '
+          '({:.1f} us per stream per second)'.format(
+              idle, keepalive, used, used / idle * 100,
+              used / idle / clients * 1e6))
+
+    for event in ('timer_started', 'timer_stopped'):
+        started = time.time()
+        client.post('/my_projects/time_action_item', data={'item_id': '1'})
+        wait_for(socks, event)
+        print('{} reached {} streams {:.1f} ms after the request '
+              'was sent'.format(event, clients,
+                                (time.time() - started) * 1000))
+
+    for sock in socks:
+        sock.close()
+    started = time.time()
+    while len(main.timer_bus) and time.time() - started < keepalive * 5:
+        time.sleep(0.1)
+    print('{} subscribers left {:.1f}s after the clients went away'.format(
+        len(main.timer_bus), time.time() - started))
+
+    server.shutdown()
+    main.get_pool().close_all()
+    os.remove(path)
+
+if __name__ == '__main__':
+    run(*[int(arg) for arg in sys.argv[1:2]])
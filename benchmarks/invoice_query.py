@@ -0,0 +1,51 @@
+"""Times invoicing.get_invoices() against the per phase queries it
+replaced, for single phases and for a batch.
+
+    python -m benchmarks.invoice_query [phases] [records]
+
+tests/test_invoicing.py checks that the invoices are the same.
+"""
+import os
+import sys
+import tempfile
+import time
+
+import invoicing
+import main
+from benchmarks import synthetic
+from tests.test_invoicing import old_invoice
+
+def run(phases=500, records=100000):
+    path = os.path.join(tempfile.mkdtemp(), 'invoice_query.db')
+    print(synthetic.build_app_database(path, records=records))
+    with main.app.test_request_context():
+        db = main.get_db()
+        phase_ids = [row[0] for row in db.execute("""
+            SELECT  id
+            FROM    phase
+            ORDER BY    id
+            LIMIT   ?
+            """, [phases])]
+        
+        started = time.time()
+        for phase_id in phase_ids:
+            old_invoice(db, phase_id)
+        old_elapsed = time.time() - started
+        started = time.time()
+        for phase_id in phase_ids:
+            invoicing.get_invoice(db, [phase_id])
+        single_elapsed = time.time() - started
+        started = time.time()
+        invoicing.get_invoices(db, phase_ids)
+        batch_elapsed = time.time() - started
+    main.get_pool().close_all()
+    os.remove(path)
+    
+    for name, elapsed in (('old, per phase', old_elapsed),
+                          ('new, per phase', single_elapsed),
+                          ('new, one batch', batch_elapsed)):
+        print('{:<16} {:>7.1f} ms  {:>7.3f} ms/invoice'.format(
+            name, elapsed * 1000, elapsed * 1000 / len(phase_ids)))
+
+if __name__ == '__main__':
+    run(*[int(arg) for arg in sys.argv[1:3]])
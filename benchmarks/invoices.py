@@ -0,0 +1,59 @@
+"""Invoice throughput, one phase at a time compared to a batch.
+
+    python -m benchmarks.invoices [phases] [records]
+
+"one at a time" builds each phase's invoice with render_bill(), the
+way send_invoice does without snapshots. The batches go through
+invoicing.run_batch() with one render process and with one per CPU.
+"snapshots" calls get_bill_for_phase() twice for each phase, the
+first pass freezing the closed phases and the second reading them
+back.
+"""
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+import invoicing
+import main
+from benchmarks import synthetic
+
+def run(phases=500, records=100000):
+    path = os.path.join(tempfile.mkdtemp(), 'invoices.db')
+    print(synthetic.build_app_database(path, records=records))
+    with main.app.test_request_context():
+        db = main.get_db()
+        phase_ids = [row[0] for row in db.execute("""
+            SELECT  id
+            FROM    phase
+            ORDER BY    id
+            LIMIT   ?
+            """, [phases])]
+        started = time.time()
+        for phase_id in phase_ids:
+            main.render_bill([phase_id])
+        elapsed = time.time() - started
+        print('{:<24} {:>6.2f}s  {:>7.1f} invoices/s'.format(
+            'one at a time', elapsed, len(phase_ids) / elapsed))
+        for name in ('snapshots, first pass', 'snapshots, second pass'):
+            started = time.time()
+            for phase_id in phase_ids:
+                main.get_bill_for_phase(phase_id)
+            elapsed = time.time() - started
+            print('{:<24} {:>6.2f}s  {:>7.1f} invoices/s'.format(
+                name, elapsed, len(phase_ids) / elapsed))
+        cpus = multiprocessing.cpu_count()
+        for processes in sorted(set([1, max(2, cpus)])):
+            # nothing here has started a thread yet, so it's safe to fork
+            invoicing.start_pool(processes)
+            archive, stats = invoicing.run_batch(db, phase_ids)
+            invoicing.stop_pool()
+            print('{:<24} {:>6.2f}s  {:>7.1f} invoices/s  ({})'.format(
+                'batch, {} processes'.format(processes), 
+                stats.total, stats.per_second, stats))
+    main.get_pool().close_all()
+    os.remove(path)
+
+if __name__ == '__main__':
+    run(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,87 @@
+"""Cost of the pages of phases and records the my_projects page loads,
+for one large synthetic project.
+
+    python -m benchmarks.render [phases] [records] [repeat]
+
+Times the query and the rendering of each page the app sends:
+phases.html with the newest phase's first page of records, the next
+page of older phases, and phase_records.html for the following pages
+of a phase's records. For comparison, the whole project is rendered
+as one phases.html with every phase's records filled in, which is
+what the page sent before it was paged.
+"""
+import os
+import sys
+import tempfile
+import time
+
+import main
+from benchmarks import synthetic
+
+def timed(function, repeat):
+    """Returns (what function returned, mean seconds per call)."""
+    started = time.time()
+    for i in range(repeat):
+        result = function()
+    return result, (time.time() - started) / repeat
+
+def records_page(phase_id, after, after_id):
+    records, more = main.get_phase_records(phase_id, after, after_id)
+    return {"phase_id": phase_id, "records": records, "more": more}
+
+def pages(project_id, phase_ids):
+    """Returns [(name, query, template)], query returning the context
+    template is rendered with.
+    """
+    first = main.get_phase_page(project_id)
+    newest = phase_ids[0]
+    last = first['time_records'][newest][-1]
+    return [
+        ('first page', lambda: main.get_phase_page(project_id),
+         'phases.html'),
+        ('older phases', lambda: main.get_phase_page(
+            project_id, first['phases'][-1]['number']), 'phases.html'),
+        ('next records', lambda: records_page(
+            newest, last['start_key'], last['id']), 'phase_records.html'),
+        ('whole project', lambda: main.get_phase_page(
+            project_id, expand=phase_ids), 'phases.html'),
+    ]
+
+def run(phases=50, records=20000, repeat=20):
+    path = os.path.join(tempfile.mkdtemp(), 'render.db')
+    synthetic.build_app_database(path, users=1, projects_per_user=1,
+                                 phases_per_project=phases, records=records)
+    config = main.app.config
+    with main.app.test_request_context():
+        project_id = main.get_db().execute("""
+            SELECT  project_id
+            FROM    time_record
+            GROUP BY    project_id
+            ORDER BY    count(*) DESC
+            LIMIT   1
+            """).fetchone()[0]
+        phase_ids = [p['id'] for p in main.get_project_phases(project_id)]
+        print('project {}: {} phases, {} records'.format(
+            project_id, len(phase_ids), main.get_db().execute(
+                "SELECT count(*) FROM time_record WHERE project_id = ?",
+                [project_id]).fetchone()[0]))
+        print('{:<14} {:>9} {:>10} {:>9}'.format(
+            'page', 'query ms', 'render ms', 'KB'))
+        page_sizes = config['PHASE_PAGE_SIZE'], config['RECORD_PAGE_SIZE']
+        for name, query, template in pages(project_id, phase_ids):
+            if name == 'whole project':
+                config['PHASE_PAGE_SIZE'] = len(phase_ids)
+                config['RECORD_PAGE_SIZE'] = records
+            context, query_seconds = timed(query, repeat)
+            template = main.app.jinja_env.get_template(template)
+            html, render_seconds = timed(
+                lambda: template.render(**context), repeat)
+            print('{:<14} {:>9.2f} {:>10.2f} {:>9.1f}'.format(
+                name, query_seconds * 1000, render_seconds * 1000,
+                len(html.encode('utf-8')) / 1024.0))
+        config['PHASE_PAGE_SIZE'], config['RECORD_PAGE_SIZE'] = page_sizes
+    main.get_pool().close_all()
+    os.remove(path)
+
+if __name__ == '__main__':
+    run(*[int(arg) for arg in sys.argv[1:4]])
@@ -0,0 +1,39 @@
+"""Run time of every registered report over a large synthetic database.
+
+    python -m benchmarks.reports [records]
+
+Each report is run over the whole history and over one month.
+"""
+import os
+import sys
+import tempfile
+import time
+
+import main
+from benchmarks import synthetic
+from reporting import REPORTS
+
+RANGES = {
+    'all time': {'start': '2014-12-01', 'end': '2017-12-31'},
+    'one month': {'start': '2016-03-01', 'end': '2016-03-31'},
+}
+
+def run(records=200000, repeat=5):
+    path = os.path.join(tempfile.mkdtemp(), 'reports.db')
+    print(synthetic.build_app_database(path, records=records))
+    with main.app.test_request_context():
+        db = main.get_db()
+        for slug, report in REPORTS.items():
+            for range_name, form in sorted(RANGES.items()):
+                values = report.parse(form)
+                started = time.time()
+                for i in range(repeat):
+                    rows = report.run(db, values)
+                elapsed = (time.time() - started) / repeat
+                print('{:<32} {:<10} {:>8.1f} ms  {:>5} rows'.format(
+                    report.name, range_name, elapsed * 1000, len(rows)))
+    main.get_pool().close_all()
+    os.remove(path)
+
+if __name__ == '__main__':
+    run(*[int(arg) for arg in sys.argv[1:2]])
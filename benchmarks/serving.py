@@ -0,0 +1,123 @@
+"""Requests per second and latency of the threaded server app.run()
+uses, with and without the ConcurrencyLimit main.py wraps it in.
+
+    python -m benchmarks.serving [clients] [seconds]
+
+Each server runs in its own process over the same synthetic database.
+clients threads here log in once, then fetch the my_projects pages
+back to back for seconds, one connection per request.
+"""
+import httplib
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from werkzeug.serving import make_server as make_dev_server, \
+    WSGIRequestHandler
+
+import main
+from concurrency import ConcurrencyLimit
+from benchmarks import synthetic
+
+PATHS = ['/my_projects',
+         '/my_projects/get_phases',
+         '/my_projects/currently_timing',
+         '/reports']
+
+class QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+def run_server(mode, path, pipe):
+    main.app.config['DATABASE'] = path
+    with main.app.app_context():
+        main.init_db()
+    if mode == 'limited':
+        main.app.wsgi_app = ConcurrencyLimit(main.app.wsgi_app,
+                                             main.app.config['MAX_REQUESTS'],
+                                             main.app.config['MAX_STREAMS'],
+                                             main.STREAM_PATHS)
+    server = make_dev_server('127.0.0.1', 0, main.app, threaded=True,
+                             request_handler=QuietHandler)
+    pipe.send(server.socket.getsockname()[1])
+    server.serve_forever()
+
+def request(port, method, path, body=None, headers={}):
+    conn = httplib.HTTPConnection('127.0.0.1', port)
+    conn.request(method, path, body, headers)
+    response = conn.getresponse()
+    response.read()
+    conn.close()
+    return response
+
+def log_in(port):
+    response = request(port, 'POST', '/login',
+                       'name=Luke&password=password',
+                       {'Content-Type': 'application/x-www-form-urlencoded'})
+    cookie = response.getheader('set-cookie').split(';')[0]
+    request(port, 'POST', '/my_projects/expanded_project', '1',
+            {'Cookie': cookie})
+    return cookie
+
+def load(port, cookie, clients, seconds):
+    """Returns (latencies, errors) from clients threads hitting PATHS
+    until seconds are up.
+    """
+    latencies = []
+    errors = []
+    deadline = time.time() + seconds
+
+    def client(offset):
+        i = offset
+        while time.time() < deadline:
+            started = time.time()
+            try:
+                status = request(port, 'GET', PATHS[i % len(PATHS)],
+                                 headers={'Cookie': cookie}).status
+            except Exception as e:
+                errors.append(e)
+                continue
+            if status >= 400:
+                errors.append(status)
+            latencies.append(time.time() - started)
+            i += 1
+
+    threads = [threading.Thread(target=client, args=(i,))
+               for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def run(clients=16, seconds=10, records=50000):
+    path = os.path.join(tempfile.mkdtemp(), 'serve.db')
+    print(synthetic.build(path, records=records))
+    for mode in ('unlimited', 'limited'):
+        parent, child = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=run_server,
+                                          args=(mode, path, child))
+        process.start()
+        port = parent.recv()
+        cookie = log_in(port)
+        load(port, cookie, clients, 1)
+        latencies, errors = load(port, cookie, clients, seconds)
+        process.terminate()
+        process.join()
+        latencies.sort()
+        print('{:<18} {:>7.1f} req/s  p50 {:>6.1f} ms  p99 {:>6.1f} ms  '
+              '{} errors'.format(
+                  mode, len(latencies) / float(seconds),
+                  percentile(latencies, 50) * 1000,
+                  percentile(latencies, 99) * 1000,
+                  len(errors)))
+    os.remove(path)
+
+if __name__ == '__main__':
+    run(*[int(arg) for arg in sys.argv[1:3]])
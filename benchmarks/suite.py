@@ -0,0 +1,198 @@
+"""Latency and query count of the main routes over a large synthetic
+database, saved as JSON so runs can be compared.
+
+    python -m benchmarks.suite [records] [requests] [out.json] [baseline.json]
+
+Builds the database with synthetic.build() (the same seed gives the
+same data, so runs are comparable), logs in as the admin owning the
+busiest project, and sends each scenario's requests through the Flask
+test client. For each scenario it reports p50/p95/p99 latency and the
+queries run per request, counted by a connection class handed to
+connect_db() through DB_FACTORY. Given a baseline from an earlier run,
+the change in each figure is printed alongside.
+"""
+import datetime
+import json
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import main
+from benchmarks import synthetic
+
+# queries run by the current thread, so the background workers'
+# queries aren't put down to the request being timed
+counter = threading.local()
+
+class CountingCursor(sqlite3.Cursor):
+    def execute(self, *args):
+        counter.queries = getattr(counter, 'queries', 0) + 1
+        return super(CountingCursor, self).execute(*args)
+
+    def executemany(self, *args):
+        counter.queries = getattr(counter, 'queries', 0) + 1
+        return super(CountingCursor, self).executemany(*args)
+
+class CountingConnection(sqlite3.Connection):
+    """Connection whose statements are counted in counter.queries.
+    Connection.execute() goes through cursor(), so it's counted too.
+    """
+
+    def cursor(self, factory=CountingCursor):
+        return super(CountingConnection, self).cursor(factory)
+
+def percentile(ordered, p):
+    """Nearest rank percentile of an already sorted list."""
+    index = max(0, int(round(p / 100.0 * len(ordered))) - 1)
+    return ordered[min(index, len(ordered) - 1)]
+
+class Workload(object):
+    """The ids the scenarios pick from, found once the database is
+    built: the busiest project, its phases, items and records, and
+    the admin who owns it.
+    """
+
+    def __init__(self, db, seed=0):
+        self.rng = random.Random(seed)
+        self.project_id, self.user_name = db.execute("""
+            SELECT  project.id,
+                    user.name
+            FROM    project,
+                    user,
+                    time_record
+            WHERE   user.id = project.user_id
+                    AND user.usergroup_id = 1
+                    AND time_record.project_id = project.id
+            GROUP BY    project.id
+            ORDER BY    count(*) DESC
+            LIMIT   1
+            """).fetchone()
+        self.phase_ids = [row[0] for row in db.execute(
+            "SELECT id FROM phase WHERE project_id = ?", [self.project_id])]
+        self.item_ids = [row[0] for row in db.execute(
+            "SELECT id FROM action_item WHERE project_id = ?",
+            [self.project_id])]
+        self.record_ids = [row[0] for row in db.execute(
+            "SELECT id FROM time_record WHERE project_id = ?",
+            [self.project_id])]
+
+    def login(self, client):
+        return client.post('/login', data={"name": self.user_name,
+                                           "password": 'password'})
+
+    def edit(self):
+        """Form data moving a random record to a random time and
+        phase, like a correction on the adjustments page.
+        """
+        start = (datetime.datetime(2016, 1, 1) +
+                 datetime.timedelta(minutes=self.rng.randint(0, 500000)))
+        stop = start + datetime.timedelta(minutes=self.rng.randint(5, 240))
+        return {"project-id": str(self.project_id),
+                "record-id": str(self.rng.choice(self.record_ids)),
+                "start": start.strftime('%Y-%m-%d %H:%M:%S'),
+                "stop": stop.strftime('%Y-%m-%d %H:%M:%S'),
+                "phase": str(self.rng.choice(self.phase_ids))}
+
+# name -> (expected status, send(client, workload)). They run in this
+# order, against the one logged in session, login excepted
+SCENARIOS = OrderedDict([
+    ('login', (302, lambda client, w: w.login(client))),
+    ('my_projects', (200, lambda client, w: client.get('/my_projects'))),
+    ('expanded_project', (200, lambda client, w: client.post(
+        '/my_projects/expanded_project', data=str(w.project_id)))),
+    # every other request starts the timer, the rest stop it
+    ('time_action_item', (200, lambda client, w: client.post(
+        '/my_projects/time_action_item',
+        data={"item_id": str(w.rng.choice(w.item_ids))}))),
+    ('get_phases', (200, lambda client, w: client.get(
+        '/my_projects/get_phases'))),
+    ('preview_invoice', (200, lambda client, w: client.post(
+        '/my_projects/preview_invoice',
+        data=str(w.rng.choice(w.phase_ids))))),
+    ('run_report', (200, lambda client, w: client.post(
+        '/reports/run_report',
+        data={"report": 'item_type',
+              "start": '2015-01-01 00:00:00',
+              "end": '2017-01-01 00:00:00'}))),
+    ('edit_time_records', (200, lambda client, w: client.post(
+        '/adjustments/edit_time_records', data=w.edit()))),
+])
+
+def time_scenario(client, workload, status, send, requests):
+    """Sends requests requests, returns a dict of the figures."""
+    seconds = []
+    queries = []
+    for i in range(requests):
+        counter.queries = 0
+        started = time.time()
+        response = send(client, workload)
+        seconds.append(time.time() - started)
+        queries.append(counter.queries)
+        assert response.status_code == status, response.data[:500]
+    seconds.sort()
+    return OrderedDict([
+        ("requests", requests),
+        ("p50_ms", percentile(seconds, 50) * 1000),
+        ("p95_ms", percentile(seconds, 95) * 1000),
+        ("p99_ms", percentile(seconds, 99) * 1000),
+        ("mean_ms", sum(seconds) / requests * 1000),
+        ("queries_per_request", float(sum(queries)) / requests),
+        ("max_queries", max(queries)),
+    ])
+
+def run(records=200000, requests=200, out=None, baseline=None, seed=0):
+    path = os.path.join(tempfile.mkdtemp(), 'suite.db')
+    main.app.config['DB_FACTORY'] = CountingConnection
+    main.app.extensions.pop('db_pool', None)
+    counts = synthetic.build_app_database(path, records=records, seed=seed)
+    with main.app.app_context():
+        workload = Workload(main.get_db(), seed)
+    client = main.app.test_client()
+    workload.login(client)
+
+    results = OrderedDict([
+        ("date", datetime.datetime.now().isoformat()),
+        ("python", platform.python_version()),
+        ("sqlite", sqlite3.sqlite_version),
+        ("seed", seed),
+        ("database", counts),
+        ("scenarios", OrderedDict()),
+    ])
+    compare = {}
+    if baseline is not None:
+        with open(baseline) as f:
+            compare = json.load(f)['scenarios']
+    print('{:<18} {:>9} {:>9} {:>9} {:>9}'.format(
+        'scenario', 'p50 ms', 'p95 ms', 'p99 ms', 'queries'))
+    for name, (status, send) in SCENARIOS.items():
+        figures = time_scenario(client, workload, status, send, requests)
+        results['scenarios'][name] = figures
+        line = '{:<18} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.1f}'.format(
+            name, figures['p50_ms'], figures['p95_ms'], figures['p99_ms'],
+            figures['queries_per_request'])
+        if name in compare:
+            line += '   p50 {:+.0%}, queries {:+.1f}'.format(
+                figures['p50_ms'] / compare[name]['p50_ms'] - 1,
+                figures['queries_per_request'] -
+                compare[name]['queries_per_request'])
+        print(line)
+    main.get_totals_worker().flush()
+
+    out = out or 'benchmark-{}.json'.format(
+        datetime.datetime.now().strftime('%Y%m%d-%H%M%S'))
+    with open(out, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('Saved to {}'.format(out))
+    main.get_pool().close_all()
+    main.app.config['DB_FACTORY'] = sqlite3.Connection
+    os.remove(path)
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    run(*[int(arg) for arg in args[:2]] + args[2:4])
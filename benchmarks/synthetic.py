@@ -0,0 +1,129 @@
+"""Seeded generator for large Stopwatch databases.
+
+    python -m benchmarks.synthetic out.db [records]
+
+builds a database from the real schema (db.sql plus migrations) and
+fills it with users, projects, phases, action items and time records.
+The same seed always gives the same database.
+"""
+import calendar
+import datetime
+import os
+import random
+import sqlite3
+import sys
+
+import schema
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# start of the generated history, in epoch seconds like time_record
+EPOCH = calendar.timegm(datetime.datetime(2015, 1, 1).timetuple())
+
+def build(path, users=20, projects_per_user=10, phases_per_project=8,
+          items_per_project=6, records=100000, days=730, seed=0):
+    """Creates the database at path. Returns a dict of how many of
+    each thing were made.
+
+    Records are spread evenly over the phases. Within a phase they are
+    back to back through days of history, so phases are in time order
+    the way they would be if they were really timed.
+    """
+    rng = random.Random(seed)
+    if os.path.exists(path):
+        os.remove(path)
+    db = sqlite3.connect(path)
+    schema.migrate(db, ROOT)
+    
+    rates = [row[0] for row in db.execute("SELECT id FROM item_rate")]
+    types = [row[0] for row in db.execute("SELECT id FROM item_type")]
+    groups = [row[0] for row in db.execute("SELECT id FROM usergroup")]
+    
+    first_user = db.execute("SELECT max(id) FROM user").fetchone()[0] + 1
+    db.executemany("""
+        INSERT INTO user (id, name, password, usergroup_id, email)
+        VALUES (?, ?, 'password', ?, ?)
+        """, [(first_user + i, 'user{}'.format(i), rng.choice(groups),
+               'user{}@example.com'.format(i)) for i in range(users)])
+    user_ids = range(first_user, first_user + users)
+    
+    projects = []
+    first_project = db.execute("SELECT max(id) FROM project").fetchone()[0] + 1
+    for user_id in user_ids:
+        for i in range(projects_per_user):
+            projects.append((first_project + len(projects), user_id,
+                             'Project {}'.format(len(projects)),
+                             rng.choice((1, 2, 2, 2))))
+    db.executemany("""
+        INSERT INTO project (id, user_id, description, notes, status_id)
+        VALUES (?, ?, ?, '', ?)
+        """, projects)
+    
+    items = {}
+    phases = []
+    first_item = db.execute("SELECT max(id) FROM action_item").fetchone()[0] + 1
+    next_phase = (db.execute("SELECT max(id) FROM phase").fetchone()[0] or 0) + 1
+    for project in projects:
+        items[project[0]] = []
+        for i in range(items_per_project):
+            items[project[0]].append(
+                (first_item, 'Item {}'.format(first_item), project[0],
+                 rng.choice(rates), rng.choice(types)))
+            first_item += 1
+        for number in range(1, phases_per_project + 1):
+            phases.append((next_phase, project[0], number))
+            next_phase += 1
+    db.executemany("""
+        INSERT INTO action_item (id, name, project_id, rate_id, type_id)
+        VALUES (?, ?, ?, ?, ?)
+        """, [item for project_items in items.values() 
+              for item in project_items])
+    db.executemany("""
+        INSERT INTO phase (id, project_id, number)
+        VALUES (?, ?, ?)
+        """, phases)
+    
+    per_phase = max(1, records // len(phases))
+    span = days * 86400 // per_phase
+    
+    def time_records():
+        made = 0
+        for phase_id, project_id, number in phases:
+            clock = EPOCH + rng.randint(0, span)
+            for i in range(per_phase):
+                if made == records:
+                    return
+                start = clock + rng.randint(0, 2 * span)
+                stop = start + rng.randint(5, 240) * 60
+                clock = stop
+                item = rng.choice(items[project_id])
+                made += 1
+                yield (item[0], project_id, phase_id, 
+                       start, stop, stop - start)
+    
+    db.executemany("""
+        INSERT INTO time_record (action_item_id, project_id, phase_id, 
+                                 start, stop, duration)
+        VALUES (?, ?, ?, ?, ?, ?)
+        """, time_records())
+    db.commit()
+    counts = dict(
+        (table, db.execute("SELECT count(*) FROM " + table).fetchone()[0])
+        for table in ('user', 'project', 'phase', 'action_item', 'time_record'))
+    db.close()
+    return counts
+
+def build_app_database(path, **kwargs):
+    """Builds the database and points the Flask app at it, running
+    init_db() so the running totals are filled in.
+    """
+    import main
+    counts = build(path, **kwargs)
+    main.app.config['DATABASE'] = path
+    with main.app.app_context():
+        main.init_db()
+    return counts
+
+if __name__ == '__main__':
+    print(build(sys.argv[1], 
+                records=int(sys.argv[2]) if len(sys.argv) > 2 else 100000))
@@ -0,0 +1,239 @@
+import csv
+import json
+from collections import OrderedDict
+from itertools import groupby
+from StringIO import StringIO
+
+import archival
+
+ACTIONS = ('create', 'update', 'archive', 'retrieve')
+
+# the columns of a CSV batch. blank cells are left out, so an update
+# keeps what was there, and each kind only reads the fields it has
+CSV_COLUMNS = ('kind', 'action', 'id', 'description', 'fee_per_hour',
+               'name', 'email', 'usergroup_id')
+
+class BulkError(ValueError):
+    """Raised for a batch that can't be applied. The message is meant
+    to be shown to the user.
+    """
+
+class Kind(object):
+    """A table the bulk endpoint can change.
+
+    fields maps each field a create sets to its type, and to its 
+    default if it can be left out (REQUIRED if it can't). create and
+    update are constant statements taking the fields, and id for
+    update, as named parameters. An update only changes the fields an
+    operation gives, it takes each field with a set_<field> flag and
+    leaves the column as it was when that's 0.
+    """
+
+    def __init__(self, table, fields, create, update):
+        self.table = table
+        self.fields = fields
+        self.create = create
+        self.update = update
+
+REQUIRED = object()
+
+KINDS = OrderedDict([
+    ('rate', Kind(
+        'item_rate',
+        OrderedDict([('description', (unicode, None)),
+                     ('fee_per_hour', (float, 0))]),
+        """
+        INSERT INTO item_rate (id,
+                               description,
+                               fee_per_hour)
+        VALUES  (null,
+                :description,
+                :fee_per_hour)
+        """,
+        """
+        UPDATE  item_rate
+        SET     description = CASE WHEN :set_description
+                                   THEN :description
+                                   ELSE description END,
+                fee_per_hour = CASE WHEN :set_fee_per_hour
+                                    THEN :fee_per_hour
+                                    ELSE fee_per_hour END
+        WHERE   id = :id
+        """)),
+    ('type', Kind(
+        'item_type',
+        OrderedDict([('description', (unicode, None))]),
+        """
+        INSERT INTO item_type (id,
+                               description)
+        VALUES  (null,
+                :description)
+        """,
+        """
+        UPDATE  item_type
+        SET     description = CASE WHEN :set_description
+                                   THEN :description
+                                   ELSE description END
+        WHERE   id = :id
+        """)),
+    # new users get a random password, see apply()
+    ('user', Kind(
+        'user',
+        OrderedDict([('name', (unicode, REQUIRED)),
+                     ('email', (unicode, REQUIRED)),
+                     ('usergroup_id', (int, REQUIRED))]),
+        """
+        INSERT INTO user   (id,
+                            name,
+                            email,
+                            password,
+                            usergroup_id)
+        VALUES  (null,
+                :name,
+                :email,
+                :password,
+                :usergroup_id)
+        """,
+        """
+        UPDATE  user
+        SET     name = CASE WHEN :set_name
+                            THEN :name
+                            ELSE name END,
+                email = CASE WHEN :set_email
+                             THEN :email
+                             ELSE email END,
+                usergroup_id = CASE WHEN :set_usergroup_id
+                                    THEN :usergroup_id
+                                    ELSE usergroup_id END
+        WHERE   id = :id
+        """)),
+])
+
+class BulkResult(object):
+    """What a batch changed.
+
+    counts      (kind, action) -> how many rows, in the order first seen
+    tables      the tables written to
+    user_ids    ids of the existing users changed
+    new_users   (email, name, password) of each user created
+    """
+
+    def __init__(self):
+        self.counts = OrderedDict()
+        self.tables = set()
+        self.user_ids = set()
+        self.new_users = []
+
+    def __len__(self):
+        return sum(self.counts.values())
+
+    def __str__(self):
+        return "{} changes: {}".format(len(self), ', '.join(
+            "{} {} {}".format(count, kind, action)
+            for (kind, action), count in self.counts.items()))
+
+def parse_json(text):
+    """Reads a batch from a JSON list of operations, or an object with
+    the list under "operations".
+    """
+    try:
+        batch = json.loads(text)
+    except ValueError as e:
+        raise BulkError("Not valid JSON: {}".format(e))
+    if isinstance(batch, dict):
+        batch = batch.get('operations')
+    if not isinstance(batch, list):
+        raise BulkError("Expected a list of operations.")
+    return [parse_operation(number, operation)
+            for number, operation in enumerate(batch, 1)]
+
+def parse_csv(text):
+    """Reads a batch from CSV with a header row naming some of
+    CSV_COLUMNS, including kind and action.
+    """
+    reader = csv.DictReader(StringIO(text))
+    columns = set(reader.fieldnames or ())
+    if not set(['kind', 'action']) <= columns:
+        raise BulkError("The CSV header needs a kind and action column.")
+    unknown = columns - set(CSV_COLUMNS)
+    if unknown:
+        raise BulkError("Unknown CSV columns: {}. Use {}.".format(
+            ', '.join(sorted(unknown)), ', '.join(CSV_COLUMNS)))
+    return [parse_operation(number, dict(
+                (key, value.decode('utf-8'))
+                for key, value in row.items() if key and value))
+            for number, row in enumerate(reader, 1)]
+
+def parse_operation(number, operation):
+    """Checks one operation and converts its fields. Returns
+    (kind, action, params).
+    """
+    def fail(message):
+        raise BulkError("Operation {}: {}".format(number, message))
+    if not isinstance(operation, dict):
+        fail("expected an object.")
+    name = operation.get('kind')
+    kind = KINDS.get(name) if isinstance(name, basestring) else None
+    if kind is None:
+        fail("kind must be one of {}.".format(', '.join(KINDS)))
+    action = operation.get('action')
+    if not isinstance(action, basestring) or action not in ACTIONS:
+        fail("action must be one of {}.".format(', '.join(ACTIONS)))
+    params = {}
+    if action != 'create':
+        try:
+            params['id'] = int(operation['id'])
+        except (KeyError, TypeError, ValueError):
+            fail("id must be a number.")
+    if action in ('create', 'update'):
+        for field, (convert, default) in kind.fields.items():
+            value = operation.get(field)
+            if action == 'update':
+                params['set_' + field] = field in operation
+                if field not in operation:
+                    params[field] = None
+                    continue
+            if value in (None, ''):
+                if default is REQUIRED:
+                    fail("{} is required.".format(field))
+                params[field] = default
+                continue
+            try:
+                params[field] = convert(value)
+            except (TypeError, ValueError):
+                fail("{} was not a valid {}.".format(field, convert.__name__))
+    return name, action, params
+
+def apply(db, operations, new_password):
+    """Applies the operations from parse_json() or parse_csv().
+
+    Each run of operations with the same kind and action goes to the
+    db as one statement, in the order given: an executemany for
+    creates and updates, archival.set_archived() for the rest.
+    new_password() is called for each user created. Does not commit,
+    the caller commits once for the whole batch, along with queueing
+    the new users' password mail.
+    """
+    result = BulkResult()
+    for (name, action), run in groupby(operations, lambda op: op[:2]):
+        kind = KINDS[name]
+        rows = [op[2] for op in run]
+        if action == 'create':
+            if kind.table == 'user':
+                for row in rows:
+                    row['password'] = new_password()
+                    result.new_users.append(
+                        (row['email'], row['name'], row['password']))
+            db.executemany(kind.create, rows)
+        elif action == 'update':
+            db.executemany(kind.update, rows)
+        else:
+            archival.set_archived(db, kind.table, 
+                                  [row['id'] for row in rows],
+                                  archived=action == 'archive')
+        if kind.table == 'user' and action != 'create':
+            result.user_ids.update(row['id'] for row in rows)
+        result.tables.add(kind.table)
+        result.counts[name, action] = (
+            result.counts.get((name, action), 0) + len(rows))
+    return result
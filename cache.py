@@ -0,0 +1,96 @@
+import threading
+import time
+from collections import OrderedDict
+
+class TTLCache(object):
+    """A small thread-safe LRU cache for this process.
+
+    Holds at most maxsize entries, dropping the least recently used
+    one when full. If ttl is given, entries older than ttl seconds
+    are treated as missing, which bounds how stale a value can get
+    when another process changes the database behind our back.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                stored, value = self._data.pop(key)
+            except KeyError:
+                return default
+            if self.ttl is not None and time.time() - stored > self.ttl:
+                return default
+            # re-inserting moves the key to the most recently used end
+            self._data[key] = (stored, value)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time(), value)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            stored, value = self._data.pop(key, (None, default))
+            return value
+
+    def evict(self, matches):
+        """Drops every entry whose value matches(value) is true."""
+        with self._lock:
+            for key, (stored, value) in list(self._data.items()):
+                if matches(value):
+                    del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+class FragmentCache(object):
+    """Caches rendered fragments, or query results, by the tables they
+    were built from.
+
+    Every table has a generation counter. Anything cached is stored
+    under the current generations of its tables, so bump()ing a table
+    after writing to it means everything built from the old data is
+    never looked up again, and ages out of the LRU.
+
+    The counters only live in this process; ttl bounds how long
+    another process's writes can go unseen.
+    """
+
+    def __init__(self, maxsize=256, ttl=None):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def generation(self, table):
+        return self._generations.get(table, 0)
+
+    def bump(self, *tables):
+        with self._lock:
+            for table in tables:
+                self._generations[table] = self.generation(table) + 1
+
+    def get_or_render(self, name, tables, render, *key):
+        """Returns the cached value for name and key, calling render()
+        to build it if the tables have changed since it was cached.
+        """
+        key = (name,) + key + tuple(self.generation(t) for t in tables)
+        value = self._cache.get(key)
+        if value is None:
+            value = render()
+            self._cache.set(key, value)
+        return value
+
+    def clear(self):
+        self._cache.clear()
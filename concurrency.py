@@ -0,0 +1,49 @@
+"""WSGI middleware limiting how much of the app runs at once.
+
+Only max_requests requests run the app at the same time; the rest
+wait their turn, so a burst queues up instead of piling onto SQLite
+together. Event streams spend nearly all their time idle, so they're
+counted apart from requests, against max_streams, and don't hold up
+anyone else. Past that limit a stream is refused with a 503, and the
+browser tries again later.
+
+Whatever serves the app wraps it, like main.py does for app.run():
+
+    app.wsgi_app = ConcurrencyLimit(app.wsgi_app, ...)
+"""
+import threading
+
+from werkzeug.wsgi import ClosingIterator
+
+class ConcurrencyLimit(object):
+    """WSGI middleware letting at most max_requests requests, and
+    max_streams of the responses at stream_paths, run at once.
+
+    A slot is held until the response has been sent, not just until
+    the view returns, since exports and streams keep working while
+    they're being sent.
+    """
+
+    def __init__(self, app, max_requests, max_streams, stream_paths):
+        self.app = app
+        self.stream_paths = stream_paths
+        self.requests = threading.Semaphore(max_requests)
+        self.streams = threading.Semaphore(max_streams)
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO') in self.stream_paths:
+            if not self.streams.acquire(False):
+                start_response('503 Service Unavailable',
+                               [('Content-Type', 'text/plain'),
+                                ('Retry-After', '30')])
+                return ["Too many open streams."]
+            release = self.streams.release
+        else:
+            self.requests.acquire()
+            release = self.requests.release
+        try:
+            app_iter = self.app(environ, start_response)
+        except:
+            release()
+            raise
+        return ClosingIterator(app_iter, release)
@@ -0,0 +1,80 @@
+import sqlite3
+import threading
+import time
+import Queue
+
+class ConnectionPool(object):
+    """Keeps open sqlite3 connections around between requests.
+
+    connect is called to open a new connection whenever the pool is
+    empty. Connections that have been open longer than recycle
+    seconds, or that fail a quick health check, are thrown away
+    instead of being handed out again. At most size idle connections
+    are kept; anything returned beyond that is closed.
+    """
+
+    def __init__(self, connect, size=5, recycle=3600):
+        self.connect = connect
+        self.size = size
+        self.recycle = recycle
+        self._idle = Queue.LifoQueue()
+        self._opened = {}
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Returns a healthy connection, opening one if needed."""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except Queue.Empty:
+                break
+            if self._is_usable(conn):
+                return conn
+            self._discard(conn)
+        conn = self.connect()
+        with self._lock:
+            self._opened[id(conn)] = time.time()
+        return conn
+
+    def put(self, conn):
+        """Gives a connection back to the pool.
+
+        Anything the request left uncommitted is rolled back so the
+        next request starts clean.
+        """
+        try:
+            conn.rollback()
+        except sqlite3.Error:
+            self._discard(conn)
+            return
+        if self._idle.qsize() >= self.size:
+            self._discard(conn)
+        else:
+            self._idle.put(conn)
+
+    def close_all(self):
+        """Closes every idle connection, e.g. before deleting the db."""
+        while True:
+            try:
+                self._discard(self._idle.get_nowait())
+            except Queue.Empty:
+                return
+
+    def _is_usable(self, conn):
+        with self._lock:
+            opened = self._opened.get(id(conn), 0)
+        if time.time() - opened > self.recycle:
+            return False
+        try:
+            conn.execute("SELECT 1").fetchone()
+        except sqlite3.Error:
+            return False
+        return True
+
+    def _discard(self, conn):
+        with self._lock:
+            self._opened.pop(id(conn), None)
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
@@ -0,0 +1,100 @@
+import json
+import threading
+import time
+import Queue
+
+# sent to every subscriber now and then, so proxies keep the
+# connection open and a client that went away is noticed on write
+KEEPALIVE = ": keepalive\n\n"
+
+def format_event(event, data):
+    """Formats one Server-Sent Event with a JSON payload."""
+    return "event: {}\ndata: {}\n\n".format(event, json.dumps(data))
+
+class Subscription(object):
+    """One client's stream of events from an EventBus.
+
+    Iterating blocks until the next event arrives. The wait has no
+    timeout, since in Python 2 a timed wait polls, and an idle client
+    should cost nothing; the bus's keepalive wakes it instead. If the
+    client falls more than maxsize events behind, the stream ends and
+    the browser reconnects, picking up the current state again.
+    """
+
+    def __init__(self, bus, user_id, maxsize):
+        self.bus = bus
+        self.user_id = user_id
+        self.queue = Queue.Queue(maxsize)
+        self.overflowed = False
+
+    def put(self, message):
+        try:
+            self.queue.put_nowait(message)
+        except Queue.Full:
+            self.overflowed = True
+
+    def __iter__(self):
+        while not self.overflowed:
+            yield self.queue.get()
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+class EventBus(object):
+    """In-process publish/subscribe of events per user.
+
+    Only this process's subscribers hear what's published here, so
+    every worker process that streams events has to be the one that
+    publishes them too.
+    """
+
+    def __init__(self, keepalive=15, maxsize=100):
+        self.keepalive = keepalive
+        self.maxsize = maxsize
+        self._subscribers = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def subscribe(self, user_id):
+        subscription = Subscription(self, user_id, self.maxsize)
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add(subscription)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._send_keepalives,
+                                                name='event-keepalive')
+                self._thread.daemon = True
+                self._thread.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscribers.get(subscription.user_id, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self._subscribers.pop(subscription.user_id, None)
+
+    def publish(self, user_id, event, data):
+        """Sends the event to each of the user's subscribers. Never
+        blocks; see Subscription for what happens to slow ones.
+        """
+        message = format_event(event, data)
+        with self._lock:
+            subscriptions = list(self._subscribers.get(user_id, ()))
+        for subscription in subscriptions:
+            subscription.put(message)
+
+    def _send_keepalives(self):
+        """One thread wakes every subscriber, instead of each of
+        them waking itself.
+        """
+        while True:
+            time.sleep(self.keepalive)
+            with self._lock:
+                subscriptions = [s for subs in self._subscribers.values()
+                                   for s in subs]
+            for subscription in subscriptions:
+                subscription.put(KEEPALIVE)
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(subs) for subs in self._subscribers.values())
@@ -0,0 +1,68 @@
+import csv
+import json
+import StringIO
+from collections import OrderedDict
+
+# rows are read from the cursor and written out this many at a time,
+# so memory use stays flat however many rows are exported
+BATCH_SIZE = 500
+
+FORMATS = OrderedDict([
+    ('csv', 'text/csv'),
+    ('ndjson', 'application/x-ndjson'),
+])
+
+class ExportError(ValueError):
+    """Raised for an unknown export format. The message is meant to
+    be shown to the user.
+    """
+
+def get_mimetype(fmt):
+    try:
+        return FORMATS[fmt]
+    except KeyError:
+        raise ExportError("Unknown export format: {}. Use {}.".format(
+            fmt, ' or '.join(FORMATS)))
+
+def iter_export(fmt, columns, execute):
+    """Yields the export as chunks of text.
+
+    columns are the keys to pull from each row, in order. execute is
+    called to run the query and return the cursor. It isn't called
+    until the first chunk is asked for, so a response can start
+    before a slow query has produced anything.
+    """
+    if fmt == 'csv':
+        return iter_csv(columns, execute)
+    return iter_ndjson(columns, execute)
+
+def iter_batches(cursor):
+    while True:
+        rows = cursor.fetchmany(BATCH_SIZE)
+        if not rows:
+            return
+        yield rows
+
+def encode(value):
+    # the python 2 csv module only writes byte strings
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+def iter_csv(columns, execute):
+    buf = StringIO.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(columns)
+    yield buf.getvalue()
+    for rows in iter_batches(execute()):
+        buf.seek(0)
+        buf.truncate()
+        writer.writerows([encode(row[key]) for key in columns] 
+                         for row in rows)
+        yield buf.getvalue()
+
+def iter_ndjson(columns, execute):
+    for rows in iter_batches(execute()):
+        yield ''.join(
+            json.dumps(OrderedDict((key, row[key]) for key in columns)) + '\n'
+            for row in rows)
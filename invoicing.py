@@ -0,0 +1,345 @@
+import json
+import multiprocessing
+import os
+import time
+import zipfile
+from cStringIO import StringIO
+from itertools import groupby
+from operator import itemgetter
+
+from jinja2 import Environment, FileSystemLoader
+
+TEMPLATES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'templates')
+
+# the same settings Flask uses for .html templates, so an invoice
+# rendered here matches one rendered by get_bill_for_phase()
+env = Environment(loader=FileSystemLoader(TEMPLATES), autoescape=True)
+
+# the render processes, see start_pool(). until it's called invoices
+# are rendered in the calling thread
+pool = None
+pool_size = 1
+
+class BatchStats(object):
+    """How long each step of a batch took, in seconds."""
+
+    def __init__(self):
+        self.invoices = 0
+        self.lines = 0
+        self.processes = 1
+        self.query = 0.0
+        self.render = 0.0
+        self.bundle = 0.0
+
+    @property
+    def total(self):
+        return self.query + self.render + self.bundle
+
+    @property
+    def per_second(self):
+        return self.invoices / self.total if self.total else 0.0
+
+    def __str__(self):
+        return ("{} invoices ({} lines) in {:.2f}s, {:.1f} invoices/s. "
+                "query {:.2f}s, render {:.2f}s on {} processes, "
+                "bundle {:.2f}s").format(
+                    self.invoices, self.lines, self.total, self.per_second,
+                    self.query, self.render, self.processes, self.bundle)
+
+def get_phases_in_range(db, start, end):
+    """Returns the ids of the phases with time recorded between start
+    and end, both epoch seconds.
+    """
+    return [row[0] for row in db.execute("""
+        SELECT  DISTINCT phase_id
+        FROM    time_record
+        WHERE   start >= ?
+                AND start < ?
+                AND duration IS NOT NULL
+        """, [start, end])]
+
+# every invoice's line items for a list of phases in one statement.
+# with :per_phase each phase is its own invoice, otherwise the phases
+# are one invoice together. line items are grouped per action item,
+# and each carries its invoice's office details; an invoice without
+# any time recorded is one row of office details alone. the type,
+# rate and grand totals are added up from the lines by make_invoice(),
+# which takes the first eight columns, as PHASE_LINES_SQL has them
+INVOICE_SQL = """
+    WITH    phases AS (
+                SELECT  phase.id,
+                        phase.number,
+                        phase.project_id,
+                        CASE WHEN :per_phase THEN phase.id ELSE 0 END AS invoice_id
+                FROM    phase
+                WHERE   phase.id IN (
+                            SELECT  value
+                            FROM    json_each(:phase_ids)
+                        )
+            ),
+            offices AS (
+                SELECT  phases.invoice_id,
+                        min(phases.id) AS phase_id,
+                        min(phases.number) AS phase_number,
+                        min(project.id) AS project_id,
+                        group_concat(DISTINCT project.office_serial) AS serial,
+                        group_concat(DISTINCT project.tt_number) AS tt_number
+                FROM    phases,
+                        project
+                WHERE   project.id = phases.project_id
+                GROUP BY    phases.invoice_id
+            ),
+            lines AS (
+                SELECT  a.invoice_id,
+                        action_item.id AS action_item_id,
+                        action_item.name,
+                        action_item.type_id,
+                        (SELECT description
+                        FROM    item_type
+                        WHERE   item_type.id = action_item.type_id) AS type,
+                        item_rate.id AS rate_id,
+                        item_rate.description AS rate,
+                        date(a.start, 'unixepoch') AS date,
+                        a.duration / 60.0 AS time_total,
+                        (item_rate.fee_per_hour / 60.0)
+                          * a.duration / 60.0 AS money_total
+                FROM    (SELECT phases.invoice_id,
+                                time_record.action_item_id,
+                                min(time_record.start) AS start,
+                                sum(time_record.duration) AS duration
+                        FROM    phases,
+                                time_record
+                        WHERE   time_record.phase_id = phases.id
+                                AND time_record.duration IS NOT NULL
+                        GROUP BY    phases.invoice_id,
+                                    time_record.action_item_id
+                        ) AS a,
+                        action_item,
+                        item_rate
+                WHERE   action_item.id = a.action_item_id
+                        AND item_rate.id = action_item.rate_id
+            )
+    SELECT  lines.name,
+            lines.type_id,
+            lines.type,
+            lines.rate_id,
+            lines.rate,
+            lines.date,
+            lines.time_total,
+            lines.money_total,
+            lines.action_item_id,
+            offices.*
+    FROM    offices
+            LEFT JOIN lines
+                ON  lines.invoice_id = offices.invoice_id
+    ORDER BY    offices.invoice_id,
+                lines.action_item_id
+"""
+
+# a single phase's invoice, as the old per phase queries had it: its
+# line items, and its office details. one key lookup each, which is
+# cheaper than INVOICE_SQL's grouping for one phase
+PHASE_LINES_SQL = """
+    SELECT  action_item.name,
+            action_item.type_id,
+            (SELECT description
+            FROM    item_type
+            WHERE   item_type.id = action_item.type_id) AS type,
+            item_rate.id,
+            item_rate.description,
+            date(a.start, 'unixepoch'),
+            a.duration / 60.0,
+            (item_rate.fee_per_hour / 60.0) * a.duration / 60.0
+    FROM    (SELECT action_item_id,
+                    min(start) AS start,
+                    sum(duration) AS duration
+            FROM    time_record
+            WHERE   phase_id = ?
+                    AND duration IS NOT NULL
+            GROUP BY    action_item_id
+            ) AS a,
+            action_item,
+            item_rate
+    WHERE   action_item.id = a.action_item_id
+            AND item_rate.id = action_item.rate_id
+"""
+
+PHASE_OFFICE_SQL = """
+    SELECT  phase.id AS phase_id,
+            phase.number AS phase_number,
+            project.id AS project_id,
+            project.office_serial AS serial,
+            project.tt_number
+    FROM    phase,
+            project
+    WHERE   phase.id = ?
+            AND project.id = phase.project_id
+"""
+
+# the columns of offices in INVOICE_SQL, after invoice_id
+OFFICE_COLUMNS = ('phase_id', 'phase_number', 'project_id', 'serial', 
+                  'tt_number')
+
+def get_invoices(db, phase_ids, per_phase=True):
+    """Returns the invoices for the phases, in project and phase
+    order, as dicts of
+
+        phase_id, project_id, phase_number
+        office          {serial, tt_number}
+        invoice         line items, one per action item
+        type_totals     {type, time_total, money_total} per item type
+        rate_totals     {rate, time_total, money_total} per rate
+        grand_totals    {time, money}
+
+    With per_phase=False all the phases go on one invoice, and
+    phase_id, project_id and phase_number are those of the first
+    phase. Its office details list every project's, comma separated.
+    """
+    phase_ids = [int(p) for p in phase_ids]
+    # plain tuples, which make_invoice() unpacks by position
+    cursor = db.cursor()
+    cursor.row_factory = None
+    if len(phase_ids) == 1:
+        office = db.execute(PHASE_OFFICE_SQL, phase_ids).fetchone()
+        if office is None:
+            return []
+        return [make_invoice(office, 
+                             cursor.execute(PHASE_LINES_SQL, phase_ids))]
+    rows = cursor.execute(INVOICE_SQL, {
+        "phase_ids": json.dumps(phase_ids),
+        "per_phase": per_phase
+    })
+    invoices = []
+    for invoice_id, group in groupby(rows, itemgetter(9)):
+        group = list(group)
+        office = dict(zip(OFFICE_COLUMNS, group[0][10:]))
+        invoices.append(make_invoice(office, (
+            row[:8] for row in group if row[8] is not None)))
+    invoices.sort(key=lambda i: (i['project_id'], i['phase_number']))
+    return invoices
+
+def make_invoice(office, lines):
+    """Returns one of get_invoices()' invoices, from a mapping of the
+    office details and (name, type_id, type, rate_id, rate, date,
+    time_total, money_total) per line item.
+    """
+    invoice = []
+    type_totals = {}
+    rate_totals = {}
+    for (name, type_id, item_type, rate_id, rate, date, 
+         time_total, money_total) in lines:
+        invoice.append({"name": name,
+                        "type": item_type,
+                        "rate": rate,
+                        "date": date,
+                        "time_total": time_total,
+                        "money_total": money_total})
+        add_subtotal(type_totals, type_id, 'type', item_type, 
+                     time_total, money_total)
+        add_subtotal(rate_totals, rate_id, 'rate', rate, 
+                     time_total, money_total)
+    return {
+        "phase_id": office['phase_id'],
+        "project_id": office['project_id'],
+        "phase_number": office['phase_number'],
+        "office": {"serial": office['serial'],
+                   "tt_number": office['tt_number']},
+        "invoice": invoice,
+        "type_totals": sorted(type_totals.values(), key=itemgetter('type')),
+        "rate_totals": sorted(rate_totals.values(), key=itemgetter('rate')),
+        "grand_totals": {"time": sum(l['time_total'] for l in invoice),
+                         "money": sum(l['money_total'] for l in invoice)}
+    }
+
+def add_subtotal(totals, key, name, description, time_total, money_total):
+    """Adds a line item to totals' subtotal for key, its type or rate."""
+    total = totals.get(key)
+    if total is None:
+        totals[key] = {name: description,
+                       "time_total": time_total,
+                       "money_total": money_total}
+    else:
+        total['time_total'] += time_total
+        total['money_total'] += money_total
+
+def get_invoice(db, phase_ids):
+    """Returns one invoice covering all the phases, see
+    get_invoices().
+    """
+    invoices = get_invoices(db, phase_ids, per_phase=False)
+    return invoices[0] if invoices else None
+
+def get_filename(invoice):
+    return "invoice-{project_id}-{phase_number}.html".format(**invoice)
+
+def render_invoice(invoice):
+    """Renders invoice.html for one of get_invoices()' invoices.
+    Returns (filename, html as utf-8).
+    """
+    html = env.get_template('invoice.html').render(**invoice)
+    return get_filename(invoice), html.encode('utf-8')
+
+def start_pool(processes=None):
+    """Starts the processes render_invoices() uses, one per CPU by
+    default. Call it once at startup, before any thread is started:
+    forking while another thread holds a lock (the mail worker's, the
+    connection pool's, logging's) leaves the child stuck on it.
+    """
+    global pool, pool_size
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if pool is None and processes > 1:
+        pool = multiprocessing.Pool(processes)
+        pool_size = processes
+
+def stop_pool():
+    global pool, pool_size
+    if pool is not None:
+        pool.close()
+        pool.join()
+    pool = None
+    pool_size = 1
+
+def render_invoices(invoices):
+    """Renders the invoices across the processes of start_pool(), or
+    in this thread if there are none. Returns a list of (filename, 
+    html) in the same order.
+    """
+    if pool is None or len(invoices) < 2:
+        return [render_invoice(invoice) for invoice in invoices]
+    chunksize = max(1, len(invoices) // (pool_size * 4))
+    return pool.map(render_invoice, invoices, chunksize)
+
+def bundle_zip(rendered):
+    """Returns a zip archive of the rendered invoices."""
+    buf = StringIO()
+    archive = zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED)
+    for filename, html in rendered:
+        archive.writestr(filename, html)
+    archive.close()
+    return buf.getvalue()
+
+def run_batch(db, phase_ids, bundle=bundle_zip):
+    """Builds, renders and bundles the invoices for the phases.
+
+    bundle is called with the list of (filename, html), e.g.
+    bundle_zip or mailer.build_invoice_batch. Returns (what bundle
+    returned, stats).
+    """
+    stats = BatchStats()
+    started = time.time()
+    invoices = get_invoices(db, phase_ids)
+    stats.query = time.time() - started
+    stats.invoices = len(invoices)
+    stats.lines = sum(len(invoice['invoice']) for invoice in invoices)
+
+    started = time.time()
+    rendered = render_invoices(invoices)
+    stats.render = time.time() - started
+    stats.processes = pool_size if pool is not None else 1
+
+    started = time.time()
+    result = bundle(rendered)
+    stats.bundle = time.time() - started
+    return result, stats
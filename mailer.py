@@ -1,12 +1,18 @@
+import json
+import logging
 import smtplib
+import threading
 
 from email.mime.multipart import MIMEMultipart
 from email.message import Message
 from email.MIMEBase import MIMEBase
 from email.mime.text import MIMEText
 
-def email_invoice(user_email, invoice, cc_email=None):
-    """Sends email with the invoice as attachment.
+log = logging.getLogger(__name__)
+
+def build_invoice(user_email, invoice, cc_email=None):
+    """Returns (sender, recipients, message) for an invoice email,
+    with the invoice as attachment.
     
     The default for this will eventually be 
         FROM: invoice@stopwatch.com
@@ -29,7 +35,7 @@ def email_invoice(user_email, invoice, cc_email=None):
         msg['Cc'] = cc_email
         recips = [you, cc_email]
     else:
-        recips = you
+        recips = [you]
     
     text = Message()
     
@@ -50,12 +56,42 @@ def email_invoice(user_email, invoice, cc_email=None):
                     )
     msg.attach(the_invoice)
     
-    s = smtplib.SMTP('smtp.macpractice.com')
-    s.sendmail(me, recips, msg.as_string())
-    s.quit()
+    return me, recips, msg.as_string()
     
-def email_new_password(user_email, username, password):
-    """Informs the user that their password has been changed.
+def build_invoice_batch(user_email, rendered):
+    """Returns (sender, recipients, message) for one email with a
+    batch of invoices attached, rendered being a list of
+    (filename, html) from invoicing.run_batch().
+    """
+    me = "invoice@stopwatch.com"
+    you = user_email
+    
+    msg = MIMEMultipart()
+    msg['Subject'] = "Invoices ({})".format(len(rendered))
+    msg['From'] = me
+    msg['To'] = you
+    
+    text = Message()
+    text.set_payload("""
+    Attached are {} invoices from the Stopwatch Invoice System.
+    """.format(len(rendered)))
+    msg.attach(text)
+    
+    for filename, html in rendered:
+        attachment = MIMEBase('application', 'octet-stream')
+        attachment.set_payload(html)
+        attachment.add_header(
+                            'Content-Disposition', 
+                            'attachment', 
+                            filename=filename
+                        )
+        msg.attach(attachment)
+    
+    return me, [you], msg.as_string()
+    
+def build_new_password(user_email, username, password):
+    """Returns (sender, recipients, message) for an email informing 
+    the user that their password has been changed.
     
     At present (07/19/17) this is just called when a user is created
     or when an admin presses "Reset Password" in the Admin tab.
@@ -86,6 +122,167 @@ def email_new_password(user_email, username, password):
     
     msg.attach(text)
     
-    s = smtplib.SMTP('smtp.macpractice.com')
-    s.sendmail(me, you, msg.as_string())
-    s.quit()
\ No newline at end of file
+    return me, [you], msg.as_string()
+    
+def queue_mail(db, sender, recipients, message):
+    """Adds a message to the outbox for OutboxWorker to send.
+    
+    Does not commit, so the mail only goes out if whatever the caller
+    is doing (like changing the password it contains) is committed too.
+    Call OutboxWorker.wake() after committing to send it right away.
+    """
+    queue_mails(db, [(sender, recipients, message)])
+    
+def queue_mails(db, mails):
+    """Adds many (sender, recipients, message) to the outbox in one
+    executemany. See queue_mail().
+    """
+    db.executemany("""
+        INSERT INTO outbox (sender,
+                            recipients,
+                            message,
+                            next_attempt,
+                            created)
+        VALUES  (?,
+                ?,
+                ?,
+                datetime('now'),
+                datetime('now'))
+        """, [(sender, json.dumps(recipients), message) 
+              for sender, recipients, message in mails])
+    
+def queue_invoice(db, user_email, invoice, cc_email=None):
+    queue_mail(db, *build_invoice(user_email, invoice, cc_email))
+    
+def queue_new_password(db, user_email, username, password):
+    queue_mail(db, *build_new_password(user_email, username, password))
+    
+def queue_new_passwords(db, users):
+    """Queues the new password email for each (user_email, username,
+    password). The worker sends them batch_size at a time over one
+    SMTP connection.
+    """
+    queue_mails(db, [build_new_password(*user) for user in users])
+    
+class OutboxWorker(threading.Thread):
+    """Background thread that sends the mail in the outbox.
+    
+    Due messages are sent in batches of batch_size over a single SMTP
+    connection, which is kept open until the outbox is empty. A message
+    that fails, for whatever reason, is retried after retry_delay 
+    seconds, doubling each time, and is marked 'dead' after 
+    max_attempts tries.
+    
+    connect should return a new sqlite3 connection; the worker keeps
+    its own. smtp is called with the host to open the SMTP connection,
+    tests can pass a fake smtplib.SMTP.
+    """
+    
+    def __init__(self, connect, host, batch_size=20, poll_interval=30,
+                 max_attempts=5, retry_delay=60, smtp=smtplib.SMTP):
+        super(OutboxWorker, self).__init__(name='outbox')
+        self.daemon = True
+        self.connect = connect
+        self.host = host
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.smtp = smtp
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        
+    def wake(self):
+        """Sends whatever is due now instead of at the next poll."""
+        self._wake.set()
+        
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        
+    def run(self):
+        db = self.connect()
+        try:
+            while not self._stop.is_set():
+                self._wake.clear()
+                try:
+                    self.drain(db)
+                except Exception:
+                    # the batch's updates would otherwise hold the
+                    # write lock until the next commit
+                    db.rollback()
+                    log.exception("Outbox worker failed, will retry")
+                self._wake.wait(self.poll_interval)
+        finally:
+            db.close()
+            
+    def drain(self, db):
+        """Sends every due message, returns how many were sent."""
+        server = None
+        sent = 0
+        try:
+            while True:
+                batch = db.execute("""
+                    SELECT  id,
+                            sender,
+                            recipients,
+                            message,
+                            attempts
+                    FROM    outbox
+                    WHERE   status = 'queued'
+                            AND next_attempt <= datetime('now')
+                    ORDER BY    id
+                    LIMIT   ?
+                    """, [self.batch_size]).fetchall()
+                if not batch:
+                    return sent
+                for row in batch:
+                    try:
+                        if server is None:
+                            server = self.smtp(self.host)
+                        server.sendmail(row[1], json.loads(row[2]), row[3])
+                    except Exception as e:
+                        self._failed(db, row, e)
+                        # the connection may be what broke
+                        server = self._close(server)
+                    else:
+                        db.execute("""
+                            UPDATE  outbox
+                            SET     status = 'sent',
+                                    sent = datetime('now'),
+                                    attempts = attempts + 1
+                            WHERE   id = ?
+                            """, [row[0]])
+                        sent += 1
+                db.commit()
+        finally:
+            self._close(server)
+            
+    def _failed(self, db, row, error):
+        attempts = row[4] + 1
+        if attempts >= self.max_attempts:
+            log.error("Giving up on outbox mail {}: {}".format(row[0], error))
+        db.execute("""
+            UPDATE  outbox
+            SET     attempts = :attempts,
+                    last_error = :error,
+                    status = CASE 
+                                WHEN :attempts >= :max_attempts THEN 'dead'
+                                ELSE 'queued'
+                             END,
+                    next_attempt = datetime('now', :delay)
+            WHERE   id = :id
+            """, {"id": row[0],
+                  "attempts": attempts,
+                  "error": str(error),
+                  "max_attempts": self.max_attempts,
+                  "delay": '+{} seconds'.format(
+                      self.retry_delay * 2 ** (attempts - 1))})
+    
+    def _close(self, server):
+        if server is not None:
+            try:
+                server.quit()
+            except (smtplib.SMTPException, IOError):
+                pass
+        return None
@@ -1,13 +1,33 @@
 import os
+import json
+import hashlib
 import sqlite3
 import datetime
+import threading
+import time
 from uuid import uuid4
 from flask import Flask, request, session, g, \
     redirect, url_for, abort, render_template, \
-    flash, Response
+    flash, Response, stream_with_context, Markup, jsonify, \
+    get_template_attribute
     
-from mailer import email_invoice, email_new_password
+from mailer import queue_mail, queue_invoice, queue_new_password, \
+    queue_new_passwords, build_invoice_batch, OutboxWorker
 from pw_utils import random_password
+from db_pool import ConnectionPool
+from reporting import REPORTS, ReportError, get_report, get_bounds, \
+    parse_range
+from export import ExportError, get_mimetype, iter_export
+import invoicing
+import bulk
+import archival
+from cache import TTLCache, FragmentCache
+from permissions import PermissionMap
+from timers import Timer, TimerRegistry
+from events import EventBus, format_event
+from aggregation import Contribution, Delta, TotalsWorker
+from concurrency import ConcurrencyLimit
+import schema
 
 app = Flask(__name__)
 app.config.from_object(__name__)
@@ -16,40 +36,196 @@ app.config.update({
     "DATABASE": os.path.join(app.root_path, 'stopwatch.db'),
     "SECRET_KEY": os.urandom(24),
     "USERNAME": 'admin',
-    "PASSWORD": 'default'
+    "PASSWORD": 'default',
+    # sqlite connection pool and pragmas, see connect_db()
+    "DB_POOL_SIZE": 5,
+    "DB_POOL_RECYCLE": 3600,
+    "DB_SYNCHRONOUS": 'NORMAL',
+    "DB_CACHE_SIZE": -8000,
+    "DB_MMAP_SIZE": 64 * 1024 * 1024,
+    "DB_BUSY_TIMEOUT": 5000,
+    "DB_STATEMENT_CACHE": 256,
+    # class of the connections made, benchmarks swap in one that
+    # counts queries
+    "DB_FACTORY": sqlite3.Connection,
+    # how many logged in sessions to remember, and for how many seconds
+    "SESSION_CACHE_SIZE": 1024,
+    "SESSION_CACHE_TTL": 60,
+    # how many phases, and how many records per phase, to send at once
+    "PHASE_PAGE_SIZE": 10,
+    "RECORD_PAGE_SIZE": 100,
+    # rendered fragments and lookup tables, see fragment_cache
+    "FRAGMENT_CACHE_SIZE": 256,
+    "FRAGMENT_CACHE_TTL": 300,
+    # outgoing mail, see get_mail_worker()
+    "MAIL_SERVER": 'smtp.macpractice.com',
+    "MAIL_BATCH_SIZE": 20,
+    "MAIL_POLL_INTERVAL": 30,
+    "MAIL_MAX_ATTEMPTS": 5,
+    "MAIL_RETRY_DELAY": 60,
+    # seconds before the totals worker retries a batch that failed
+    "TOTALS_RETRY_DELAY": 5,
+    # processes rendering batch invoices, None for one per CPU. they're
+    # started with the server, see invoicing.start_pool()
+    "INVOICE_PROCESSES": None,
+    # timer event streams: seconds between keepalives, and how many
+    # events a slow client may fall behind before it's dropped
+    "EVENT_KEEPALIVE": 15,
+    "EVENT_QUEUE_SIZE": 100,
+    # requests running the app at once, and open event streams, see
+    # concurrency.ConcurrencyLimit
+    "MAX_REQUESTS": 8,
+    "MAX_STREAMS": 1000
 })
 
+# the long lived responses, counted apart by ConcurrencyLimit
+STREAM_PATHS = frozenset(['/my_projects/timer_events'])
+
+# guards creating the connection pool and worker threads on first use
+pool_lock = threading.Lock()
+
+# session_id -> online user, see get_online_user()
+session_cache = TTLCache(maxsize=app.config['SESSION_CACHE_SIZE'],
+                         ttl=app.config['SESSION_CACHE_TTL'])
+
+# usergroup -> allowed endpoints, see get_permissions()
+permission_map = PermissionMap()
+
+# user_id -> running timer, see get_active_timer()
+active_timers = TimerRegistry()
+
+# timer starts and stops, pushed to each user's open event streams,
+# see timer_events()
+timer_bus = EventBus(keepalive=app.config['EVENT_KEEPALIVE'],
+                     maxsize=app.config['EVENT_QUEUE_SIZE'])
+
+# rates, types, statuses and the fragments rendered from them rarely
+# change, so they're kept here until a write bumps their table
+fragment_cache = FragmentCache(maxsize=app.config['FRAGMENT_CACHE_SIZE'],
+                               ttl=app.config['FRAGMENT_CACHE_TTL'])
+
 #
 #   Database connection functions
 #
 
 def connect_db():
-    rv = sqlite3.connect(app.config['DATABASE'])
+    """Opens a new connection. Only the pool should call this.
+    
+    The statement cache is sized to hold every query in this file
+    and reporting.py, so each is only prepared once per connection.
+    
+    WAL mode lets readers keep reading while start_timing and
+    stop_timing write, instead of queueing up behind them. With WAL,
+    synchronous=NORMAL is still safe against corruption, a power cut
+    can only lose the last few commits.
+    """
+    rv = sqlite3.connect(app.config['DATABASE'],
+                         timeout=app.config['DB_BUSY_TIMEOUT'] / 1000.0,
+                         cached_statements=app.config['DB_STATEMENT_CACHE'],
+                         check_same_thread=False,
+                         factory=app.config['DB_FACTORY'])
     rv.row_factory = sqlite3.Row
+    rv.execute("PRAGMA journal_mode = WAL")
+    for pragma in ('synchronous', 'cache_size', 'mmap_size', 'busy_timeout'):
+        rv.execute("PRAGMA {} = {}".format(
+            pragma, app.config['DB_' + pragma.upper()]))
     return rv
     
+def get_pool():
+    """Returns the connection pool, making it on first use so that
+    any config changes made before then are picked up.
+    """
+    with pool_lock:
+        pool = app.extensions.get('db_pool')
+        if pool is None:
+            pool = ConnectionPool(connect_db,
+                                  size=app.config['DB_POOL_SIZE'],
+                                  recycle=app.config['DB_POOL_RECYCLE'])
+            app.extensions['db_pool'] = pool
+    return pool
+    
 def get_db():
     """Used at the start of new queries"""
     if not hasattr(g, 'sqlite_db'):
-        g.sqlite_db = connect_db()
+        g.sqlite_db = get_pool().get()
     return g.sqlite_db
     
 def init_db():
-    """Creates a new db if none exists, otherwise
-    just inits current db
+    """Creates a new db if none exists, otherwise brings the
+    current db up to the latest schema version.
+    
+    See schema.py for how migrations are found and recorded.
     """
     db = get_db()
-    with app.open_resource('db.sql', mode='r') as f:
-        try:
-            db.cursor().executescript(f.read())
-        except sqlite3.OperationalError:
-            pass
+    for version in schema.migrate(db, app.root_path):
+        app.logger.info("Applied schema migration {}".format(version))
+    rebuild_time_totals()
     db.commit()
+    permission_map.reload()
+    active_timers.reload()
+    check_query_plans()
+    
+# the modules whose queries check_query_plans() looks over
+SQL_MODULES = ('main.py', 'aggregation.py', 'bulk.py', 'invoicing.py',
+               'mailer.py', 'permissions.py', 'reporting.py', 'timers.py')
+
+def check_query_plans():
+    """Logs a warning for every query of get_app_queries() that would
+    scan a whole table instead of using an index.
+    """
+    db = get_db()
+    for sql, detail in schema.get_unindexed_queries(db, get_app_queries()):
+        app.logger.warning("Unindexed query ({}):\n{}".format(detail, sql))
+
+def get_app_queries():
+    """Returns every query in SQL_MODULES, for check_query_plans().
+    
+    The reports and archival's statements are put together with
+    str.format(), so they're taken as built rather than from their
+    source.
+    """
+    queries = []
+    for module in SQL_MODULES:
+        queries.extend(schema.get_queries(os.path.join(app.root_path, module)))
+    queries.extend(report.sql for report in REPORTS.values())
+    queries.extend(archival.SET_ARCHIVED.values())
+    return queries
 
+def get_mail_worker():
+    """Returns the thread sending mail from the outbox, starting it
+    the first time. Call .wake() on it after queueing mail.
+    """
+    with pool_lock:
+        worker = app.extensions.get('mail_worker')
+        if worker is None:
+            worker = OutboxWorker(connect_db,
+                                  app.config['MAIL_SERVER'],
+                                  batch_size=app.config['MAIL_BATCH_SIZE'],
+                                  poll_interval=app.config['MAIL_POLL_INTERVAL'],
+                                  max_attempts=app.config['MAIL_MAX_ATTEMPTS'],
+                                  retry_delay=app.config['MAIL_RETRY_DELAY'])
+            worker.start()
+            app.extensions['mail_worker'] = worker
+    return worker
+    
+def get_totals_worker():
+    """Returns the thread applying time record edits to the running
+    totals, starting it the first time. See edit_time_records().
+    """
+    with pool_lock:
+        worker = app.extensions.get('totals_worker')
+        if worker is None:
+            worker = TotalsWorker(connect_db,
+                                  retry_delay=app.config['TOTALS_RETRY_DELAY'])
+            worker.start()
+            app.extensions['totals_worker'] = worker
+    return worker
+    
 @app.teardown_appcontext
 def close_db(error):
+    """Hands the connection back to the pool instead of closing it."""
     if hasattr(g, 'sqlite_db'):
-        g.sqlite_db.close()
+        get_pool().put(g.sqlite_db)
         
 #
 #   functions to call directly from templates
@@ -62,61 +238,99 @@ def my_utility_processor():
         """Currently only needed within details.html,
         returns all possible project statuses.
         """
-        db = get_db()
-        cur = db.execute("""
-            SELECT  *
-            FROM    project_status
-        """)
+        def query():
+            db = get_db()
+            cur = db.execute("""
+                SELECT  *
+                FROM    project_status
+            """)
+            return cur.fetchall()
     
-        return cur.fetchall()
+        return fragment_cache.get_or_render('statuses', 
+                                            ['project_status'], 
+                                            query)
+        
+    def get_navi():
+        """The pages the online user can go to, for navi.html."""
+        user = get_online_user()
+        if user is None:
+            return []
+        return get_permissions().pages(user['usergroup_id'])
     
-    return {"get_statuses": get_statuses}
+    return {"get_statuses": get_statuses,
+            "get_navi": get_navi}
 
 #
 #   Common functions
 #
         
 def get_online_user():
-    """Gets the user that matches the session id."""
-    db = get_db()
-    cur = db.execute("""
-        SELECT  * 
-        FROM    online_users 
-        WHERE   session_id = ?
-        """, [session.get('session_id')])
-    return cur.fetchone()
-    
-def get_urls_for_user(user):
-    """Returns list of SQL results for the user's
-    allowed urls.
+    """Gets the user that matches the session id.
+    
+    Includes the user's usergroup_id and archived flag along with
+    the online_users columns.
+    
+    The user is looked up once per request and kept on g. Behind that
+    is session_cache, so most requests don't query for it at all.
+    Anything that changes online_users, or the user's group or
+    archived state, has to call forget_online_user() afterwards.
     """
-    db = get_db()
-    cur = db.execute("""
-        SELECT  url
-        FROM    permission
-        WHERE   id in (
-                    SELECT  permission_id
-                    FROM    usergroup_permission_tie
-                    WHERE   usergroup_id = (
-                                SELECT  usergroup_id
-                                FROM    user
-                                WHERE   id = ?
-                            )
-                )
-        """, [user['user_id']])
-    return cur.fetchall()
+    if not hasattr(g, 'online_user'):
+        session_id = session.get('session_id')
+        user = session_cache.get(session_id)
+        if user is None and session_id is not None:
+            user = get_db().execute("""
+                SELECT  online_users.*,
+                        user.usergroup_id,
+                        user.archived
+                FROM    online_users,
+                        user
+                WHERE   online_users.session_id = ?
+                        AND user.id = online_users.user_id
+                """, [session_id]).fetchone()
+            if user is not None:
+                user = dict(user)
+                session_cache.set(session_id, user)
+        g.online_user = user
+    return g.online_user
+    
+def forget_online_user(user_id):
+    """Drops every cached session for the user, so the next
+    get_online_user() reads it fresh from the db.
+    """
+    session_cache.evict(lambda user: user['user_id'] == int(user_id))
+    if hasattr(g, 'online_user'):
+        del g.online_user
+    
+def get_permissions():
+    """Returns the permission map, loading it from the db the first
+    time and again after permission_map.reload().
+    """
+    if not permission_map.is_loaded():
+        permission_map.load(get_db(), app.url_map)
+    return permission_map
+    
+def get_active_timer(user_id):
+    """Returns the user's running Timer, or None if they aren't
+    timing. Answered from memory, the registry only reads the
+    active_timer journal the first time.
+    """
+    if not active_timers.is_loaded():
+        active_timers.load(get_db())
+    return active_timers.get(user_id)
     
 def get_projects_for_user(user):
     db = get_db()
     cur = db.execute("""
-        SELECT  description,
-                id,
-                (SELECT sum(strftime('%s', stop) - strftime('%s', start)) / 60.0 
-                FROM    time_record 
-                WHERE   project_id = project.id) AS project_total
-        FROM    project 
-        WHERE   user_id = ? 
-                AND status_id != 1
+        SELECT  project.description,
+                project.id,
+                time_total.seconds / 60.0 AS project_total
+        FROM    project
+                LEFT JOIN time_total
+                    ON  time_total.scope = 'project'
+                    AND time_total.scope_id = project.id
+        WHERE   project.user_id = ? 
+                AND project.status_id != 1
         """, [user['user_id']])
     return cur.fetchall()
     
@@ -136,59 +350,237 @@ def get_open_project_items(project_id):
         WHERE   action_item.type_id = item_type.id 
                 AND action_item.rate_id = item_rate.id 
                 AND action_item.project_id = ?
-                AND action_item.archived != 1
+                AND action_item.archived = 0
         """, [project_id])
     return cur.fetchall()
     
-def get_project_phases(project_id):
+def get_project_phases(project_id, before=None, limit=-1):
+    """Returns the project's phases, newest first.
+    
+    Only phases numbered lower than before are returned if it is
+    given, and at most limit of them (-1 means no limit), so pages
+    of phases can be fetched by passing the last number seen.
+    """
     db = get_db()
     cur = db.execute("""
+        SELECT  phase.id,
+                phase.project_id,
+                phase.number, 
+                time_total.seconds / 60.0 AS phase_total
+        FROM    phase
+                LEFT JOIN time_total
+                    ON  time_total.scope = 'phase'
+                    AND time_total.scope_id = phase.id
+        WHERE   phase.project_id = :project_id
+                AND (:before IS NULL OR phase.number < :before)
+        ORDER BY    phase.number DESC
+        LIMIT   :limit;
+        """, {"project_id": project_id, "before": before, "limit": limit})
+    
+    return cur.fetchall()
+    
+def get_phase_choices(project_id):
+    """Every phase id and number for the project, for dropdowns."""
+    db = get_db()
+    return db.execute("""
         SELECT  id,
-                project_id,
-                number, 
-                (SELECT sum(strftime('%s', stop) - strftime('%s', start)) / 60.0 
-                FROM    time_record 
-                WHERE   phase_id = phase.id) AS phase_total
+                number
         FROM    phase
         WHERE   project_id = ?
-        ORDER BY    number DESC;
-        """, [project_id])
+        ORDER BY    number DESC
+        """, [project_id]).fetchall()
     
-    return cur.fetchall()
+def get_phase_records(phase_id, after=None, after_id=None):
+    """Returns (records, more) for one page of a phase's time records.
     
-def get_time_records_for_phases(phases):
-    """Retrieves the time records for all phases.
+    Records come in the order they were started. Pass the start_key and
+    id of the last record seen as after and after_id to get the next
+    page. more is True if there are records after this page.
     
-    The database saves time_record.start and time_record.stop without accounting
-    for localization. Thus when we VIEW the timestamps, in order for them to
-    make sense, they need to be converted to locatime.
+    The database saves time_record.start and time_record.stop as UTC 
+    epoch seconds, without accounting for localization. Thus when we 
+    VIEW the timestamps, in order for them to make sense, they need to 
+    be converted to localtime.
     
-    This is *particularly* important for times when timestamps are manually
-    adjusted!! The server should RETURN localized timestamps but should be GIVEN
-    UTC timestamps. 
+    This is *particularly* important for times when timestamps are 
+    manually adjusted!! The server should RETURN localized timestamps 
+    but should be GIVEN UTC timestamps, see edit_time_records().
     
     Some parts of the software do not need to account for this,
     like toggling timing on/off, or just calculating the difference.
-    
+    start_key is the raw start, for paging.
     """
+    limit = app.config['RECORD_PAGE_SIZE']
     db = get_db()
-    cur = db.execute("""
+    records = db.execute("""
         SELECT  time_record.id,
                 action_item.name,
                 time_record.phase_id,
-                strftime('%Y-%m-%d', datetime(time_record.start, 'localtime')) AS date,
-                datetime(time_record.start, 'localtime') AS start,
-                datetime(time_record.stop, 'localtime') AS stop,
-                (strftime('%s', time_record.stop) - strftime('%s', time_record.start)) / 60.0 AS total
-        FROM    action_item,
-                time_record
-        WHERE   action_item.id = time_record.action_item_id 
-                AND time_record.phase_id in ({})
-        """.format(','.join(str(p['id']) for p in phases)))
+                date(time_record.start, 'unixepoch', 'localtime') AS date,
+                datetime(time_record.start, 'unixepoch', 'localtime') AS start,
+                datetime(time_record.stop, 'unixepoch', 'localtime') AS stop,
+                time_record.duration / 60.0 AS total,
+                time_record.start AS start_key
+        FROM    time_record,
+                action_item
+        WHERE   action_item.id = time_record.action_item_id
+                AND time_record.phase_id = :phase_id
+                AND (:after IS NULL 
+                     OR (time_record.start, time_record.id) > (:after, :after_id))
+        ORDER BY    time_record.start,
+                    time_record.id
+        LIMIT   :limit
+        """, {"phase_id": phase_id, 
+              "after": after, 
+              "after_id": after_id, 
+              "limit": limit + 1}).fetchall()
+    return records[:limit], len(records) > limit
     
-    return cur.fetchall()
+def get_time_record(record_id):
+    """Returns one record like get_phase_records() does."""
+    return get_db().execute("""
+        SELECT  time_record.id,
+                action_item.name,
+                time_record.phase_id,
+                date(time_record.start, 'unixepoch', 'localtime') AS date,
+                datetime(time_record.start, 'unixepoch', 'localtime') AS start,
+                datetime(time_record.stop, 'unixepoch', 'localtime') AS stop,
+                time_record.duration / 60.0 AS total,
+                time_record.start AS start_key
+        FROM    time_record,
+                action_item
+        WHERE   action_item.id = time_record.action_item_id
+                AND time_record.id = ?
+        """, [record_id]).fetchone()
+    
+def get_phase_page(project_id, before=None, expand=None):
+    """Returns the template context for one page of phases.
+    
+        phases          up to PHASE_PAGE_SIZE phases older than before
+        more_phases     True if there are older phases still
+        time_records    phase id -> first page of records, only for the 
+                        phases in expand (by default the newest phase on 
+                        the first page). The rest load when expanded.
+        more_records    ids of the phases that have more records
+    """
+    limit = app.config['PHASE_PAGE_SIZE']
+    phases = get_project_phases(project_id, before, limit + 1)
+    if expand is None:
+        expand = [phases[0]['id']] if phases and before is None else []
+    page = {
+        "phases": phases[:limit],
+        "more_phases": len(phases) > limit,
+        "time_records": {},
+        "more_records": set()
+    }
+    for phase_id in expand:
+        records, more = get_phase_records(phase_id)
+        page['time_records'][phase_id] = records
+        if more:
+            page['more_records'].add(phase_id)
+    return page
+    
+def get_edited_phases(phase_ids):
+    """Returns the phases like get_project_phases() does, newest
+    first, for rendering just those after an edit. Their totals come
+    from the totals worker, so edits it hasn't written yet are
+    already counted.
+    """
+    phase_ids = [int(p) for p in phase_ids]
+    db = get_db()
+    totals = get_totals_worker().totals(db, 'phase', phase_ids)
+    phases = db.execute("""
+        SELECT  id,
+                project_id,
+                number
+        FROM    phase
+        WHERE   id IN (
+                    SELECT  value
+                    FROM    json_each(?)
+                )
+        ORDER BY    number DESC
+        """, [json.dumps(phase_ids)]).fetchall()
+    return [dict(zip(phase.keys(), phase), 
+                 phase_total=totals[phase['id']] / 60.0) 
+            for phase in phases]
     
-def get_bill_for_phase(phase_id): 
+def get_bill_for_phase(phase_id):
+    """Returns (html, input_hash) for the phase's invoice.
+    
+    Invoices of closed phases (ones with a newer phase after them, 
+    so nothing more can be timed into them, and no record still being 
+    timed) are frozen the first time they're built, and served from 
+    there afterwards without touching time_record. Rates and office 
+    details are frozen along with the records.
+    
+    input_hash identifies what went into the invoice, so an
+    unchanged invoice always has the same hash. Snapshots are stored
+    by it in invoice_snapshot, written once and never changed, and 
+    phase_invoice points each closed phase at its snapshot. 
+    edit_time_records() drops the pointers of the phases it changes, 
+    which is the only way a closed phase's records can change.
+    """
+    db = get_db()
+    snapshot = db.execute("""
+        SELECT  invoice_snapshot.html,
+                invoice_snapshot.input_hash
+        FROM    phase_invoice,
+                invoice_snapshot
+        WHERE   phase_invoice.phase_id = ?
+                AND invoice_snapshot.input_hash = phase_invoice.input_hash
+        """, [phase_id]).fetchone()
+    if snapshot is not None:
+        return snapshot['html'], snapshot['input_hash']
+    html, input_hash = render_bill([phase_id])
+    closed = db.execute("""
+        SELECT  EXISTS (
+                    SELECT  1
+                    FROM    phase AS newer
+                    WHERE   newer.project_id = phase.project_id
+                            AND newer.id > phase.id
+                )
+                AND NOT EXISTS (
+                    SELECT  1
+                    FROM    time_record
+                    WHERE   time_record.phase_id = phase.id
+                            AND time_record.duration IS NULL
+                )
+        FROM    phase
+        WHERE   phase.id = ?
+        """, [phase_id]).fetchone()
+    if closed is not None and closed[0]:
+        db.execute("""
+            INSERT OR IGNORE INTO invoice_snapshot (input_hash,
+                                                    html,
+                                                    created)
+            VALUES  (?,
+                    ?,
+                    datetime('now'))
+            """, [input_hash, html])
+        db.execute("""
+            INSERT OR REPLACE INTO phase_invoice (phase_id,
+                                                  input_hash)
+            VALUES  (?,
+                    ?)
+            """, [phase_id, input_hash])
+        db.commit()
+    return html, input_hash
+    
+def forget_invoices(phase_ids):
+    """Unhooks the phases from their invoice snapshots, so they're
+    built again from their records. The snapshots themselves are kept,
+    an invoice that was sent stays as it was. Does not commit.
+    """
+    db = get_db()
+    db.execute("""
+        DELETE FROM phase_invoice
+        WHERE   phase_id IN (
+                    SELECT  value
+                    FROM    json_each(?)
+                )
+        """, [json.dumps([int(p) for p in phase_ids])])
+    
+def render_bill(phase_ids): 
     """Returns an HTML table with an itemized series of timed sessions. 
     
     Should include per line item: 
@@ -197,156 +589,547 @@ def get_bill_for_phase(phase_id):
         total minutes spent
         sub-total (minutes spent * fee per hour)
         
-    Also should include a grand total for minutes spent and total fee.
+    Also should include subtotals per item type and per rate, and a 
+    grand total for minutes spent and total fee. All of it comes from
+    one query, see invoicing.get_invoices(). Several phases can go on 
+    one invoice.
     
     As of this writing this is not a standalone estimate for any goods or
     services rendered and still needs to go to accounting as it does not
     include any of their fees or taxes or anything ancillary to the actual
     timed action item.
-    """
     
-    db = get_db()
-    invoice = db.execute("""
-        SELECT  a.name,
-                a.phase_id,
-                a.type,
-                a.date,
-                a.time_total,
-                (item_rate.fee_per_hour / 60.0 )* a.time_total AS money_total
-        FROM    item_rate, 
-                (SELECT action_item.name,
-                        action_item.rate_id,
-                        (SELECT description
-                        FROM    item_type
-                        WHERE   item_type.id = action_item.type_id) AS type,
-                        time_record.phase_id,
-                        strftime('%Y-%m-%d', time_record.start) AS date,
-                sum(strftime('%s', stop) - strftime('%s', start))/ 60.0 AS time_total
-                FROM    action_item,
-                        time_record
-                WHERE   action_item.id = time_record.action_item_id
-                        AND time_record.phase_id = ?
-                GROUP BY    action_item.id
-            ) AS a
-        WHERE   a.rate_id = item_rate.id
-        """, [phase_id]).fetchall()
-    office = db.execute("""
-        SELECT  office_serial AS serial,
-                tt_number
-        FROM    project
-        WHERE   project.id = (
-                    SELECT  project_id
-                    FROM    phase
-                    WHERE   phase.id = ?
-                )
-        """, [phase_id]).fetchone()
-    # this seems like it should be rolled into a query
-    # but this will do for now
-    grand_totals = {
-        'time': sum(x['time_total'] for x in invoice),
-        'money': sum(y['money_total'] for y in invoice)
-    }
-    return render_template("invoice.html",
-                            office=office,
-                            invoice=invoice,
-                            grand_totals=grand_totals)
+    Returns (html, input_hash), see get_bill_for_phase().
+    """
+    invoice = invoicing.get_invoice(get_db(), phase_ids)
+    if invoice is None:
+        invoice = {
+            "office": None,
+            "invoice": [],
+            "type_totals": [],
+            "rate_totals": [],
+            "grand_totals": {"time": 0, "money": 0}
+        }
+    html = render_template("invoice.html", **invoice)
+    inputs = json.dumps(invoice, sort_keys=True)
+    return html, hashlib.sha1(inputs).hexdigest()
                             
 def get_open_rates():
-    db = get_db()
-    return db.execute("""
-        SELECT  * 
-        FROM    item_rate
-        WHERE   archived != 1    
-        """).fetchall()
+    def query():
+        db = get_db()
+        return db.execute("""
+            SELECT  * 
+            FROM    item_rate
+            WHERE   archived = 0    
+            """).fetchall()
+    return fragment_cache.get_or_render('open_rates', ['item_rate'], query)
     
 def get_open_types():
-    db = get_db()
-    return db.execute("""
+    def query():
+        db = get_db()
+        return db.execute("""
+            SELECT  * 
+            FROM    item_type
+            WHERE   archived = 0    
+            """).fetchall()
+    return fragment_cache.get_or_render('open_types', ['item_type'], query)
+    
+def render_action_items(project_id):
+    """Renders action_items.html for the project, from the
+    fragment cache if its items, rates and types haven't changed.
+    """
+    return fragment_cache.get_or_render(
+        'action_items.html',
+        ['action_item', 'item_rate', 'item_type'],
+        lambda: render_template("action_items.html", 
+                                action_items=get_open_project_items(project_id)),
+        project_id)
+        
+def render_rate_editor():
+    def render():
+        db = get_db()
+        version = fragment_cache.generation('item_rate')
+        rates = db.execute("SELECT * FROM item_rate").fetchall()
+        return render_template('rate_editor.html', 
+                                rates=rates,
+                                version=version)
+    return fragment_cache.get_or_render('rate_editor.html', 
+                                        ['item_rate'], 
+                                        render)
+    
+def render_type_editor():
+    def render():
+        db = get_db()
+        version = fragment_cache.generation('item_type')
+        types = db.execute("SELECT * FROM item_type").fetchall()
+        return render_template('type_editor.html', 
+                                types=types,
+                                version=version)
+    return fragment_cache.get_or_render('type_editor.html', 
+                                        ['item_type'], 
+                                        render)
+    
+def render_user_editor():
+    def render():
+        db = get_db()
+        version = fragment_cache.generation('user')
+        users = get_user_list()
+        groups = db.execute("""SELECT * from usergroup""")
+        return render_template("user_editor.html",
+                                users=users,
+                                groups=groups,
+                                version=version)
+    return fragment_cache.get_or_render('user_editor.html', 
+                                        ['user', 'usergroup'], 
+                                        render)
+    
+# the row macro in admin_rows.html, and the query for just the given
+# rows, of each admin table. see admin_patch()
+ADMIN_ROWS = {
+    'item_rate': ('rate_row', """
+        SELECT  * 
+        FROM    item_rate
+        WHERE   id IN (
+                    SELECT  value
+                    FROM    json_each(?)
+                )
+        """),
+    'item_type': ('type_row', """
         SELECT  * 
         FROM    item_type
-        WHERE   archived != 1    
-        """).fetchall()
+        WHERE   id IN (
+                    SELECT  value
+                    FROM    json_each(?)
+                )
+        """),
+    'user': ('user_row', """
+        SELECT  user.id,
+                user.name,
+                user.email, 
+                usergroup.name AS usergroup,
+                user.archived
+        FROM    user,
+                usergroup
+        WHERE   user.id IN (
+                    SELECT  value
+                    FROM    json_each(?)
+                )
+                AND usergroup.id = user.usergroup_id
+        """),
+}
+
+def admin_patch(table, ids, render_full):
+    """Returns just the changed rows of an admin table, as JSON 
+    {table, version, rows: [{id, html}]}, for admin.js to patch into
+    the table in place.
+    
+    The table's fragment_cache generation is its version. The client
+    sends the version it has in X-Table-Version, and a write that
+    changed rows bumps it once, so the patch only applies if the 
+    version is now exactly one past the client's (or unchanged, if no
+    ids changed). Otherwise someone else wrote in between, or the
+    client has no version, and render_full() is returned instead, the
+    way every admin write used to answer.
+    
+    Versions only count this process's writes, like the fragment 
+    cache. With several processes, a client going back and forth
+    between them mostly gets full renders.
+    """
+    version = fragment_cache.generation(table)
+    client_version = request.headers.get('X-Table-Version', type=int)
+    if (client_version is None 
+            or version != client_version + (1 if ids else 0)):
+        return render_full()
+    macro, sql = ADMIN_ROWS[table]
+    render_row = get_template_attribute('admin_rows.html', macro)
+    rows = get_db().execute(sql, [json.dumps([int(i) for i in ids])])
+    return jsonify(table=table, 
+                   version=version,
+                   rows=[{"id": row['id'], "html": unicode(render_row(row))}
+                         for row in rows])
+    
+def render_admin_editor():
+    """Renders the type, rate and user editors together, each from
+    the fragment cache unless its tables have changed.
+    """
+    return render_template('admin_editor.html',
+                           type_editor=Markup(render_type_editor()),
+                           rate_editor=Markup(render_rate_editor()),
+                           user_editor=Markup(render_user_editor()))
     
-def start_timing(item_id, phase_id):
+def get_project_workspace(project_id):
+    """Loads everything the expanded project view needs.
+    
+    Returns a dict that can be passed straight to render_template():
+        details         the project row, None if there's no such project
+        action_items    from get_open_project_items()
+        rates           from get_open_rates()
+        types           from get_open_types()
+        phases, more_phases, time_records, more_records
+                        the first page of phases, see get_phase_page()
+        
+    The items, rates and types usually come from fragment_cache. One
+    query then fetches the project with its first page of phases and 
+    the newest phase's first page of records, one row per record, so 
+    the project and phase columns repeat.
+    """
+    phase_limit = app.config['PHASE_PAGE_SIZE']
+    record_limit = app.config['RECORD_PAGE_SIZE']
     db = get_db()
-    user = get_online_user()
-    new_time = db.execute("""
-        INSERT INTO time_record (id, 
-                                 action_item_id, 
-                                 project_id, 
-                                 phase_id, 
-                                 start, 
-                                 stop)
-        VALUES      (null, 
-                    ?, 
-                    ?, 
-                    ?, 
-                    datetime('now'), 
-                    null)
-        """, [item_id, user['viewing_project_id'], phase_id])
-    db.execute("""
-        UPDATE  online_users 
-        SET     time_record_id = ?
-        WHERE   user_id = ?
-        """, [new_time.lastrowid, user['user_id']])
-    db.commit()
+    workspace = {
+        "details": None,
+        "action_items": fragment_cache.get_or_render(
+            'workspace_items', 
+            ['action_item', 'item_rate', 'item_type'],
+            lambda: get_open_project_items(project_id), 
+            project_id),
+        # rates and types are the same for every project, so they're
+        # cached once instead of along with each project's items
+        "rates": get_open_rates(),
+        "types": get_open_types(),
+        "phases": [],
+        "more_phases": False,
+        "time_records": {},
+        "more_records": set()
+    }
+    # see get_phase_records() about the localtime conversions.
+    # one extra phase and record are fetched to tell if there are more
+    rows = db.execute("""
+        WITH    page AS (
+                    SELECT  id,
+                            number
+                    FROM    phase
+                    WHERE   project_id = :project_id
+                    ORDER BY    number DESC
+                    LIMIT   :phase_limit
+                ),
+                records AS (
+                    SELECT  *
+                    FROM    time_record
+                    WHERE   phase_id = (
+                                SELECT  id
+                                FROM    page
+                                ORDER BY    number DESC
+                                LIMIT   1
+                            )
+                    ORDER BY    start,
+                                id
+                    LIMIT   :record_limit
+                )
+        SELECT  project.*,
+                phase.id AS phase_id,
+                phase.number AS phase_number,
+                time_total.seconds / 60.0 AS phase_total,
+                records.id AS record_id,
+                action_item.name AS record_name,
+                date(records.start, 'unixepoch', 'localtime') AS record_date,
+                datetime(records.start, 'unixepoch', 'localtime') AS record_start,
+                datetime(records.stop, 'unixepoch', 'localtime') AS record_stop,
+                records.duration / 60.0 AS record_total,
+                records.start AS record_start_key
+        FROM    project
+                LEFT JOIN phase
+                    ON  phase.id IN (SELECT id FROM page)
+                LEFT JOIN time_total
+                    ON  time_total.scope = 'phase'
+                    AND time_total.scope_id = phase.id
+                LEFT JOIN records
+                    ON  records.phase_id = phase.id
+                LEFT JOIN action_item
+                    ON  action_item.id = records.action_item_id
+        WHERE   project.id = :project_id
+        ORDER BY    phase.number DESC,
+                    records.start,
+                    records.id
+        """, {"project_id": project_id,
+              "phase_limit": phase_limit + 1,
+              "record_limit": record_limit + 1}).fetchall()
+    if rows:
+        first = rows[0]
+        workspace['details'] = dict(
+            (key, first[key]) for key in ('id', 'office_serial', 'tt_number', 
+                                          'user_id', 'description', 'notes', 
+                                          'status_id'))
+    for row in rows:
+        if row['phase_id'] is None:
+            continue
+        phases = workspace['phases']
+        if not phases or phases[-1]['id'] != row['phase_id']:
+            if len(phases) == phase_limit:
+                workspace['more_phases'] = True
+                break
+            phases.append({
+                "id": row['phase_id'],
+                "project_id": row['id'],
+                "number": row['phase_number'],
+                "phase_total": row['phase_total']
+            })
+        if row['record_id'] is not None:
+            records = workspace['time_records'].setdefault(row['phase_id'], [])
+            if len(records) == record_limit:
+                workspace['more_records'].add(row['phase_id'])
+                continue
+            records.append({
+                "id": row['record_id'],
+                "name": row['record_name'],
+                "phase_id": row['phase_id'],
+                "date": row['record_date'],
+                "start": row['record_start'],
+                "stop": row['record_stop'],
+                "total": row['record_total'],
+                "start_key": row['record_start_key']
+            })
+    return workspace
+    
+def start_timing(item_id, project_id):
+    """Starts timing the item in the project's newest phase, creating
+    phase 1 first if the project has none.
+    
+    The phase, the time_record and the active_timer journal row all go
+    in one transaction. Returns the new Timer, or None if the user was
+    already timing (the journal allows one timer per user).
+    """
+    db = get_db()
+    user_id = get_online_user()['user_id']
+    now = int(time.time())
+    try:
+        db.execute("""
+            INSERT INTO phase (id, 
+                               project_id, 
+                               number)
+            SELECT  null,
+                    :project_id,
+                    1
+            WHERE   NOT EXISTS (
+                        SELECT  1
+                        FROM    phase
+                        WHERE   project_id = :project_id
+                    )
+            """, {"project_id": project_id})
+        phase_id = db.execute("""
+            SELECT  max(id)
+            FROM    phase
+            WHERE   project_id = ?
+            """, [project_id]).fetchone()[0]
+        record_id = db.execute("""
+            INSERT INTO time_record (id, 
+                                     action_item_id, 
+                                     project_id, 
+                                     phase_id, 
+                                     start, 
+                                     stop,
+                                     duration)
+            VALUES      (null, 
+                        ?, 
+                        ?, 
+                        ?, 
+                        ?, 
+                        null,
+                        null)
+            """, [item_id, project_id, phase_id, now]).lastrowid
+        db.execute("""
+            INSERT INTO active_timer (user_id,
+                                      time_record_id,
+                                      project_id,
+                                      phase_id,
+                                      action_item_id,
+                                      start)
+            VALUES  (?,
+                    ?,
+                    ?,
+                    ?,
+                    ?,
+                    ?)
+            """, [user_id, record_id, project_id, phase_id, item_id, now])
+        item_name = db.execute("""
+            SELECT  name
+            FROM    action_item
+            WHERE   id = ?
+            """, [item_id]).fetchone()[0]
+        db.commit()
+    except sqlite3.IntegrityError:
+        db.rollback()
+        return None
+    timer = Timer(user_id, record_id, project_id, phase_id, 
+                  int(item_id), item_name, now)
+    active_timers.started(timer)
+    timer_bus.publish(user_id, 'timer_started', 
+                      dict(timer.as_dict(), now=now))
+    return timer
     
 def stop_timing():
-    """Stops timing the current project, and sets
-    online_users.time_record_id to NULL.
+    """Stops the current user's timer.
+    
+    The time_record, the running totals and the active_timer journal
+    are updated in one transaction. Removing the journal row comes 
+    first, so when two stops overlap (a double click, or a second tab)
+    only the one that removed it goes on to close the record and add
+    it to the totals.
     """
     db = get_db()
-    user = get_online_user()
-    db.executescript("""
+    user_id = get_online_user()['user_id']
+    timer = get_active_timer(user_id)
+    if timer is None:
+        return
+    now = int(time.time())
+    journaled = db.execute("""
+        DELETE FROM active_timer
+        WHERE       user_id = ?
+                    AND time_record_id = ?
+        """, [user_id, timer.time_record_id]).rowcount
+    if not journaled:
+        db.rollback()
+        return
+    db.execute("""
         UPDATE  time_record 
-        SET     stop = datetime('now')
-        WHERE   id = {time_record_id};
-        
-        UPDATE  online_users 
-        SET     time_record_id=null
-        WHERE   user_id = {user_id}
-        """.format(**user))
+        SET     stop = :now,
+                duration = :now - start
+        WHERE   id = :id
+                AND stop IS NULL
+        """, {"now": now, "id": timer.time_record_id})
+    apply_record_to_totals(timer.time_record_id)
+    totals = get_running_totals(timer)
     db.commit()
+    active_timers.stopped(user_id)
+    timer_bus.publish(user_id, 'timer_stopped', 
+                      dict(timer.as_dict(), 
+                           now=now, 
+                           stop=now, 
+                           duration=now - timer.start,
+                           totals=totals))
     
-def archive_record(table, id):
-    """Sets the archived flag of a record to 1.
+def get_running_totals(timer):
+    """Returns the seconds recorded so far on the timer's action item,
+    phase and project, keyed by scope.
+    """
+    rows = get_db().execute("""
+        SELECT  scope,
+                seconds
+        FROM    time_total
+        WHERE   (scope = 'action_item' AND scope_id = ?)
+                OR (scope = 'phase' AND scope_id = ?)
+                OR (scope = 'project' AND scope_id = ?)
+        """, [timer.action_item_id, timer.phase_id, timer.project_id])
+    totals = {"action_item": 0, "phase": 0, "project": 0}
+    totals.update((str(row[0]), row[1]) for row in rows)
+    return totals
     
-    This can be a generic function since the only data
-    we need is the table name and the id of the record.
+def apply_record_to_totals(record_id):
+    """Adds a closed time_record's duration to the running totals
+    of its phase, project and action item, and to the daily
+    time_bucket the reports read.
     
-    sqlite3 doesn't let you parameterize column names, so
-    sadly we have to use str.format() to get the right
-    query. This should not be unsafe since the table name 
-    will only ever be passed from the function calling it
-    and won't come from forms submitted from the browser.
+    Edits don't come through here, edit_time_records() hands them 
+    to the totals worker instead. Records that are still being timed
+    have no stop and are ignored.
+    
+    Does not commit; the caller commits along with its own changes.
     """
     db = get_db()
     db.execute("""
-        UPDATE  {}
-        SET     archived = 1
-        WHERE   id = {}
-        """.format(table, id))
-    db.commit()
+        WITH    record AS (
+                    SELECT  phase_id,
+                            project_id,
+                            action_item_id,
+                            duration AS seconds
+                    FROM    time_record
+                    WHERE   id = ?
+                            AND stop IS NOT NULL
+                )
+        INSERT INTO time_total (scope, 
+                                scope_id, 
+                                seconds)
+        SELECT  'phase', phase_id, seconds FROM record
+        UNION ALL
+        SELECT  'project', project_id, seconds FROM record
+        UNION ALL
+        SELECT  'action_item', action_item_id, seconds FROM record
+        WHERE   true
+        ON CONFLICT (scope, scope_id)
+        DO UPDATE SET seconds = seconds + excluded.seconds
+        """, [record_id])
+    db.execute("""
+        INSERT INTO time_bucket (day, 
+                                 project_id, 
+                                 phase_id, 
+                                 action_item_id, 
+                                 seconds)
+        SELECT  start - start % 86400,
+                project_id,
+                phase_id,
+                action_item_id,
+                duration
+        FROM    time_record
+        WHERE   id = ?
+                AND stop IS NOT NULL
+        ON CONFLICT (day, project_id, phase_id, action_item_id)
+        DO UPDATE SET seconds = seconds + excluded.seconds
+        """, [record_id])
         
-def retrieve_record(table, id):
-    """Sets the archived flag of a record to 0.
-    
-    This can be a generic function since the only data
-    we need is the table name and the id of the record.
+def rebuild_time_totals():
+    """Recomputes every running total and daily bucket from scratch.
     
-    sqlite3 doesn't let you parameterize column names, so
-    sadly we have to use str.format() to get the right
-    query. This should not be unsafe since the table name 
-    will only ever be passed from the function calling it
-    and won't come from forms submitted from the browser.
+    The totals are normally kept up to date by apply_record_to_totals(),
+    this is for startup and for databases that predate time_total.
     """
     db = get_db()
+    db.execute("DELETE FROM time_total")
+    db.execute("""
+        -- full scan: adds up every record
+        INSERT INTO time_total (scope, 
+                                scope_id, 
+                                seconds)
+        SELECT  'phase', 
+                phase_id, 
+                sum(duration)
+        FROM    time_record
+        WHERE   stop IS NOT NULL
+        GROUP BY    phase_id
+        UNION ALL
+        SELECT  'project', 
+                project_id, 
+                sum(duration)
+        FROM    time_record
+        WHERE   stop IS NOT NULL
+        GROUP BY    project_id
+        UNION ALL
+        SELECT  'action_item', 
+                action_item_id, 
+                sum(duration)
+        FROM    time_record
+        WHERE   stop IS NOT NULL
+        GROUP BY    action_item_id
+        """)
+    db.execute("DELETE FROM time_bucket")
     db.execute("""
-        UPDATE  {}
-        SET     archived = 0
-        WHERE   id = {}
-        """.format(table, id))
+        -- full scan: adds up every record
+        INSERT INTO time_bucket (day, 
+                                 project_id, 
+                                 phase_id, 
+                                 action_item_id, 
+                                 seconds)
+        SELECT  start - start % 86400,
+                project_id,
+                phase_id,
+                action_item_id,
+                sum(duration)
+        FROM    time_record
+        WHERE   stop IS NOT NULL
+        GROUP BY    start - start % 86400,
+                    project_id,
+                    phase_id,
+                    action_item_id
+        """)
+    
+def archive_records(table, ids, archived=True):
+    """Archives the rows of table with the given ids, or with
+    archived=False retrieves them, in one transaction. See 
+    archival.py for which tables can be archived.
+    """
+    db = get_db()
+    archival.set_archived(db, table, ids, archived)
     db.commit()
+    fragment_cache.bump(table)
     
 def get_user_list():
     db = get_db()
@@ -378,30 +1161,14 @@ def check_user():
     # everyone should access these
     if request.endpoint in ('login', 'logout', 'static'):
         return
-    do_login = True
-    if 'session_id' in session:
-        db = get_db()
-        cur = db.execute("""
-            SELECT  * 
-            FROM    online_users
-            WHERE   session_id = ?
-            """, [session['session_id']])
-        match = cur.fetchall()
-        if match:
-            do_login = False
-    if do_login:
+    user = get_online_user()
+    # archived users get sent back to login like anyone
+    # else who isn't logged in
+    if not user or user['archived']:
         return redirect(url_for('login'), code=401)
     # confirm privilege to access url provided
-    user = get_online_user()
-    if user:
-        if 'navi' not in session:
-            session['navi'] = [url[0][1:] for url in get_urls_for_user(user)]
-        stop_access = True
-        for url in session['navi']:
-            if url in request.full_path:
-                stop_access = False
-        if stop_access:
-            return Response("Bollocks, can't go here", 500)
+    if not get_permissions().allows(user['usergroup_id'], request.endpoint):
+        return Response("Bollocks, can't go here", 500)
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -419,7 +1186,7 @@ def login():
                     password
             FROM    user
             WHERE   name = ?
-                    AND archived != 1
+                    AND archived = 0
         """, [request.form['name']]).fetchall()
         if not result:
             flash("No such username")
@@ -438,6 +1205,7 @@ def login():
                             null)
                     """, [user_id, session['session_id']])
                 db.commit()
+                forget_online_user(user_id)
                 flash("Welcome, {}".format(name))
                 return redirect(url_for('my_projects'))
             else:
@@ -450,7 +1218,7 @@ def logout():
     # there might not be anybody online
     if user:
         # if user is timing, stop it
-        if user['time_record_id'] is not None:
+        if get_active_timer(user['user_id']) is not None:
             stop_timing()
         db = get_db()
         db.execute("""
@@ -459,6 +1227,7 @@ def logout():
             """, [user['user_id']])
         session.clear()
         db.commit()
+        forget_online_user(user['user_id'])
     flash("You logged out")
     return redirect(url_for('login'), code=302)
     
@@ -474,24 +1243,11 @@ def index():
 def my_projects():
     user = get_online_user()
     projects = get_projects_for_user(user)
-    db = get_db()
-    rates = get_open_rates()
-    types = get_open_types()
-    action_items = get_open_project_items(user['viewing_project_id'])
-    details = db.execute("""
-        SELECT  * 
-        FROM    project 
-        WHERE   id = :project_id
-        """, [user['viewing_project_id']]).fetchone()
-    phases = get_project_phases(user['viewing_project_id'])
+    workspace = get_project_workspace(user['viewing_project_id'])
     return render_template('my_projects.html', 
                             projects=projects,
-                            rates=rates,
-                            types=types,
                             active=user['viewing_project_id'],
-                            action_items=action_items,
-                            details=details,
-                            phases=phases)
+                            **workspace)
                             
 @app.route('/my_projects/add_project', methods=['POST'])
 def add_project():
@@ -521,7 +1277,7 @@ def add_project():
 @app.route('/my_projects/expanded_project', methods=['POST'])
 def expanded_project():
     user = get_online_user()
-    if user['time_record_id'] is not None:
+    if get_active_timer(user['user_id']) is not None:
         return Response("Cannot switch projects while timing.", 500)
     
     db = get_db()
@@ -529,30 +1285,15 @@ def expanded_project():
         "project_id": request.data,
         "session_id": user['session_id']
     }
-    details = db.execute("""
-        SELECT  * 
-        FROM    project 
-        WHERE   id = :project_id
-        """, data).fetchone()
     db.execute("""
         UPDATE  online_users
         SET     viewing_project_id = :project_id
         WHERE   session_id = :session_id
         """, data)
     db.commit()
-    action_items = get_open_project_items(data['project_id'])
-    rates = get_open_rates()
-    types = get_open_types()
-    phases = get_project_phases(data['project_id'])
-    time_records = get_time_records_for_phases(phases)
-    
-    return render_template('expanded_project.html',
-                            details=details,
-                            action_items=action_items,
-                            rates=rates,
-                            types=types,
-                            phases=phases,
-                            time_records=time_records)
+    forget_online_user(user['user_id'])
+    workspace = get_project_workspace(data['project_id'])
+    return render_template('expanded_project.html', **workspace)
     
 @app.route('/my_projects/add_action_item', methods=['POST'])
 def add_action_item():
@@ -594,73 +1335,105 @@ def add_action_item():
                 id = :id
             """, data)
     db.commit()
-    action_items = get_open_project_items(project_id)
-    return render_template("action_items.html", 
-                            action_items=action_items)
+    fragment_cache.bump('action_item')
+    return render_action_items(project_id)
 
 @app.route('/my_projects/delete_action_item', methods=['POST'])
 def delete_action_item():
-    """Archives the action_item.
+    """Archives the action_items.
     """
-    archive_record("action_item", request.form['item_id'])
-    action_items = get_open_project_items(get_online_user()['viewing_project_id'])
-    return render_template("action_items.html", 
-                            action_items=action_items)
+    archive_records("action_item", request.form.getlist('item_id'))
+    return render_action_items(get_online_user()['viewing_project_id'])
     
 @app.route('/my_projects/time_action_item', methods=['POST'])
 def time_action_item():
     """Start/stop toggle for timing.
     
-    Checks the db to see if there's a time_record_id, which means
-    the user is timing. If so, calls stop_timing(). Else, calls start_timing().
+    Checks the timer registry to see if the user is timing. If so, 
+    calls stop_timing(). Else, calls start_timing().
     
     Returns 'currently_timing.html'.
     """
     item_to_time = request.form['item_id']
-    db = get_db()
     user = get_online_user()
     project_id = user['viewing_project_id']
-    if user['time_record_id'] is not None:
+    if get_active_timer(user['user_id']) is not None:
         stop_timing()
-        action_items = get_open_project_items(project_id)
-        return render_template("action_items.html", 
-                                action_items=action_items)
-    else:
-        latest_phase = db.execute("""
-                SELECT  max(id)
-                FROM    phase
-                WHERE   project_id = ?
-                """, [project_id]).fetchone()[0]
-        if latest_phase is None:
-            latest_phase = db.execute("""
-                INSERT INTO phase (id, 
-                                   project_id, 
-                                   number)
-                VALUES  (null, 
-                        ?, 
-                        1)
-                """, [project_id]).lastrowid
-            db.commit()
-        start_timing(item_to_time, latest_phase)
-        db.commit()
-        
-        timed_item = db.execute("""
-            SELECT  name, 
-                    id 
-            FROM    action_item
-            WHERE   id = ?
-            """, [item_to_time]).fetchone()
-        
-        return render_template("currently_timing.html", 
-                                item=timed_item)
+        return render_action_items(project_id)
+    if start_timing(item_to_time, project_id) is None:
+        return Response("Already timing.", 500)
+    return currently_timing()
+    
+@app.route('/my_projects/currently_timing')
+def currently_timing():
+    """Returns 'currently_timing.html' for what the user is timing,
+    or an empty 204 if they aren't. Doesn't touch the db, see
+    get_active_timer().
+    """
+    timer = get_active_timer(get_online_user()['user_id'])
+    if timer is None:
+        return Response(status=204)
+    return render_template("currently_timing.html", 
+                            item={"id": timer.action_item_id,
+                                  "name": timer.item_name,
+                                  "start": timer.start})
                                 
+@app.route('/my_projects/timer_events')
+def timer_events():
+    """Streams the user's timer starts and stops as Server-Sent
+    Events, so the page doesn't have to poll.
+    
+    The stream opens with a timer_state event, the running timer or
+    {} when idle, then timer_started and timer_stopped as they happen.
+    Each carries the server's clock as now; the browser counts the
+    elapsed time itself. Nothing in the stream needs the request or a
+    db connection, so an idle client only holds a blocked thread.
+    """
+    user_id = get_online_user()['user_id']
+    subscription = timer_bus.subscribe(user_id)
+    # subscribed first, so nothing is missed between the two
+    timer = get_active_timer(user_id)
+    state = dict(timer.as_dict() if timer else {}, now=int(time.time()))
+    
+    def stream():
+        yield "retry: 5000\n"
+        yield format_event('timer_state', state)
+        for message in subscription:
+            yield message
+    
+    response = Response(stream(), mimetype='text/event-stream',
+                        headers={"Cache-Control": 'no-cache',
+                                 "X-Accel-Buffering": 'no'})
+    response.call_on_close(subscription.close)
+    return response
+    
 @app.route('/my_projects/get_phases')
 def get_phases():
-    phases = get_project_phases(get_online_user()['viewing_project_id'])
-    time_records = get_time_records_for_phases(phases)
-    return render_template("phases.html",
-                            phases=phases,
-                            time_records=time_records)
+    """Returns a page of phases for the current project.
+    
+    Without arguments this is the newest phases, with the newest 
+    one's records filled in. ?before=<phase number> returns the next
+    page of older phases, with records left to load when expanded.
+    """
+    page = get_phase_page(get_online_user()['viewing_project_id'],
+                          request.args.get('before', type=int))
+    return render_template("phases.html", **page)
+    
+@app.route('/my_projects/get_phase_records')
+def get_phase_records_page():
+    """Returns the rows for one page of a phase's records.
+    
+    Takes phase_id, and after/after_id from the last record already
+    shown to get the page after it.
+    """
+    phase_id = request.args.get('phase_id', type=int)
+    records, more = get_phase_records(phase_id,
+                                      request.args.get('after', type=int),
+                                      request.args.get('after_id', type=int))
+    return render_template("phase_records.html",
+                            phase_id=phase_id,
+                            records=records,
+                            more=more)
         
 @app.route('/my_projects/add_phase', methods=['POST'])
 def add_phase():
@@ -697,12 +1470,8 @@ def add_phase():
         """, [user['viewing_project_id'], next_phase])
     db.commit()
     
-    phases = get_project_phases(user['viewing_project_id'])
-    time_records = get_time_records_for_phases(phases)
-    
-    return render_template("phases.html", 
-                            phases=phases,
-                            time_records=time_records)
+    page = get_phase_page(user['viewing_project_id'])
+    return render_template("phases.html", **page)
                             
 @app.route('/my_projects/update_details', methods=['POST'])
 def update_details():
@@ -732,19 +1501,33 @@ def update_details():
                             
 @app.route('/my_projects/preview_invoice', methods=['POST'])
 def preview_invoice():
-    return get_bill_for_phase(request.data)
+    """Returns the invoice for a phase id, or for several comma 
+    separated phase ids together.
+    """
+    phase_ids = request.data.split(',')
+    if len(phase_ids) == 1:
+        html, input_hash = get_bill_for_phase(phase_ids[0])
+    else:
+        html, input_hash = render_bill(phase_ids)
+    # the hash names this exact invoice, e.g. for accounting to 
+    # check a sent invoice against a preview
+    response = Response(html)
+    response.set_etag(input_hash)
+    return response
 
 
 @app.route('/my_projects/send_invoice', methods=['POST'])    
 def send_invoice():
-    invoice = get_bill_for_phase(request.data)
+    invoice, input_hash = get_bill_for_phase(request.data)
     db = get_db()
     user_email = db.execute("""
             SELECT  email
             FROM    user
             WHERE   id = ?
         """, [get_online_user()['user_id']]).fetchone()[0]
-    email_invoice(user_email, invoice)
+    queue_invoice(db, user_email, invoice)
+    db.commit()
+    get_mail_worker().wake()
     return """
             <div style="background-color:rgb(140, 140, 140)">
                 <h1>Sent invoice</h1>
@@ -758,16 +1541,8 @@ def send_invoice():
 
 @app.route('/admin', methods=['GET'])
 def admin():
-    db = get_db()
-    rates = db.execute("SELECT * FROM item_rate").fetchall()
-    types = db.execute("SELECT * FROM item_type").fetchall()
-    users = get_user_list()
-    groups = db.execute("SELECT * FROM usergroup").fetchall()
     return render_template('admin.html', 
-                            types=types, 
-                            rates=rates,
-                            users=users,
-                            groups=groups)
+                            admin_editor=Markup(render_admin_editor()))
     
 @app.route('/admin/edit_rate', methods=['POST'])
 def edit_rate():
@@ -779,14 +1554,14 @@ def edit_rate():
     data['id'] = data.pop('rate-id', None)
     db = get_db()
     if data['id'] == '-1':
-        db.execute("""
+        data['id'] = db.execute("""
             INSERT INTO item_rate (id, 
                                    description, 
                                    fee_per_hour)
             VALUES  (null, 
                     :description, 
                     :fee_per_hour)
-        """, data)
+        """, data).lastrowid
     else:
         db.execute("""
             UPDATE  item_rate
@@ -797,25 +1572,20 @@ def edit_rate():
         """, data)
         
     db.commit()
-    rates = db.execute("SELECT * FROM item_rate").fetchall()
-    return render_template('rate_editor.html', 
-                            rates=rates)
+    fragment_cache.bump('item_rate')
+    return admin_patch('item_rate', [data['id']], render_rate_editor)
                             
 @app.route('/admin/archive_rate', methods=['POST'])
 def archive_rate():
-    archive_record('item_rate', request.form['rate-id'])
-    db = get_db()
-    rates = db.execute("SELECT * FROM item_rate").fetchall()
-    return render_template('rate_editor.html',
-                            rates=rates)
+    ids = request.form.getlist('rate-id')
+    archive_records('item_rate', ids)
+    return admin_patch('item_rate', ids, render_rate_editor)
                             
 @app.route('/admin/retrieve_rate', methods=['POST'])
 def retrieve_rate():
-    retrieve_record('item_rate', request.form['rate-id'])
-    db = get_db()
-    rates = db.execute("SELECT * FROM item_rate").fetchall()
-    return render_template('rate_editor.html',
-                            rates=rates)
+    ids = request.form.getlist('rate-id')
+    archive_records('item_rate', ids, archived=False)
+    return admin_patch('item_rate', ids, render_rate_editor)
     
     
 @app.route('/admin/edit_type', methods=['POST'])
@@ -825,12 +1595,12 @@ def edit_type():
     data['id'] = data.pop('type-id', None)
     data['description'] = data.pop('description') or None
     if data['id'] == '-1':
-        db.execute("""
+        data['id'] = db.execute("""
             INSERT INTO item_type (id, 
                                    description)
             VALUES  (null, 
                     :description)
-        """, data)
+        """, data).lastrowid
     else:
         db.execute("""
             UPDATE  item_type
@@ -838,25 +1608,20 @@ def edit_type():
             WHERE   id = :id
         """, data)
     db.commit()
-    types = db.execute("SELECT * FROM item_type").fetchall()
-    return render_template('type_editor.html', 
-                            types=types)
+    fragment_cache.bump('item_type')
+    return admin_patch('item_type', [data['id']], render_type_editor)
                             
 @app.route('/admin/archive_type', methods=['POST'])
 def archive_type():
-    archive_record('item_type', request.form['type-id'])
-    db = get_db()
-    types = db.execute("SELECT * FROM item_type").fetchall()
-    return render_template('type_editor.html',
-                            types=types)
+    ids = request.form.getlist('type-id')
+    archive_records('item_type', ids)
+    return admin_patch('item_type', ids, render_type_editor)
 
 @app.route('/admin/retrieve_type', methods=['POST'])
 def retrieve_type():
-    retrieve_record('item_type', request.form['type-id'])
-    db = get_db()
-    types = db.execute("SELECT * FROM item_type").fetchall()
-    return render_template('type_editor.html',
-                            types=types)
+    ids = request.form.getlist('type-id')
+    archive_records('item_type', ids, archived=False)
+    return admin_patch('item_type', ids, render_type_editor)
                             
 @app.route('/admin/edit_user', methods=['POST'])
 def edit_user():
@@ -874,7 +1639,7 @@ def edit_user():
         # as they can be
         if 'password' not in data:
             data['password'] = random_password()
-        db.execute("""
+        data['id'] = db.execute("""
             INSERT INTO user   (id,
                                 name,
                                 email,
@@ -885,8 +1650,8 @@ def edit_user():
                     :email,
                     :password,
                     :usergroup_id)
-        """, data)
-        email_new_password(data['email'], data['name'], data['password'])
+        """, data).lastrowid
+        queue_new_password(db, data['email'], data['name'], data['password'])
     else:
         db.execute("""
             UPDATE  user
@@ -895,34 +1660,29 @@ def edit_user():
                     usergroup_id = :usergroup_id
             WHERE   id = :id
         """, data)
+        forget_online_user(data['id'])
     db.commit()
-    users = get_user_list()
-    groups = db.execute("""SELECT * from usergroup""")
-    return render_template("user_editor.html",
-                            users=users,
-                            groups=groups)   
+    get_mail_worker().wake()
+    fragment_cache.bump('user')
+    return admin_patch('user', [data['id']], render_user_editor)
 
                          
 @app.route('/admin/archive_user', methods=['POST'])
 def archive_user():
-    archive_record("user", request.form['user-id'])
-    db = get_db()
-    users = get_user_list()
-    groups = db.execute("""SELECT * from usergroup""")
-    return render_template("user_editor.html",
-                            users=users,
-                            groups=groups)
+    ids = request.form.getlist('user-id')
+    archive_records("user", ids)
+    for user_id in ids:
+        forget_online_user(user_id)
+    return admin_patch('user', ids, render_user_editor)
 
 
 @app.route('/admin/retrieve_user', methods=['POST'])
 def retrieve_user():
-    retrieve_record("user", request.form['user-id'])
-    db = get_db()
-    users = get_user_list()
-    groups = db.execute("""SELECT * from usergroup""")
-    return render_template("user_editor.html",
-                            users=users,
-                            groups=groups)
+    ids = request.form.getlist('user-id')
+    archive_records("user", ids, archived=False)
+    for user_id in ids:
+        forget_online_user(user_id)
+    return admin_patch('user', ids, render_user_editor)
                             
 @app.route('/admin/reset_password', methods=['POST'])
 def reset_password():
@@ -938,15 +1698,58 @@ def reset_password():
         SET     password = :password
         WHERE   id = :id
     """, data)
-    email_new_password(request.form['email'], 
+    queue_new_password(db,
+                       request.form['email'], 
                        request.form['name'], 
                        data['password'])
     db.commit()
-    users = get_user_list()
-    groups = db.execute("""SELECT * from usergroup""")
-    return render_template("user_editor.html",
-                            users=users,
-                            groups=groups)
+    get_mail_worker().wake()
+    forget_online_user(data['id'])
+    # nothing shown in the table changed
+    return admin_patch('user', [], render_user_editor)
+
+
+@app.route('/admin/bulk', methods=['POST'])
+def bulk_admin():
+    """Creates, updates, archives and retrieves many rates, types and
+    users at once. See bulk.py for the operations.
+    
+    Takes a JSON or CSV body (by Content-Type), or the batch and 
+    format fields of the admin page's form. The whole batch is applied
+    in one transaction, or not at all, and the new users' password 
+    mail is queued in it too. Returns the refreshed admin editors, 
+    with what changed in the X-Bulk-Stats header.
+    """
+    if request.mimetype == 'application/json':
+        fmt, text = 'json', request.data
+    elif request.mimetype == 'text/csv':
+        fmt, text = 'csv', request.data
+    else:
+        fmt = request.form.get('format', 'json')
+        text = request.form.get('batch', '').encode('utf-8')
+    db = get_db()
+    try:
+        if fmt == 'csv':
+            operations = bulk.parse_csv(text)
+        else:
+            operations = bulk.parse_json(text)
+        result = bulk.apply(db, operations, random_password)
+    except bulk.BulkError as e:
+        return Response(str(e), 500)
+    except sqlite3.Error as e:
+        db.rollback()
+        return Response("Nothing was changed: {}".format(e), 500)
+    queue_new_passwords(db, result.new_users)
+    db.commit()
+    if result.new_users:
+        get_mail_worker().wake()
+    for table in result.tables:
+        fragment_cache.bump(table)
+    for user_id in result.user_ids:
+        forget_online_user(user_id)
+    app.logger.info("Bulk admin: {}".format(result))
+    return Response(render_admin_editor(),
+                    headers={"X-Bulk-Stats": str(result)})
 
 
 #   #
@@ -988,6 +1791,7 @@ def edit_profile():
         WHERE   id = :id
     """, data)
     db.commit()
+    fragment_cache.bump('user')
     return Response('Information updated.', 500)
     
 @app.route('/profile/edit_password', methods=['POST'])
@@ -1032,8 +1836,9 @@ def edit_password():
             SET     password = :password
             WHERE   id = :id
         """, id_pw)
-        email_new_password(user['email'], user['name'], id_pw['password'])
+        queue_new_password(db, user['email'], user['name'], id_pw['password'])
         db.commit()
+        get_mail_worker().wake()
     else:
         return Response('No match for that password', 500)
     return Response('Password changed, email sent to {}'.format(user['email']), 500)
@@ -1049,12 +1854,81 @@ def adjustments():
     
 @app.route('/adjustments/search_by_project', methods=['POST'])
 def search_by_project():
-    phases = get_project_phases(request.form['project-id'])
-    time_records = get_time_records_for_phases(phases)
+    """Returns a page of the project's phases, newest first.
+    
+    Posting before=<phase number> gets the next page of older phases.
+    Records are only filled in for the newest phase, the rest come
+    from get_adjustment_records when a phase is expanded.
+    """
+    project_id = request.form['project-id']
+    before = request.form.get('before', type=int)
+    page = get_phase_page(project_id, before)
     return render_template("adjustment_search_results.html",
-                            phases=phases,
-                            time_records=time_records)
+                            project_id=project_id,
+                            phase_choices=get_phase_choices(project_id),
+                            **page)
                             
+@app.route('/adjustments/get_records')
+def get_adjustment_records():
+    """Returns the editable rows for one page of a phase's records,
+    see get_phase_records_page().
+    """
+    phase_id = request.args.get('phase_id', type=int)
+    phase = get_db().execute("""
+        SELECT  project_id
+        FROM    phase
+        WHERE   id = ?
+        """, [phase_id]).fetchone()
+    if phase is None:
+        return Response("No such phase.", 404)
+    records, more = get_phase_records(phase_id,
+                                      request.args.get('after', type=int),
+                                      request.args.get('after_id', type=int))
+    return render_template("adjustment_records.html",
+                            phase_id=phase_id,
+                            records=records,
+                            more=more,
+                            phase_choices=get_phase_choices(phase['project_id']))
+                            
+@app.route('/adjustments/export')
+def export_time_records():
+    """Streams every time record of a project as CSV or NDJSON,
+    oldest first. Timestamps are localtime, like the adjustments page.
+    """
+    project_id = request.args.get('project_id', type=int)
+    fmt = request.args.get('format', 'csv')
+    columns = ['id', 'project_id', 'phase', 'action_item', 'type', 'rate',
+               'start', 'stop', 'minutes']
+    db = get_db()
+    def execute():
+        # time_record_project returns the rows already in order,
+        # so they stream without being sorted first
+        return db.execute("""
+            SELECT  time_record.id,
+                    time_record.project_id,
+                    phase.number AS phase,
+                    action_item.name AS action_item,
+                    item_type.description AS type,
+                    item_rate.description AS rate,
+                    datetime(time_record.start, 'unixepoch', 'localtime') AS start,
+                    datetime(time_record.stop, 'unixepoch', 'localtime') AS stop,
+                    time_record.duration / 60.0 AS minutes
+            FROM    time_record,
+                    phase,
+                    action_item,
+                    item_type,
+                    item_rate
+            WHERE   time_record.project_id = ?
+                    AND phase.id = time_record.phase_id
+                    AND action_item.id = time_record.action_item_id
+                    AND item_type.id = action_item.type_id
+                    AND item_rate.id = action_item.rate_id
+            ORDER BY    time_record.start,
+                        time_record.id
+            """, [project_id])
+    return export_response('project-{}-records'.format(project_id), 
+                           fmt, columns, execute)
+                           
 @app.route('/adjustments/edit_time_records', methods=['POST'])
 def edit_time_records():
     """Allows user to manually modify time_records.
@@ -1062,8 +1936,16 @@ def edit_time_records():
     The timestamps are saved in the database as UTC timestamps during the
     start/stop timing process, but this view needs to convert them to localtime
     in order for manual edits to make any sense. For that reason they are 
-    converted back to UTC before they are saved again.
+    converted back to UTC epoch seconds before they are saved again.
+    
+    The running totals aren't touched here. The change goes to the 
+    totals worker as a Delta, and instead of the whole page only the
+    edited row and the phases it moved between are sent back, as JSON:
     
+        record      id, phase_id, start_key and html of the row
+        phases      id, total and html of each phase. The html is the
+                    phase collapsed, its records load when expanded,
+                    for when the page has to swap in the whole phase.
     """
     data = {}
     for k, v in request.form.iteritems():
@@ -1072,115 +1954,191 @@ def edit_time_records():
         # if they are not, send response to the user.
         if k in ('start', 'stop'):
             try:
-                data[k] = datetime.datetime.strptime(v, "%Y-%m-%d %H:%M:%S")
+                value = datetime.datetime.strptime(v, "%Y-%m-%d %H:%M:%S")
             except ValueError:
                 return Response('\n'.join([
                     "'{}' was not a valid datetime.".format(k.capitalize()),
                     "Valid datetimes are yyyy-mm-dd 24:00:00."
                     ]), 500)
+            # Notice the timestamp converts back to UTC here
+            data[k] = int(time.mktime(value.timetuple()))
             #else:
             #    data[k] = v
     data['id'] = request.form['record-id']
     data['phase_id'] = request.form['phase']
     db = get_db()
-    # Notice the timestamp converts back to UTC here
-    db.execute("""
+    old = db.execute("""
+        SELECT  project_id,
+                phase_id,
+                action_item_id,
+                start,
+                duration,
+                stop
+        FROM    time_record
+        WHERE   id = ?
+        """, [data['id']]).fetchone()
+    if old is None:
+        return Response("No such record.", 404)
+    # a record still being timed is left alone, stop_timing() would
+    # overwrite the edit and count its whole duration again
+    edited = db.execute("""
         UPDATE  time_record
-        SET     start = datetime(:start, 'utc'),
-                stop = datetime(:stop, 'utc'),
+        SET     start = :start,
+                stop = :stop,
+                duration = :stop - :start,
                 phase_id = :phase_id
         WHERE   id = :id
-    """, data)
+                AND NOT EXISTS (
+                    SELECT  1
+                    FROM    active_timer
+                    WHERE   time_record_id = :id
+                )
+    """, data).rowcount
+    if not edited:
+        db.rollback()
+        return Response("This record is still being timed. "
+                        "Stop the timer before editing it.", 500)
+    forget_invoices([old['phase_id'], data['phase_id']])
     db.commit()
-    phases = get_project_phases(request.form['project-id'])
-    time_records = get_time_records_for_phases(phases)
-    return render_template("adjustment_search_results.html",
-                            phases=phases,
-                            time_records=time_records,
-                            last_record_altered=int(data['id']))
+    get_totals_worker().submit(Delta(
+        Contribution(*[old[k] for k in Contribution._fields])
+            if old['stop'] is not None else None,
+        Contribution(old['project_id'], int(data['phase_id']), 
+                     old['action_item_id'], data['start'], 
+                     data['stop'] - data['start'])))
+    phase_choices = get_phase_choices(request.form['project-id'])
+    record = get_time_record(data['id'])
+    phases = get_edited_phases(set([old['phase_id'], record['phase_id']]))
+    return jsonify(
+        record={"id": record['id'],
+                "phase_id": record['phase_id'],
+                "start_key": record['start_key'],
+                "html": render_template("adjustment_records.html",
+                                        records=[record],
+                                        phase_choices=phase_choices,
+                                        last_record_altered=record['id'])},
+        phases=[{"id": phase['id'],
+                 "total": "%.02f" % phase['phase_total'],
+                 "html": render_template("adjustment_phase.html",
+                                         phase=phase,
+                                         time_records={},
+                                         more_records=(),
+                                         phase_choices=phase_choices)}
+                for phase in phases])
                             
 #   #
 #   #   Reports page
 #   #
 
-#####
-#
-#   I must now pay for my sins of rejecting OOP
-#
-#####
-
-ALL_REPORTS = {
-        "Total Time Per Item Type": """
-            SELECT  sum(
-                        strftime('%s', time_record.stop) 
-                        - strftime('%s', time_record.start)
-                    ) 
-                    / 60.0 
-                    AS total, 
-                    item_type.description 
-                    AS description
-            FROM    time_record, 
-                    action_item, 
-                    item_type 
-            WHERE   action_item.id = time_record.action_item_id 
-            AND     action_item.type_id = item_type.id 
-            AND     time_record.start 
-                BETWEEN     datetime(:start, 'utc')
-                AND         datetime(:end, 'utc')
-            GROUP BY    action_item.type_id
-            """
-    }
+#   The reports themselves live in reporting.py, each one declares
+#   its parameters, query and output columns.
                             
 @app.route('/reports')
 def reports():
-    """For now this returns the results of one kind of query.
-    
-    That'll change.
-    """
-    #db = get_db()
-    #results = db.execute("""
-    #    SELECT  sum(strftime('%s', time_record.stop) - strftime('%s', time_record.start)) / 60.0 AS total, 
-    #            item_type.description AS description
-    #    FROM    time_record, 
-    #            action_item, 
-    #            item_type 
-    #    WHERE   action_item.id = time_record.action_item_id 
-    #    AND     action_item.type_id = item_type.id 
-    #    GROUP BY    action_item.type_id
-    #    """)
-    return render_template('reports.html')
+    return render_template('reports.html',
+                            reports=REPORTS.values())
                             
 @app.route('/reports/run_report', methods=['POST'])
 def run_report():
-    data = {}
-    for k, v in request.form.iteritems():
-        if k in ('start', 'end'):
-            try:
-                data[k] = datetime.datetime.strptime(v, "%Y-%m-%d %H:%M:%S")
-            except ValueError:
-                return Response('\n'.join([
-                    "'{}' was not a valid datetime.".format(k.capitalize()),
-                    "Valid datetimes are yyyy-mm-dd 24:00:00."
-                    ]), 500)
+    """Runs the report picked on the form over its date range."""
+    try:
+        report = get_report(request.form.get('report', 'item_type'))
+        values = report.parse(request.form)
+    except ReportError as e:
+        return Response(str(e), 500)
     db = get_db()
-    #results = db.execute("""
-    #    SELECT  sum(strftime('%s', time_record.stop) - strftime('%s', time_record.start)) / 60.0 AS total, 
-    #            item_type.description AS description
-    #    FROM    time_record, 
-    #            action_item, 
-    #            item_type 
-    #    WHERE   action_item.id = time_record.action_item_id 
-    #    AND     action_item.type_id = item_type.id 
-    #    AND     time_record.start 
-    #        BETWEEN     datetime(:start, 'utc')
-    #        AND         datetime(:end, 'utc')
-    #    GROUP BY    action_item.type_id
-    #    """, data)
-    report = ALL_REPORTS['Total Time Per Item Type']
-    results = db.execute(report, data)
+    results = report.run(db, values)
     return render_template('report_results.html',
+                            report=report,
                             results=results)
         
+@app.route('/reports/export')
+def export_report():
+    """Streams the results of a report as CSV or NDJSON. Takes the
+    same parameters as run_report, plus format.
+    """
+    try:
+        report = get_report(request.args.get('report', 'item_type'))
+        values = report.parse(request.args)
+    except ReportError as e:
+        return Response(str(e), 500)
+    db = get_db()
+    return export_response('report-{}'.format(report.slug),
+                           request.args.get('format', 'csv'),
+                           [column.key for column in report.columns],
+                           lambda: report.execute(db, values))
+    
+@app.route('/reports/batch_invoices', methods=['POST'])
+def batch_invoices():
+    """Builds the invoices for many phases at once.
+    
+    Takes either phases, a comma separated list of phase ids, or a
+    start and end date to invoice every phase with time in that range.
+    deliver=zip downloads them as one archive, deliver=email sends 
+    them to the user in one email. How long the batch took goes in 
+    the X-Invoice-Stats header, or the page, and the log.
+    """
+    db = get_db()
+    if request.form.get('phases'):
+        try:
+            phase_ids = [int(p) for p in request.form['phases'].split(',')]
+        except ValueError:
+            return Response("Phases must be a comma separated list of ids.", 
+                            500)
+    else:
+        try:
+            values = parse_range(request.form)
+        except ReportError as e:
+            return Response(str(e), 500)
+        bounds = get_bounds(values)
+        phase_ids = invoicing.get_phases_in_range(db, 
+                                                  bounds['start'], 
+                                                  bounds['end'])
+    if request.form.get('deliver') == 'email':
+        user_email = db.execute("""
+                SELECT  email
+                FROM    user
+                WHERE   id = ?
+            """, [get_online_user()['user_id']]).fetchone()[0]
+        mail, stats = invoicing.run_batch(
+            db, phase_ids,
+            lambda rendered: build_invoice_batch(user_email, rendered))
+        queue_mail(db, *mail)
+        db.commit()
+        get_mail_worker().wake()
+        app.logger.info("Batch invoices: {}".format(stats))
+        return """
+            <div style="background-color:rgb(140, 140, 140)">
+                <h1>Sent {} invoices</h1>
+                <p>{}</p>
+            </div>
+            """.format(stats.invoices, stats)
+    archive, stats = invoicing.run_batch(db, phase_ids)
+    app.logger.info("Batch invoices: {}".format(stats))
+    return Response(archive, 
+                    mimetype='application/zip',
+                    headers={"Content-Disposition":
+                             "attachment; filename=invoices.zip",
+                             "X-Invoice-Stats": str(stats)})
+    
+def export_response(name, fmt, columns, execute):
+    """Returns a streamed download of the rows from execute().
+    See export.py.
+    
+    Rows are written out in batches as they're read from the cursor,
+    so memory use doesn't grow with the size of the export. The 
+    request context (and its pooled connection) stays open until 
+    the last row is sent.
+    """
+    try:
+        mimetype = get_mimetype(fmt)
+    except ExportError as e:
+        return Response(str(e), 500)
+    rows = iter_export(fmt, columns, execute)
+    return Response(stream_with_context(rows), 
+                    mimetype=mimetype,
+                    headers={"Content-Disposition": 
+                             "attachment; filename={}.{}".format(name, fmt)})
     
 
 #
@@ -1190,4 +2148,13 @@ def run_report():
 if __name__ == '__main__':
     with app.app_context():
         init_db()
-    app.run(host='0.0.0.0', debug=True)
\ No newline at end of file
+    # forked before any thread is started
+    invoicing.start_pool(app.config['INVOICE_PROCESSES'])
+    # sends anything left in the outbox from the last run
+    get_mail_worker()
+    app.wsgi_app = ConcurrencyLimit(app.wsgi_app,
+                                    app.config['MAX_REQUESTS'],
+                                    app.config['MAX_STREAMS'],
+                                    STREAM_PATHS)
+    # threaded, since each open timer event stream holds a thread
+    app.run(host='0.0.0.0', debug=True, threaded=True)
\ No newline at end of file
@@ -0,0 +1,9 @@
+/* running totals (in seconds) of closed time records, so views
+   don't have to re-sum every time_record. scope is one of
+   'phase', 'project' or 'action_item'. */
+CREATE TABLE IF NOT EXISTS time_total (
+    scope TEXT,
+    scope_id INTEGER,
+    seconds INTEGER DEFAULT 0,
+    PRIMARY KEY (scope, scope_id)
+);
@@ -0,0 +1,36 @@
+/* indexes for the lookups main.py does on every request.
+   the time_record ones carry start/stop/action_item_id so the
+   phase and report queries can be answered from the index alone. */
+   
+CREATE INDEX time_record_phase 
+    ON time_record (phase_id, start, stop, action_item_id);
+    
+CREATE INDEX time_record_project 
+    ON time_record (project_id, start);
+    
+CREATE INDEX time_record_action_item 
+    ON time_record (action_item_id, start, stop);
+    
+CREATE INDEX time_record_start 
+    ON time_record (start, stop, action_item_id);
+
+CREATE INDEX action_item_project 
+    ON action_item (project_id);
+
+CREATE INDEX phase_project 
+    ON phase (project_id, number);
+
+CREATE INDEX project_user 
+    ON project (user_id, status_id);
+
+CREATE INDEX user_name 
+    ON user (name);
+
+CREATE INDEX online_users_session 
+    ON online_users (session_id);
+
+CREATE INDEX online_users_user 
+    ON online_users (user_id);
+
+CREATE INDEX usergroup_permission_tie_usergroup 
+    ON usergroup_permission_tie (usergroup_id, permission_id);
@@ -0,0 +1,18 @@
+/* outgoing mail, sent by mailer.OutboxWorker instead of inside
+   the request. status is 'queued', 'sent' or 'dead' once it has
+   failed too many times. */
+CREATE TABLE outbox (
+    id INTEGER PRIMARY KEY,
+    sender TEXT,
+    recipients TEXT,
+    message TEXT,
+    status TEXT DEFAULT 'queued',
+    attempts INTEGER DEFAULT 0,
+    next_attempt DATETIME,
+    last_error TEXT,
+    created DATETIME,
+    sent DATETIME
+);
+
+CREATE INDEX outbox_due
+    ON outbox (status, next_attempt);
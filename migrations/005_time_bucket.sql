@@ -0,0 +1,11 @@
+/* closed time records summed per day (UTC, by the day they
+   started) so date range reports don't have to read every
+   time_record. kept up to date with time_total. */
+CREATE TABLE IF NOT EXISTS time_bucket (
+    day DATE,
+    project_id INTEGER,
+    phase_id INTEGER,
+    action_item_id INTEGER,
+    seconds INTEGER DEFAULT 0,
+    PRIMARY KEY (day, project_id, phase_id, action_item_id)
+);
@@ -0,0 +1,58 @@
+/* time_record.start and stop become integer unix epoch seconds (UTC)
+   instead of DATETIME text, with the closed duration stored, so sums
+   are plain integer arithmetic instead of two strftime() calls per
+   row. sqlite can't change a column's type, so the table is rebuilt. */
+CREATE TABLE time_record_epoch (
+    id INTEGER PRIMARY KEY, 
+    action_item_id INTEGER,
+    project_id INTEGER,
+    phase_id INT,
+    start INTEGER,
+    stop INTEGER,
+    duration INTEGER
+);
+
+INSERT INTO time_record_epoch (id, 
+                               action_item_id, 
+                               project_id, 
+                               phase_id, 
+                               start, 
+                               stop, 
+                               duration)
+SELECT  id,
+        action_item_id,
+        project_id,
+        phase_id,
+        CAST(strftime('%s', start) AS INTEGER),
+        CAST(strftime('%s', stop) AS INTEGER),
+        strftime('%s', stop) - strftime('%s', start)
+FROM    time_record;
+
+DROP TABLE time_record;
+
+ALTER TABLE time_record_epoch RENAME TO time_record;
+
+CREATE INDEX time_record_phase 
+    ON time_record (phase_id, start, duration, action_item_id);
+    
+CREATE INDEX time_record_project 
+    ON time_record (project_id, start);
+    
+CREATE INDEX time_record_action_item 
+    ON time_record (action_item_id, start, duration);
+    
+CREATE INDEX time_record_start 
+    ON time_record (start, duration, action_item_id, project_id, phase_id);
+
+/* the buckets are keyed by the epoch second their UTC day starts
+   on. they are rebuilt from time_record on startup. */
+DROP TABLE time_bucket;
+
+CREATE TABLE time_bucket (
+    day INTEGER,
+    project_id INTEGER,
+    phase_id INTEGER,
+    action_item_id INTEGER,
+    seconds INTEGER DEFAULT 0,
+    PRIMARY KEY (day, project_id, phase_id, action_item_id)
+);
@@ -0,0 +1,9 @@
+/* rendered invoices of closed phases, see get_bill_for_phase().
+   input_hash is a sha1 of everything the invoice was built from
+   (line items, rates and office details). */
+CREATE TABLE invoice_snapshot (
+    phase_id INTEGER PRIMARY KEY,
+    input_hash TEXT,
+    html TEXT,
+    created DATETIME
+);
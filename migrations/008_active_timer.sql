@@ -0,0 +1,32 @@
+/* the timers running right now, one per user. timers.TimerRegistry
+   keeps these in memory; this table is its journal, written in the
+   same transaction as the time_record and read back on startup.
+   it replaces online_users.time_record_id, which is no longer used. */
+CREATE TABLE active_timer (
+    user_id INTEGER PRIMARY KEY,
+    time_record_id INTEGER,
+    project_id INTEGER,
+    phase_id INTEGER,
+    action_item_id INTEGER,
+    start INTEGER
+);
+
+INSERT OR IGNORE INTO active_timer (user_id,
+                                    time_record_id,
+                                    project_id,
+                                    phase_id,
+                                    action_item_id,
+                                    start)
+SELECT  online_users.user_id,
+        time_record.id,
+        time_record.project_id,
+        time_record.phase_id,
+        time_record.action_item_id,
+        time_record.start
+FROM    online_users,
+        time_record
+WHERE   time_record.id = online_users.time_record_id
+        AND time_record.stop IS NULL;
+
+UPDATE  online_users
+SET     time_record_id = NULL;
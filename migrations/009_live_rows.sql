@@ -0,0 +1,16 @@
+/* partial indexes over the rows that aren't archived. the open
+   rates, types and project items, and the login lookup, ask for
+   archived = 0, so they only read live rows however many archived
+   ones pile up. */
+
+CREATE INDEX action_item_live
+    ON action_item (project_id) WHERE archived = 0;
+
+CREATE INDEX item_rate_live
+    ON item_rate (id) WHERE archived = 0;
+
+CREATE INDEX item_type_live
+    ON item_type (id) WHERE archived = 0;
+
+CREATE INDEX user_live_name
+    ON user (name) WHERE archived = 0;
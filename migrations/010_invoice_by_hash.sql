@@ -0,0 +1,32 @@
+/* invoice snapshots are stored by input_hash, so a snapshot is
+   written once and never changes, and the same inputs always find
+   the same invoice. phase_invoice points each closed phase at its
+   snapshot; forget_invoices() drops the pointer, not the invoice. */
+ALTER TABLE invoice_snapshot RENAME TO invoice_snapshot_by_phase;
+
+CREATE TABLE invoice_snapshot (
+    input_hash TEXT PRIMARY KEY,
+    html TEXT,
+    created DATETIME
+);
+
+CREATE TABLE phase_invoice (
+    phase_id INTEGER PRIMARY KEY,
+    input_hash TEXT
+);
+
+INSERT OR IGNORE INTO invoice_snapshot (input_hash,
+                                        html,
+                                        created)
+SELECT  input_hash,
+        html,
+        created
+FROM    invoice_snapshot_by_phase;
+
+INSERT INTO phase_invoice (phase_id,
+                           input_hash)
+SELECT  phase_id,
+        input_hash
+FROM    invoice_snapshot_by_phase;
+
+DROP TABLE invoice_snapshot_by_phase;
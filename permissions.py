@@ -0,0 +1,63 @@
+import threading
+
+class PermissionMap(object):
+    """Works out, once, which Flask endpoints each usergroup may use.
+
+    A permission url such as '/admin' grants every route at or below
+    it ('/admin', '/admin/edit_rate', ...). Those are matched against
+    the app's url rules when the map loads, so checking a request is
+    just a set lookup on its endpoint.
+
+    The map loads itself on first use. Call reload() after changing
+    the permission or usergroup_permission_tie tables.
+    """
+
+    def __init__(self):
+        self._endpoints = {}
+        self._pages = {}
+        self._stale = True
+        self._lock = threading.Lock()
+
+    def load(self, db, url_map):
+        rows = db.execute("""
+            -- full scan: loads every group's permissions
+            SELECT  usergroup_permission_tie.usergroup_id,
+                    permission.url
+            FROM    usergroup_permission_tie,
+                    permission
+            WHERE   permission.id = usergroup_permission_tie.permission_id
+            ORDER BY    permission.id
+            """).fetchall()
+        urls = {}
+        for usergroup_id, url in rows:
+            urls.setdefault(usergroup_id, []).append(url)
+        rules = list(url_map.iter_rules())
+        endpoints = {}
+        pages = {}
+        for usergroup_id, group_urls in urls.items():
+            endpoints[usergroup_id] = frozenset(
+                rule.endpoint for rule in rules
+                if any(rule.rule == url or rule.rule.startswith(url + '/')
+                       for url in group_urls))
+            # the navigation links are the top level page for each url
+            pages[usergroup_id] = [url[1:] for url in group_urls]
+        with self._lock:
+            self._endpoints = endpoints
+            self._pages = pages
+            self._stale = False
+
+    def reload(self):
+        """Marks the map to be loaded again. Until then the old
+        map keeps answering, so requests in flight aren't affected.
+        """
+        with self._lock:
+            self._stale = True
+
+    def is_loaded(self):
+        return not self._stale
+
+    def allows(self, usergroup_id, endpoint):
+        return endpoint in self._endpoints.get(usergroup_id, ())
+
+    def pages(self, usergroup_id):
+        return self._pages.get(usergroup_id, [])
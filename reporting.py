@@ -0,0 +1,259 @@
+import datetime
+import time
+from collections import OrderedDict
+
+# every report takes a date range. the form's date inputs only send
+# a date, so an end date covers the whole of that day.
+DATE_FORMATS = ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d")
+
+class ReportError(ValueError):
+    """Raised for bad report names or parameters. The message is
+    meant to be shown to the user.
+    """
+
+class Column(object):
+    """One column of report output.
+
+    kind says how to show it: 'text', 'minutes' or 'money'.
+    """
+
+    def __init__(self, key, label, kind='text'):
+        self.key = key
+        self.label = label
+        self.kind = kind
+
+class Report(object):
+    """A named, parameterized report.
+
+    sql is a constant statement using the parameters from
+    get_bounds(). Since the text never changes, each pooled connection
+    prepares it once and reuses it from sqlite3's statement cache on
+    every later run.
+    """
+
+    params = ('start', 'end')
+
+    def __init__(self, slug, name, sql, columns):
+        self.slug = slug
+        self.name = name
+        self.sql = sql
+        self.columns = columns
+
+    def parse(self, form):
+        """Returns the query parameters from the submitted form."""
+        return parse_range(form, self.params)
+
+    def execute(self, db, values):
+        """Runs the report and returns the cursor."""
+        return db.execute(self.sql, get_bounds(values))
+
+    def run(self, db, values):
+        return self.execute(db, values).fetchall()
+
+def parse_range(form, params=('start', 'end')):
+    """Returns the start and end datetimes from a submitted form."""
+    values = {}
+    for param in params:
+        value = form.get(param, '')
+        values[param] = parse_datetime(param, value)
+        if param == 'end' and len(value) == len('yyyy-mm-dd'):
+            values[param] += datetime.timedelta(days=1, seconds=-1)
+    return values
+
+def parse_datetime(name, value):
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, date_format)
+        except ValueError:
+            pass
+    raise ReportError('\n'.join([
+        "'{}' was not a valid datetime.".format(name.capitalize()),
+        "Valid datetimes are yyyy-mm-dd or yyyy-mm-dd 24:00:00."
+        ]))
+
+DAY = 86400
+
+def to_epoch(value):
+    """Converts a naive localtime datetime to UTC epoch seconds."""
+    return int(time.mktime(value.timetuple()))
+
+def get_bounds(values):
+    """Splits the report's localtime range into the UTC epoch
+    parameters used by TIME_IN_RANGE.
+
+    first_day and last_day bound the whole days in the range, which
+    are read from time_bucket. Records starting between start and
+    first_day, or between last_day and end, are read from time_record.
+    end is exclusive here. If the range has no whole day in it,
+    first_day and last_day are both end, and everything is read
+    from time_record.
+    """
+    start = to_epoch(values['start'])
+    end = to_epoch(values['end']) + 1
+    first_day = -(-start // DAY) * DAY
+    last_day = end // DAY * DAY
+    if first_day >= last_day:
+        first_day = last_day = end
+    return dict(values, 
+                start=start, 
+                first_day=first_day, 
+                last_day=last_day, 
+                end=end)
+
+REPORTS = OrderedDict()
+
+def register(report):
+    REPORTS[report.slug] = report
+    return report
+
+def get_report(slug):
+    try:
+        return REPORTS[slug]
+    except KeyError:
+        raise ReportError("No such report: {}".format(slug))
+
+# the closed time, in minutes, of records that started in the range.
+# whole days come from the daily buckets, the partial days at either
+# end from the records themselves. every report groups these.
+TIME_IN_RANGE = """
+            SELECT  project_id,
+                    phase_id,
+                    action_item_id,
+                    seconds / 60.0 AS minutes
+            FROM    time_bucket
+            WHERE   day >= :first_day
+                    AND day < :last_day
+            UNION ALL
+            SELECT  project_id,
+                    phase_id,
+                    action_item_id,
+                    duration / 60.0
+            FROM    time_record
+            WHERE   start >= :start
+                    AND start < :first_day
+                    AND duration IS NOT NULL
+            UNION ALL
+            SELECT  project_id,
+                    phase_id,
+                    action_item_id,
+                    duration / 60.0
+            FROM    time_record
+            WHERE   start >= :last_day
+                    AND start < :end
+                    AND duration IS NOT NULL
+"""
+
+register(Report(
+    'item_type',
+    "Total Time Per Item Type",
+    """
+    WITH    records AS ({})
+    SELECT  item_type.description AS description,
+            sum(records.minutes) AS total
+    FROM    records,
+            action_item,
+            item_type
+    WHERE   action_item.id = records.action_item_id
+            AND item_type.id = action_item.type_id
+    GROUP BY    item_type.id
+    ORDER BY    item_type.description
+    """.format(TIME_IN_RANGE),
+    [Column('description', "Item Type"),
+     Column('total', "Total Time (Minutes)", 'minutes')]))
+
+register(Report(
+    'user',
+    "Total Time Per User",
+    """
+    WITH    records AS ({})
+    SELECT  user.name AS name,
+            sum(records.minutes) AS total
+    FROM    records,
+            project,
+            user
+    WHERE   project.id = records.project_id
+            AND user.id = project.user_id
+    GROUP BY    user.id
+    ORDER BY    user.name
+    """.format(TIME_IN_RANGE),
+    [Column('name', "User"),
+     Column('total', "Total Time (Minutes)", 'minutes')]))
+
+register(Report(
+    'project',
+    "Total Time Per Project",
+    """
+    WITH    records AS ({})
+    SELECT  project.id AS id,
+            project.description AS description,
+            sum(records.minutes) AS total
+    FROM    records,
+            project
+    WHERE   project.id = records.project_id
+    GROUP BY    project.id
+    ORDER BY    project.id
+    """.format(TIME_IN_RANGE),
+    [Column('id', "Project Number"),
+     Column('description', "Project"),
+     Column('total', "Total Time (Minutes)", 'minutes')]))
+
+register(Report(
+    'rate',
+    "Total Time and Fees Per Rate",
+    """
+    WITH    records AS ({})
+    SELECT  item_rate.description AS description,
+            sum(records.minutes) AS total,
+            sum(records.minutes) * item_rate.fee_per_hour / 60.0 AS money
+    FROM    records,
+            action_item,
+            item_rate
+    WHERE   action_item.id = records.action_item_id
+            AND item_rate.id = action_item.rate_id
+    GROUP BY    item_rate.id
+    ORDER BY    item_rate.description
+    """.format(TIME_IN_RANGE),
+    [Column('description', "Rate"),
+     Column('total', "Total Time (Minutes)", 'minutes'),
+     Column('money', "Fees", 'money')]))
+
+register(Report(
+    'phase',
+    "Total Time Per Phase",
+    """
+    WITH    records AS ({})
+    SELECT  project.id AS project_id,
+            project.description AS description,
+            phase.number AS number,
+            sum(records.minutes) AS total
+    FROM    records,
+            phase,
+            project
+    WHERE   phase.id = records.phase_id
+            AND project.id = phase.project_id
+    GROUP BY    phase.id
+    ORDER BY    project.id,
+                phase.number
+    """.format(TIME_IN_RANGE),
+    [Column('project_id', "Project Number"),
+     Column('description', "Project"),
+     Column('number', "Phase"),
+     Column('total', "Total Time (Minutes)", 'minutes')]))
+
+register(Report(
+    'status',
+    "Total Time Per Project Status",
+    """
+    WITH    records AS ({})
+    SELECT  project_status.description AS description,
+            sum(records.minutes) AS total
+    FROM    records,
+            project,
+            project_status
+    WHERE   project.id = records.project_id
+            AND project_status.id = project.status_id
+    GROUP BY    project_status.id
+    ORDER BY    project_status.description
+    """.format(TIME_IN_RANGE),
+    [Column('description', "Status"),
+     Column('total', "Total Time (Minutes)", 'minutes')]))
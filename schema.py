@@ -0,0 +1,165 @@
+import ast
+import os
+import re
+import sqlite3
+
+# db.sql is the original schema and always counts as version 1.
+# every later change goes in migrations/ as NNN_description.sql
+BASELINE = 'db.sql'
+MIGRATIONS_DIR = 'migrations'
+
+# tables that are always read in full (the lookup tables and the
+# admin user list), or only ever hold a row per running timer, a 
+# table scan on these is expected
+SCAN_OK = ('item_rate', 'item_type', 'usergroup', 'project_status',
+           'permission', 'schema_version', 'user', 'active_timer')
+
+# statements that are meant to read a whole table, like rebuilding the
+# running totals, start with this comment and aren't checked
+FULL_SCAN = '-- full scan'
+
+def get_migrations(root_path):
+    """Returns a sorted list of (version, name, path) for the baseline
+    schema and every file in the migrations directory.
+    """
+    migrations = [(1, 'baseline', os.path.join(root_path, BASELINE))]
+    folder = os.path.join(root_path, MIGRATIONS_DIR)
+    for filename in os.listdir(folder):
+        match = re.match(r'(\d+)_(\w+)\.sql$', filename)
+        if match:
+            migrations.append((int(match.group(1)),
+                               match.group(2),
+                               os.path.join(folder, filename)))
+    migrations.sort()
+    return migrations
+
+def get_applied_versions(db):
+    """Returns the set of migration versions already run on the db.
+
+    Databases made before migrations existed were set up by running
+    db.sql directly, so if the original tables are there but there's
+    no schema_version table, the baseline is recorded as applied.
+    """
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name TEXT,
+            applied DATETIME
+        )
+        """)
+    applied = set(row[0] for row in db.execute("""
+        SELECT  version
+        FROM    schema_version
+        """))
+    if not applied:
+        legacy = db.execute("""
+            SELECT  count(*)
+            FROM    sqlite_master
+            WHERE   type = 'table'
+                    AND name = 'time_record'
+            """).fetchone()[0]
+        if legacy:
+            db.execute("""
+                INSERT INTO schema_version (version,
+                                            name,
+                                            applied)
+                VALUES  (1,
+                        'baseline',
+                        datetime('now'))
+                """)
+            db.commit()
+            applied.add(1)
+    return applied
+
+def migrate(db, root_path):
+    """Runs every migration that hasn't been applied yet, in order.
+
+    Each migration runs in its own transaction together with the
+    schema_version insert, so a broken migration is rolled back
+    entirely and raises instead of being half-applied.
+
+    Returns the list of versions that were applied.
+    """
+    applied = get_applied_versions(db)
+    ran = []
+    for version, name, path in get_migrations(root_path):
+        if version in applied:
+            continue
+        with open(path) as f:
+            script = f.read()
+        try:
+            db.executescript("""
+                BEGIN;
+                {}
+                ;
+                INSERT INTO schema_version (version, name, applied)
+                VALUES ({}, '{}', datetime('now'));
+                COMMIT;
+                """.format(script, version, name))
+        except sqlite3.Error:
+            # executescript doesn't tell the connection it's in a
+            # transaction, so db.rollback() would be a no-op here
+            try:
+                db.execute("ROLLBACK")
+            except sqlite3.OperationalError:
+                pass
+            raise
+        ran.append(version)
+    return ran
+
+def get_queries(source_path):
+    """Pulls every SQL statement out of the string literals in a
+    python source file.
+
+    "IN ({})" lists to be filled in by str.format() are planned with
+    NULL. Statements that format in anything else, a table name, named
+    values or a whole subquery, can't be planned from their source
+    and are left out, and so are the ones marked with FULL_SCAN.
+    """
+    with open(source_path) as f:
+        tree = ast.parse(f.read())
+    queries = []
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Str):
+            continue
+        sql = node.s.strip()
+        if sql.startswith(FULL_SCAN):
+            continue
+        if not re.match(r'(SELECT|INSERT|UPDATE|DELETE|WITH)\s', sql, re.I):
+            continue
+        sql = sql.replace('IN ({})', 'IN (NULL)')
+        if re.search(r'\{\w*\}', sql):
+            continue
+        queries.append(sql)
+    return queries
+
+def get_unindexed_queries(db, queries):
+    """Runs EXPLAIN QUERY PLAN over the queries and returns a list of
+    (query, plan detail) for every full table scan, apart from the
+    tables in SCAN_OK. Scans of CTEs and subqueries are fine, they
+    are only as big as whatever was searched to build them.
+    """
+    tables = set(row[0] for row in db.execute("""
+        SELECT  name
+        FROM    sqlite_master
+        WHERE   type = 'table'
+        """))
+    unindexed = []
+    for sql in queries:
+        if '?' in sql:
+            params = [None] * sql.count('?')
+        else:
+            params = dict((name, None) for name in re.findall(r':(\w+)', sql))
+        try:
+            plan = db.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+        except Exception as e:
+            unindexed.append((sql, 'could not plan: {}'.format(e)))
+            continue
+        for row in plan:
+            detail = row[-1]
+            match = re.match(r'SCAN (?:TABLE )?(\w+)', detail)
+            if (match and 'INDEX' not in detail
+                    and match.group(1) in tables
+                    and match.group(1) not in SCAN_OK):
+                unindexed.append((sql, detail))
+    return unindexed
@@ -15,6 +15,50 @@ $(document).ready(function(){
         return false;
     });
     
+    var $results = $('#adjustment_search_results', $main);
+    
+    /* phases come a page at a time, and a collapsed phase only
+       fetches its records the first time it's expanded */
+    $results.on('click', '.shutter', function(){
+        var $this = $(this);
+        $this.siblings().toggle();
+        $this.toggleClass('closed');
+        var $records = $this.siblings('.indent')
+                            .find('tbody.records[data-unloaded]');
+        if ($records.length) {
+            $records.removeAttr('data-unloaded');
+            $.ajax({
+                url: $records.attr('data-url')
+            }).success(function(data){
+                $records.html(data);
+            });
+        }
+    });
+    
+    $results.on('click', '.more-records', function(){
+        var $this = $(this);
+        $.ajax({
+            url: $this.attr('data-url')
+        }).success(function(data){
+            $this.replaceWith(data);
+        });
+    });
+    
+    $results.on('click', '.older-phases', function(){
+        var $this = $(this);
+        $.ajax({
+            method: 'post',
+            url: $this.attr('formaction'),
+            data: {
+                "project-id": $this.attr('data-project-id'),
+                "before": $this.attr('data-before')
+            }
+        }).success(function(data){
+            $this.replaceWith(data);
+        });
+        return false;
+    });
+    
     /* sends any changes to a row back to the db to auto-update */
     $('#adjustment_search_results', $main).on('change', 
                                               'input, select', 
@@ -35,7 +79,43 @@ $(document).ready(function(){
             method: "post",
             data: fdata
         }).success(function(data){
-            $('#adjustment_search_results').html(data);
-        })
+            var record = data.record;
+            $('tr[data-record-id=' + record.id + ']', $results).remove();
+            $('tr.last-altered', $results).removeClass('last-altered');
+            
+            //a phase that still has its table only needs its total.
+            //the rest are swapped for the collapsed phase
+            $.each(data.phases, function(i, phase){
+                var $phase = $('.phase-view[data-phase-id=' + phase.id + ']',
+                               $results);
+                if ($phase.find('table').length && Number(phase.total)) {
+                    $('.phase-total', $phase).text(phase.total);
+                } else {
+                    $phase.replaceWith(phase.html);
+                }
+            });
+            
+            //the row goes where it falls in start order, if that's in
+            //the records already loaded. otherwise it comes with a later
+            //page, or when the phase is expanded
+            var $records = $('.phase-view[data-phase-id=' + record.phase_id + 
+                             '] tbody.records', $results)
+                                .not('[data-unloaded]');
+            if (!$records.length) {
+                return;
+            }
+            var $after = $records.children('tr[data-record-id]').filter(
+                function(){
+                    var key = Number($(this).attr('data-start-key'));
+                    return key > record.start_key || 
+                           (key == record.start_key && 
+                            Number($(this).attr('data-record-id')) > record.id);
+                }).first();
+            if ($after.length) {
+                $after.before(record.html);
+            } else if (!$records.children('.more-records').length) {
+                $records.append(record.html);
+            }
+        });
     });
 });
\ No newline at end of file
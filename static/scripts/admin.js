@@ -57,17 +57,47 @@ $(document).ready(function(){
         $this.addClass("selected");
     });
     
-    /* buttons */
+    /*
+        buttons. the server answers with just the changed rows if it
+        can, see admin_patch() in main.py, or else the whole editor
+    */
     $admin.on('click', 'button', function(){
         var $this = $(this);
         var $parent = $this.parent();
+        var $table = $parent.siblings('table');
         var fdata = $parent.serializeArray();
         $.ajax({
             method: 'post',
             url: $this.attr("formaction"),
-            data: fdata
+            data: fdata,
+            headers: {'X-Table-Version': $table.attr('data-version')}
+        }).success(function(data){
+            if (typeof data === 'string') {
+                $parent.parent().empty().append(data);
+                return;
+            }
+            $.each(data.rows, function(index, row){
+                var $row = $('tr[data-id=' + row.id + ']', $table);
+                if ($row.length) {
+                    $row.replaceWith(row.html);
+                } else {
+                    $table.append(row.html);
+                }
+            });
+            $table.attr('data-version', data.version);
+        });
+        return false;
+    });
+    
+    /* bulk changes come back as all three editors at once */
+    $('#admin-bulk').on('click', 'button', function(){
+        var $this = $(this);
+        $.ajax({
+            method: 'post',
+            url: $this.attr("formaction"),
+            data: $this.parent().serializeArray()
         }).success(function(data){
-            $parent.parent().empty().append(data);
+            $admin.empty().append(data);
         });
         return false;
     });
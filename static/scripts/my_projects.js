@@ -82,6 +82,79 @@ $(document).ready(function(){
     
     
     
+    /**
+     * Shows the running timer, if there is one. The server answers
+     * 204 when there's nothing being timed.
+     */
+    function show_timer() {
+        $.ajax({
+            url: 'my_projects/currently_timing'
+        }).success(function(data, status, xhr){
+            if (xhr.status === 200) {
+                $("#action_items .content").html(data);
+                show_elapsed();
+            }
+        });
+    }
+    
+    
+    /**
+     * The elapsed time is counted here, against the server's clock,
+     * rather than asked for.
+     */
+    var clock_offset = 0;
+    
+    function pad(n) {
+        return n < 10 ? '0' + n : '' + n;
+    }
+    
+    function show_elapsed() {
+        var $elapsed = $('#currently-timing .elapsed');
+        if (!$elapsed.length) {
+            return;
+        }
+        var now = Date.now() / 1000 + clock_offset;
+        var seconds = Math.max(0, Math.floor(now - $elapsed.attr('data-start')));
+        $elapsed.text('(' + Math.floor(seconds / 3600) + ':' + 
+                      pad(Math.floor(seconds % 3600 / 60)) + ':' + 
+                      pad(seconds % 60) + ')');
+    }
+    setInterval(show_elapsed, 1000);
+    
+    
+    /**
+     * Timer starts and stops are pushed from the server, see
+     * timer_events() in main.py, so a timer started or stopped in
+     * another tab shows up here without polling. Browsers without
+     * EventSource just get the timer once, on page load.
+     */
+    function on_timer_started(e) {
+        var data = JSON.parse(e.data);
+        clock_offset = data.now - Date.now() / 1000;
+        if (data.item_id !== undefined && !$('#currently-timing').length) {
+            show_timer();
+        }
+    }
+    
+    if (window.EventSource) {
+        var timer_events = new EventSource('my_projects/timer_events');
+        timer_events.addEventListener('timer_state', on_timer_started);
+        timer_events.addEventListener('timer_started', on_timer_started);
+        timer_events.addEventListener('timer_stopped', function(e){
+            var data = JSON.parse(e.data);
+            $('#projects tr[data-row=' + data.project_id + '] .project-total')
+                .text((data.totals.project / 60).toFixed(2));
+            //stopped somewhere else, reload the project to catch up.
+            //if it was stopped here, the click handler does that
+            if ($('#currently-timing:not(.stopping)').length) {
+                $('#projects tr.selected').click();
+            }
+        });
+    } else {
+        show_timer();
+    }
+    
+    
     /**
      * Handlers for expanded project view.
      * These only work if you do not dynamically reload #expanded-project.
@@ -96,6 +169,45 @@ $(document).ready(function(){
     });
     
     
+    /**
+     * Phases and their records come a page at a time. A collapsed
+     * phase only fetches its records the first time it's expanded.
+     */
+    $exp_proj.on('click', ".phase-view .shutter", function(e){
+        var $records = $(this).siblings('.indent')
+                              .find('tbody.records[data-unloaded]');
+        if ($records.length) {
+            $records.removeAttr('data-unloaded');
+            $.ajax({
+                url: $records.attr('data-url')
+            }).success(function(data){
+                $records.html(data);
+            });
+        }
+    });
+    
+    
+    $exp_proj.on('click', ".more-records", function(e){
+        var $this = $(this);
+        $.ajax({
+            url: $this.attr('data-url')
+        }).success(function(data){
+            $this.replaceWith(data);
+        });
+    });
+    
+    
+    $exp_proj.on('click', ".older-phases", function(e){
+        var $this = $(this);
+        $.ajax({
+            url: $this.attr('formaction')
+        }).success(function(data){
+            $this.replaceWith(data);
+        });
+        return false;
+    });
+    
+    
     $exp_proj.on('click', '#action_items div.content tr', function(){
         var $this = $(this);
         var data_id = $this.attr('data-id');
@@ -206,6 +318,7 @@ $(document).ready(function(){
         //...yeah, I wish I'd just updated the view based on 
         // a state object too, but it's too late to go back now
         if ($this.attr('value') === 'Stop Timing') {
+            $('#currently-timing').addClass('stopping');
             $.ajax({
                 url: 'my_projects/get_phases'
             }).success(function(data){
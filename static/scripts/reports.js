@@ -3,9 +3,13 @@
  */
 
 $(document).ready(function(){
-    $('button[type=submit]').on('click', function(){
+    // export buttons submit normally so the browser downloads the file
+    $('button[type=submit]:not(.export)').on('click', function(){
         var $this = $(this);
         var fdata = $this.parent().serializeArray();
+        if ($this.attr('name')) {
+            fdata.push({name: $this.attr('name'), value: $this.val()});
+        }
         $.ajax({
            method: 'post',
            url: $(this).attr('formaction'),
@@ -0,0 +1,174 @@
+"""invoicing.get_invoices() against the per phase queries and Python
+sums render_bill() used before it.
+
+    python -m unittest discover tests
+
+Line item dates aren't compared, the old query took whichever
+record's date sqlite picked.
+"""
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import invoicing
+from benchmarks import synthetic
+
+# render_bill()'s queries before invoicing.INVOICE_SQL
+OLD_INVOICE_SQL = """
+    SELECT  a.name,
+            a.phase_id,
+            a.type,
+            a.date,
+            a.time_total,
+            (item_rate.fee_per_hour / 60.0 )* a.time_total AS money_total
+    FROM    item_rate,
+            (SELECT action_item.name,
+                    action_item.rate_id,
+                    (SELECT description
+                    FROM    item_type
+                    WHERE   item_type.id = action_item.type_id) AS type,
+                    time_record.phase_id,
+                    date(time_record.start, 'unixepoch') AS date,
+            sum(time_record.duration) / 60.0 AS time_total
+            FROM    action_item,
+                    time_record
+            WHERE   action_item.id = time_record.action_item_id
+                    AND time_record.phase_id = ?
+            GROUP BY    action_item.id
+        ) AS a
+    WHERE   a.rate_id = item_rate.id
+"""
+
+OLD_OFFICE_SQL = """
+    SELECT  office_serial AS serial,
+            tt_number
+    FROM    project
+    WHERE   project.id = (
+                SELECT  project_id
+                FROM    phase
+                WHERE   phase.id = ?
+            )
+"""
+
+def old_invoice(db, phase_id):
+    invoice = db.execute(OLD_INVOICE_SQL, [phase_id]).fetchall()
+    office = db.execute(OLD_OFFICE_SQL, [phase_id]).fetchone()
+    grand_totals = {
+        'time': sum(x['time_total'] for x in invoice),
+        'money': sum(y['money_total'] for y in invoice)
+    }
+    return invoice, office, grand_totals
+
+def close(a, b):
+    return abs((a or 0) - (b or 0)) < 1e-6
+
+def subtotals(lines, key):
+    totals = {}
+    for line in lines:
+        time_total, money_total = totals.get(line[key], (0, 0))
+        totals[line[key]] = (time_total + line['time_total'],
+                             money_total + line['money_total'])
+    return totals
+
+def compare(old, new):
+    """Returns a list of the ways the new invoice differs."""
+    lines, office, grand_totals = old
+    problems = []
+    if len(lines) != len(new['invoice']):
+        problems.append('{} lines, expected {}'.format(
+            len(new['invoice']), len(lines)))
+    old_lines = sorted((l['name'], l['type'], l['time_total'],
+                        l['money_total']) for l in lines)
+    new_lines = sorted((l['name'], l['type'], l['time_total'],
+                        l['money_total']) for l in new['invoice'])
+    for a, b in zip(old_lines, new_lines):
+        if a[:2] != b[:2] or not close(a[2], b[2]) or not close(a[3], b[3]):
+            problems.append('line {} != {}'.format(b, a))
+    for key, name in (('type', 'type_totals'), ('rate', 'rate_totals')):
+        expected = subtotals(new['invoice'], key)
+        got = dict((t[key], (t['time_total'], t['money_total']))
+                   for t in new[name])
+        if sorted(expected) != sorted(got) or not all(
+                close(expected[k][0], got[k][0])
+                and close(expected[k][1], got[k][1]) for k in expected):
+            problems.append('{} {} != {}'.format(name, got, expected))
+    for key in ('time', 'money'):
+        if not close(grand_totals[key], new['grand_totals'][key]):
+            problems.append('grand total {} {} != {}'.format(
+                key, new['grand_totals'][key], grand_totals[key]))
+    if office is not None and (
+            unicode(office['serial']) != unicode(new['office']['serial']) or
+            unicode(office['tt_number'] or '')
+            != unicode(new['office']['tt_number'] or '')):
+        problems.append('office {} != {}'.format(
+            new['office'], tuple(office)))
+    return problems
+
+class InvoiceTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        path = os.path.join(cls.directory, 'invoicing.db')
+        synthetic.build(path, users=3, projects_per_user=3, records=3000)
+        cls.db = sqlite3.connect(path)
+        cls.db.row_factory = sqlite3.Row
+        # a phase nothing has been timed in yet
+        cls.db.execute("""
+            INSERT INTO phase (project_id, number)
+            SELECT  project_id,
+                    max(number) + 1
+            FROM    phase
+            """)
+        cls.db.commit()
+        cls.phase_ids = [row[0] for row in cls.db.execute(
+            "SELECT id FROM phase ORDER BY id")]
+        cls.old = dict((phase_id, old_invoice(cls.db, phase_id))
+                       for phase_id in cls.phase_ids)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.db.close()
+        shutil.rmtree(cls.directory)
+
+    def assertSameInvoice(self, phase_id, new):
+        self.assertEqual(compare(self.old[phase_id], new), [],
+                         'phase {}'.format(phase_id))
+
+    def test_per_phase(self):
+        for phase_id in self.phase_ids:
+            self.assertSameInvoice(
+                phase_id, invoicing.get_invoice(self.db, [phase_id]))
+
+    def test_batch(self):
+        invoices = invoicing.get_invoices(self.db, self.phase_ids)
+        self.assertEqual(sorted(i['phase_id'] for i in invoices),
+                         self.phase_ids)
+        for invoice in invoices:
+            self.assertSameInvoice(invoice['phase_id'], invoice)
+
+    def test_combined_adds_up(self):
+        combined = invoicing.get_invoice(self.db, self.phase_ids)
+        for key in ('time', 'money'):
+            self.assertAlmostEqual(
+                combined['grand_totals'][key],
+                sum(old[2][key] for old in self.old.values()), places=3)
+
+    def test_phase_without_time(self):
+        phase_id = self.phase_ids[-1]
+        batch = dict((i['phase_id'], i) for i in
+                     invoicing.get_invoices(self.db, self.phase_ids))
+        for invoice in (invoicing.get_invoice(self.db, [phase_id]),
+                        batch[phase_id]):
+            self.assertEqual(invoice['invoice'], [])
+            self.assertEqual(invoice['grand_totals'],
+                             {"time": 0, "money": 0})
+
+    def test_unknown_phase(self):
+        self.assertIsNone(invoicing.get_invoice(self.db, [-1]))
+        self.assertEqual(invoicing.get_invoices(self.db, [-1, -2]), [])
+
+if __name__ == '__main__':
+    unittest.main()
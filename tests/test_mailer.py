@@ -0,0 +1,155 @@
+"""OutboxWorker against a fake smtplib.SMTP.
+
+    python -m unittest discover tests
+"""
+import logging
+import os
+import smtplib
+import sqlite3
+import unittest
+
+import mailer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class FakeSMTP(object):
+    """Stands in for smtplib.SMTP. Sending to an address in refuse
+    raises the exception mapped to it.
+    """
+
+    def __init__(self):
+        self.connections = 0
+        self.sent = []
+        self.refuse = {}
+
+    def __call__(self, host):
+        self.connections += 1
+        return self
+
+    def sendmail(self, sender, recipients, message):
+        for recipient in recipients:
+            if recipient in self.refuse:
+                raise self.refuse[recipient]
+        self.sent.append((sender, recipients, message))
+
+    def quit(self):
+        pass
+
+class RollbackCounter(sqlite3.Connection):
+    rollbacks = 0
+
+    def rollback(self):
+        self.rollbacks += 1
+        return super(RollbackCounter, self).rollback()
+
+class OutboxWorkerTest(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.db = sqlite3.connect(':memory:')
+        with open(os.path.join(ROOT, 'migrations', '004_outbox.sql')) as f:
+            self.db.executescript(f.read())
+        self.smtp = FakeSMTP()
+        self.worker = mailer.OutboxWorker(None, 'localhost', batch_size=2,
+                                          max_attempts=3, retry_delay=60,
+                                          smtp=self.smtp)
+
+    def tearDown(self):
+        self.db.close()
+        logging.disable(logging.NOTSET)
+
+    def queue(self, recipient):
+        mailer.queue_mail(self.db, 'me@example.com', [recipient], 'Hello')
+        self.db.commit()
+
+    def row(self):
+        return self.db.execute("""
+            SELECT  status,
+                    attempts,
+                    last_error,
+                    (julianday(next_attempt) - julianday('now')) * 86400
+            FROM    outbox
+            """).fetchone()
+
+    def make_due(self):
+        self.db.execute("UPDATE outbox SET next_attempt = datetime('now')")
+        self.db.commit()
+
+    def test_sent(self):
+        for i in range(5):
+            self.queue('you{}@example.com'.format(i))
+        self.assertEqual(self.worker.drain(self.db), 5)
+        self.assertEqual(len(self.smtp.sent), 5)
+        # every batch goes over the one connection
+        self.assertEqual(self.smtp.connections, 1)
+        self.assertEqual(self.db.execute("""
+            SELECT  count(*)
+            FROM    outbox
+            WHERE   status = 'sent'
+                    AND attempts = 1
+            """).fetchone()[0], 5)
+        self.assertEqual(self.worker.drain(self.db), 0)
+
+    def test_retry_backoff(self):
+        self.smtp.refuse['you@example.com'] = smtplib.SMTPException('busy')
+        self.queue('you@example.com')
+        self.assertEqual(self.worker.drain(self.db), 0)
+        status, attempts, error, delay = self.row()
+        self.assertEqual((status, attempts, error), ('queued', 1, 'busy'))
+        self.assertAlmostEqual(delay, 60, delta=2)
+        # not due yet, so not tried again
+        self.worker.drain(self.db)
+        self.assertEqual(self.row()[1], 1)
+
+        self.make_due()
+        self.worker.drain(self.db)
+        status, attempts, error, delay = self.row()
+        self.assertEqual((status, attempts), ('queued', 2))
+        self.assertAlmostEqual(delay, 120, delta=2)
+
+        del self.smtp.refuse['you@example.com']
+        self.make_due()
+        self.assertEqual(self.worker.drain(self.db), 1)
+        self.assertEqual(self.row()[:2], ('sent', 3))
+
+    def test_dead(self):
+        self.smtp.refuse['you@example.com'] = IOError('connection reset')
+        self.queue('you@example.com')
+        for i in range(3):
+            self.make_due()
+            self.worker.drain(self.db)
+        self.assertEqual(self.row()[:2], ('dead', 3))
+        self.make_due()
+        self.worker.drain(self.db)
+        self.assertEqual(self.row()[:2], ('dead', 3))
+
+    def test_any_error_fails_the_message(self):
+        self.smtp.refuse['bad@example.com'] = ValueError('bad address')
+        self.queue('bad@example.com')
+        self.queue('good@example.com')
+        self.assertEqual(self.worker.drain(self.db), 1)
+        self.assertEqual(self.db.execute("""
+            SELECT  status,
+                    attempts,
+                    last_error
+            FROM    outbox
+            ORDER BY    id
+            """).fetchall(), [('queued', 1, 'bad address'),
+                              ('sent', 1, None)])
+
+    def test_run_rolls_back_a_failed_drain(self):
+        connections = []
+        def connect():
+            db = sqlite3.connect(':memory:', factory=RollbackCounter)
+            connections.append(db)
+            return db
+        class Failing(mailer.OutboxWorker):
+            def drain(self, db):
+                self.stop()
+                raise RuntimeError('disk I/O error')
+        worker = Failing(connect, 'localhost', smtp=self.smtp)
+        worker.run()
+        self.assertEqual(connections[0].rollbacks, 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+"""Migrations and the query plan check, over the real schema.
+
+    python -m unittest discover tests
+"""
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import main
+import schema
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class QueryPlanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = sqlite3.connect(':memory:')
+        schema.migrate(self.db, ROOT)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.directory)
+
+    def get_queries(self, source):
+        path = os.path.join(self.directory, 'source.py')
+        with open(path, 'w') as f:
+            f.write(source)
+        return schema.get_queries(path)
+
+    def test_migrate_twice(self):
+        self.assertEqual(schema.migrate(self.db, ROOT), [])
+
+    def test_app_queries_are_indexed(self):
+        queries = main.get_app_queries()
+        for module in ('reporting', 'invoicing', 'aggregation', 'mailer',
+                       'timers', 'permissions', 'bulk'):
+            self.assertIn(module + '.py', main.SQL_MODULES)
+        self.assertEqual(schema.get_unindexed_queries(self.db, queries), [])
+
+    def test_reports_are_planned_as_built(self):
+        queries = main.get_app_queries()
+        for report in main.REPORTS.values():
+            self.assertIn(report.sql, queries)
+        self.assertFalse([sql for sql in queries if '({})' in sql
+                          or 'AS (NULL)' in sql])
+
+    def test_formatted_statements(self):
+        queries = self.get_queries('\n'.join([
+            'a = "SELECT id FROM phase WHERE id IN ({})"',
+            'b = "WITH records AS ({}) SELECT * FROM records"',
+            'c = "UPDATE {} SET archived = 1"',
+            'd = "SELECT {column} FROM phase"',
+            'e = """{}\nSELECT * FROM time_record"""'.format(schema.FULL_SCAN),
+            'f = "update"',
+        ]))
+        self.assertEqual(queries, ["SELECT id FROM phase WHERE id IN (NULL)"])
+
+    def test_full_scan_is_reported(self):
+        self.assertEqual(schema.get_unindexed_queries(
+            self.db, ["SELECT * FROM time_record WHERE stop > ?"]),
+            [("SELECT * FROM time_record WHERE stop > ?",
+              'SCAN time_record')])
+
+if __name__ == '__main__':
+    unittest.main()
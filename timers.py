@@ -0,0 +1,79 @@
+import threading
+
+class Timer(object):
+    """A running timer: who is timing what, since when (epoch seconds)."""
+
+    def __init__(self, user_id, time_record_id, project_id, phase_id,
+                 action_item_id, item_name, start):
+        self.user_id = user_id
+        self.time_record_id = time_record_id
+        self.project_id = project_id
+        self.phase_id = phase_id
+        self.action_item_id = action_item_id
+        self.item_name = item_name
+        self.start = start
+
+    def as_dict(self):
+        return {"time_record_id": self.time_record_id,
+                "project_id": self.project_id,
+                "phase_id": self.phase_id,
+                "item_id": self.action_item_id,
+                "name": self.item_name,
+                "start": self.start}
+
+class TimerRegistry(object):
+    """Keeps every running timer in memory, so finding out whether a
+    user is timing doesn't touch the db.
+
+    The active_timer table is the journal behind it. start_timing()
+    and stop_timing() write the journal in the same transaction as the
+    time_record, and only tell the registry (started()/stopped())
+    after that commits, so it never holds a timer that isn't in the
+    db. The registry loads itself from the journal on first use, e.g.
+    after a restart. Call reload() if the journal is changed some
+    other way.
+    """
+
+    def __init__(self):
+        self._timers = {}
+        self._stale = True
+        self._lock = threading.Lock()
+
+    def load(self, db):
+        rows = db.execute("""
+            SELECT  active_timer.user_id,
+                    active_timer.time_record_id,
+                    active_timer.project_id,
+                    active_timer.phase_id,
+                    active_timer.action_item_id,
+                    action_item.name,
+                    active_timer.start
+            FROM    active_timer,
+                    action_item
+            WHERE   action_item.id = active_timer.action_item_id
+            """).fetchall()
+        timers = dict((row[0], Timer(*row)) for row in rows)
+        with self._lock:
+            self._timers = timers
+            self._stale = False
+
+    def reload(self):
+        with self._lock:
+            self._stale = True
+
+    def is_loaded(self):
+        return not self._stale
+
+    def get(self, user_id):
+        return self._timers.get(user_id)
+
+    def started(self, timer):
+        with self._lock:
+            self._timers[timer.user_id] = timer
+
+    def stopped(self, user_id):
+        with self._lock:
+            return self._timers.pop(user_id, None)
+
+    def __len__(self):
+        return len(self._timers)